@@ -0,0 +1,104 @@
+# Description:
+#   Re-puts every entity of a kind, so the properties its model gained
+#   since the entity was written get stored and indexed. ComputedProperties
+#   are only stored by a put: the summary view of record/list projects on
+#   Record.num_parents and num_children, and person/search queries
+#   Person.search_tokens, so entities written before those existed are
+#   missing from both until they are put again.
+#
+#   POST /admin/backfill/<kind> queues the first task. Each task re-puts
+#   a page of the kind, every entity in its own transaction so a
+#   concurrent write is never overwritten, and queues the next page.
+#   Re-putting moves 'updated' along, so the next record/changes sync of
+#   a backfilled school sends all of it once.
+
+import json
+import logging
+import webapp2
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import datamodel_lib
+
+
+QUEUE_NAME = 'backfill'
+PAGE_URL = '/tasks/backfill/page'
+PAGE_SIZE = 100  # Entities per task.
+
+# Kind name -> the model re-put.
+KINDS = {
+  'Record': datamodel_lib.Record,
+  'Person': datamodel_lib.Person,
+}
+
+
+def _Task(kind, cursor=None):
+  return taskqueue.Task(url=PAGE_URL, payload=json.dumps(
+    {'kind': kind, 'cursor': cursor}))
+
+
+def Start(kind):
+  """Queues the backfill of kind, one of KINDS.
+
+  Raises:
+    ValueError: When kind is not one of KINDS.
+  """
+  if kind not in KINDS:
+    raise ValueError('Unknown kind: %s' % (kind))
+  taskqueue.Queue(QUEUE_NAME).add(_Task(kind))
+
+
+@ndb.transactional_tasklet
+def _PutAsync(key):
+  """Re-puts key. Returns the entity, None when it no longer exists."""
+  obj = yield key.get_async()
+  if obj:
+    yield obj.put_async()
+  raise ndb.Return(obj)
+
+
+def PutPage(payload):
+  """Re-puts one page of a kind and queues the task for the next.
+
+  Args:
+    payload: (dict) As queued by Start.
+  Returns:
+    int: The number of entities put.
+  """
+  model = KINDS[payload['kind']]
+  start = Cursor(urlsafe=payload['cursor']) if payload['cursor'] else None
+  keys, cursor, more = model.query().fetch_page(
+    PAGE_SIZE, keys_only=True, start_cursor=start)
+  # The transactions run side by side, one entity group each.
+  futures = [_PutAsync(k) for k in keys]
+  objs = [f.get_result() for f in futures]
+  objs = [o for o in objs if o]
+  # Summary listings of the schools change: their Records join them.
+  datamodel_lib.BumpSchoolVersion(
+    *[o.school for o in objs if isinstance(o, datamodel_lib.Record)])
+  if more:
+    taskqueue.Queue(QUEUE_NAME).add(_Task(payload['kind'], cursor.urlsafe()))
+  return len(objs)
+
+
+class StartHandler(webapp2.RequestHandler):
+  """POST /admin/backfill/<kind>: backfills every entity of kind."""
+
+  def post(self, kind):
+    try:
+      Start(kind)
+    except ValueError as e:
+      self.abort(404, detail=str(e))
+    logging.info('Backfilling %s', kind)
+    self.response.set_status(202)
+
+
+class PageHandler(webapp2.RequestHandler):
+  """Task queue worker for one page of a backfill."""
+
+  def post(self):
+    payload = json.loads(self.request.body)
+    count = PutPage(payload)
+    logging.info('Backfilled %d %s entities', count, payload['kind'])
@@ -0,0 +1,88 @@
+# Description:
+#   unittests for backfill.py
+
+import json
+import unittest
+
+import webapp2
+
+from google.appengine.api import datastore
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import backfill
+import datamodel_lib
+import main
+import test_lib
+
+
+def _PutOldRecord(school, parent):
+  """Puts a Record as written before it had head-counts.
+
+  Through the low-level datastore API, which leaves ndb and its caches
+  out of it.
+  """
+  entity = datastore.Entity('Record')
+  entity.update({'school': school.to_old_key(),
+                 'parents': [parent.to_old_key()]})
+  datastore.Put(entity)
+
+
+class BackfillTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = test_lib.Activate(taskqueue=True)
+    self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.AddSuperUser()
+    self.school = ndb.Key(datamodel_lib.District, 'test.org',
+                          datamodel_lib.School, 'test')
+    datamodel_lib.District(id='test.org').put()
+    datamodel_lib.School(key=self.school).put()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def _RunTasks(self):
+    """Runs queued tasks, and the ones they queue, until none are left."""
+    put = 0
+    while True:
+      tasks = self.taskqueue.get_filtered_tasks(
+        queue_names=[backfill.QUEUE_NAME])
+      if not tasks:
+        return put
+      self.taskqueue.FlushQueue(backfill.QUEUE_NAME)
+      for task in tasks:
+        put += backfill.PutPage(json.loads(task.payload))
+
+  def _Summaries(self):
+    return datamodel_lib.Record.All(self.school).fetch(
+      projection=datamodel_lib.Record.SUMMARY_PROJECTION)
+
+  def testRecords(self):
+    for i in xrange(3):
+      person = datamodel_lib.Person(first_name='mom%d' % (i)).put()
+      _PutOldRecord(self.school, person)
+    self.assertEquals([], self._Summaries())
+    backfill.PAGE_SIZE, page_size = 2, backfill.PAGE_SIZE
+    try:
+      backfill.Start('Record')
+      self.assertEquals(3, self._RunTasks())
+    finally:
+      backfill.PAGE_SIZE = page_size
+    self.assertEquals([(1, 0)] * 3, [(r.num_parents, r.num_children)
+                                     for r in self._Summaries()])
+
+  def testStartHandler(self):
+    request = webapp2.Request.blank('/admin/backfill/Person')
+    request.method = 'POST'
+    self.assertEquals(202, request.get_response(main.app).status_int)
+    self.assertEquals(1, len(self.taskqueue.get_filtered_tasks(
+      queue_names=[backfill.QUEUE_NAME])))
+    request = webapp2.Request.blank('/admin/backfill/Nope')
+    request.method = 'POST'
+    self.assertEquals(404, request.get_response(main.app).status_int)
+
+
+if __name__ == '__main__':
+  unittest.main()
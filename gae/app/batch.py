@@ -0,0 +1,199 @@
+# Description:
+#   Applies a list of Person and Record writes in as few transactions as
+#   their entity groups allow, for the batch endpoint.
+#
+#   Operations are packed, in order, into transactions of at most
+#   MAX_GROUPS entity groups, the cross-group transaction limit. The
+#   operations of a transaction run as parallel tasklets, so ndb's
+#   autobatcher turns their gets and puts into a few batch RPCs. When a
+#   transaction fails, its operations are retried one per transaction, so
+#   one bad operation only fails itself.
+
+import endpoints
+import logging
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+from protorpc import messages
+
+import datamodel_lib
+import person_fanout
+import stats
+import txn
+
+
+MAX_OPERATIONS = 500
+MAX_GROUPS = txn.MAX_GROUPS
+
+
+class BatchOperationMessage(messages.Message):
+  """One write: an update when the message has an id, else a create.
+
+  Exactly one of record and person is set. school places a new person.
+  """
+  record = messages.MessageField(datamodel_lib.RecordMessage, 1)
+  person = messages.MessageField(datamodel_lib.PersonMessage, 2)
+  school = messages.MessageField(datamodel_lib.SchoolMessage, 3)
+
+
+class BatchRequestMessage(messages.Message):
+  operations = messages.MessageField(BatchOperationMessage, 1, repeated=True)
+
+
+class BatchResultMessage(messages.Message):
+  """The outcome of operations[index]: what was written, or error."""
+  index = messages.IntegerField(1)
+  record = messages.MessageField(datamodel_lib.RecordMessage, 2)
+  person = messages.MessageField(datamodel_lib.PersonMessage, 3)
+  error = messages.StringField(4)
+
+
+class BatchResponseMessage(messages.Message):
+  results = messages.MessageField(BatchResultMessage, 1, repeated=True)
+
+
+def _SchoolKey(msg):
+  return ndb.Key(datamodel_lib.District, msg.district,
+                 datamodel_lib.School, msg.name)
+
+
+def _Groups(op):
+  """The entity groups op writes, as root keys or placeholders."""
+  if op.record:
+    return datamodel_lib.Record.EntityGroups(op.record)
+  return set([datamodel_lib.Person.EntityGroup(
+    op.person, op.school and _SchoolKey(op.school))])
+
+
+def _Chunks(ops):
+  """Packs (index, op, groups), in order, into lists of <= MAX_GROUPS groups.
+
+  Yields:
+    list: (index, op, groups) triples.
+  """
+  chunk = []
+  chunk_groups = set()
+  for index, op, groups in ops:
+    if chunk and len(chunk_groups | groups) > MAX_GROUPS:
+      yield chunk
+      chunk = []
+      chunk_groups = set()
+    chunk.append((index, op, groups))
+    chunk_groups |= groups
+  if chunk:
+    yield chunk
+
+
+def _Validate(op):
+  """Checks op before any of the batch is written.
+
+  Returns:
+    set: The entity groups of op, see _Groups.
+  """
+  if bool(op.record) == bool(op.person):
+    raise ValueError('Set exactly one of record and person.')
+  if op.record:
+    op.record.check_initialized()
+  else:
+    op.person.check_initialized()
+  return _Groups(op)
+
+
+@ndb.tasklet
+def _ApplyAsync(op, changed_people, stat_deltas):
+  """Writes op. Returns the Record or Person written."""
+  if op.record:
+    result = yield datamodel_lib.Record.FromMessageAsync(
+      op.record, changed_people=changed_people, stat_deltas=stat_deltas)
+  else:
+    result = yield datamodel_lib.Person.FromMessageAsync(
+      op.person, school=op.school and _SchoolKey(op.school),
+      changed_people=changed_people)
+  raise ndb.Return(result)
+
+
+def _Transact(chunk):
+  """Applies the operations of chunk in one transaction, cross-group only
+  when they span more than one entity group.
+
+  Returns:
+    (list, list, list): The entities written, in chunk order, the Persons
+      whose summary changed, and the schools Records were added to or
+      moved out of.
+  """
+  changed_people = []
+  schools = []
+  def _Txn():
+    del changed_people[:]  # From an attempt that was retried.
+    # The counts of the whole chunk go to one shard per school.
+    stat_deltas = stats.Deltas()
+    futures = [_ApplyAsync(op, changed_people, stat_deltas)
+               for _, op, _ in chunk]
+    entities = [f.get_result() for f in futures]
+    stats.ApplyAsync(stat_deltas).get_result()
+    schools[:] = stat_deltas.Schools()
+    return entities
+  groups = set().union(*[groups for _, _, groups in chunk])
+  entities = txn.Run(_Txn, groups=len(groups))
+  return entities, changed_people, schools
+
+
+# What makes an operation fail, rather than the whole request.
+_OPERATION_ERRORS = (ValueError, messages.ValidationError,
+                     endpoints.ServiceException, datastore_errors.Error)
+
+
+def _Result(index, entity):
+  if isinstance(entity, datamodel_lib.Record):
+    return BatchResultMessage(
+      index=index, record=datamodel_lib.Record.SnapshotToMessage(entity))
+  return BatchResultMessage(
+    index=index, person=datamodel_lib.Person.ToMessage(entity))
+
+
+def Apply(request):
+  """Applies the operations of a BatchRequestMessage.
+
+  Returns:
+    BatchResponseMessage: One result per operation, in request order.
+  Raises:
+    endpoints.BadRequestException: When there are too many operations.
+  """
+  if len(request.operations) > MAX_OPERATIONS:
+    raise endpoints.BadRequestException(
+      'At most %d operations per batch.' % (MAX_OPERATIONS))
+  results = {}
+  valid = []
+  for index, op in enumerate(request.operations):
+    try:
+      valid.append((index, op, _Validate(op)))
+    except _OPERATION_ERRORS as e:
+      results[index] = BatchResultMessage(index=index, error=str(e))
+  changed_people = []
+  schools = set()
+  for chunk in _Chunks(valid):
+    try:
+      attempts = [(chunk, _Transact(chunk))]
+    except _OPERATION_ERRORS as e:
+      logging.info('Batch of %d failed (%s), retrying one by one',
+                   len(chunk), e)
+      attempts = []
+      for index, op, groups in chunk:
+        single = [(index, op, groups)]
+        try:
+          attempts.append((single, _Transact(single)))
+        except _OPERATION_ERRORS as e:
+          results[index] = BatchResultMessage(index=index, error=str(e))
+    for done, (entities, changed, changed_schools) in attempts:
+      changed_people.extend(changed)
+      schools.update(changed_schools)
+      for (index, _, _), entity in zip(done, entities):
+        results[index] = _Result(index, entity)
+        if isinstance(entity, datamodel_lib.Person):
+          # The full view of every school listing the Person shows it.
+          schools.update(entity.schools)
+  # After the commits, as RecordAdd does.
+  datamodel_lib.BumpSchoolVersion(*schools)
+  person_fanout.EnqueueRefresh(changed_people)
+  return BatchResponseMessage(
+    results=[results[i] for i in sorted(results)])
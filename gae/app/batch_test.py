@@ -0,0 +1,111 @@
+# Description:
+#   unittests for batch.py
+
+import unittest
+
+from google.appengine.ext import ndb
+
+import batch
+import datamodel_lib
+import test_lib
+
+
+def _School():
+  return datamodel_lib.SchoolMessage(district='test.org', name='test')
+
+
+def _RecordOp(name, record_id=None):
+  return batch.BatchOperationMessage(record=datamodel_lib.RecordMessage(
+    id=record_id, school=_School(),
+    parents=[datamodel_lib.PersonMessage(
+      first_name='parent', last_name=name,
+      email_addresses=['%s@example.com' % (name)])],
+    children=[datamodel_lib.PersonMessage(first_name='child',
+                                          last_name=name)]))
+
+
+class BatchTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = test_lib.Activate(taskqueue=True)
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.AddSuperUser()
+    datamodel_lib.District(id='test.org').put()
+    datamodel_lib.School(
+      id='test', parent=ndb.Key(datamodel_lib.District, 'test.org')).put()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testMixedOperations(self):
+    existing = datamodel_lib.Record.FromMessage(_RecordOp('lee').record)
+    person = batch.BatchOperationMessage(
+      person=datamodel_lib.PersonMessage(
+        first_name='solo', email_addresses=['solo@example.com']),
+      school=_School())
+    update = _RecordOp('lee', record_id=existing.key.urlsafe())
+    update.record.children[0].first_name = 'kid'
+    request = batch.BatchRequestMessage(operations=[
+      _RecordOp('smith'), person, update, batch.BatchOperationMessage()])
+    response = batch.Apply(request)
+    self.assertEquals([0, 1, 2, 3], [r.index for r in response.results])
+    self.assertEquals('smith', response.results[0].record.parents[0].last_name)
+    self.assertEquals('solo', response.results[1].person.first_name)
+    self.assertEquals(existing.key.urlsafe(), response.results[2].record.id)
+    self.assertEquals('kid', response.results[2].record.children[0].first_name)
+    self.assertTrue(response.results[3].error)
+    self.assertEquals(2, datamodel_lib.Record.query().count())
+
+  def testMoveChangesBothSchools(self):
+    test = ndb.Key(datamodel_lib.District, 'test.org',
+                   datamodel_lib.School, 'test')
+    other = ndb.Key(datamodel_lib.District, 'test.org',
+                    datamodel_lib.School, 'other')
+    datamodel_lib.School(key=other).put()
+    existing = datamodel_lib.Record.FromMessage(_RecordOp('lee').record)
+    versions = [datamodel_lib.SchoolVersion(s) for s in (test, other)]
+    move = _RecordOp('lee', record_id=existing.key.urlsafe())
+    move.record.school.name = 'other'
+    response = batch.Apply(batch.BatchRequestMessage(operations=[move]))
+    self.assertEquals(None, response.results[0].error)
+    self.assertEquals(other, existing.key.get().school)
+    for school, version in zip((test, other), versions):
+      self.assertNotEquals(version, datamodel_lib.SchoolVersion(school))
+
+  def testPersonChangesItsSchools(self):
+    test = ndb.Key(datamodel_lib.District, 'test.org',
+                   datamodel_lib.School, 'test')
+    existing = datamodel_lib.Record.FromMessage(_RecordOp('lee').record)
+    version = datamodel_lib.SchoolVersion(test)
+    # An address is not in the snapshots, so no fan-out bumps it either.
+    update = batch.BatchOperationMessage(person=datamodel_lib.PersonMessage(
+      id=existing.parents[0].urlsafe(), addresses=['1 Main St']))
+    response = batch.Apply(batch.BatchRequestMessage(operations=[update]))
+    self.assertEquals(None, response.results[0].error)
+    self.assertNotEquals(version, datamodel_lib.SchoolVersion(test))
+
+  def testBadOperationOnlyFailsItself(self):
+    missing = ndb.Key(datamodel_lib.Record, 404).urlsafe()
+    request = batch.BatchRequestMessage(operations=[
+      _RecordOp('smith'), _RecordOp('jones', record_id=missing),
+      _RecordOp('lee')])
+    response = batch.Apply(request)
+    self.assertEquals([None, None],
+                      [response.results[i].error for i in (0, 2)])
+    self.assertTrue(response.results[1].error)
+    self.assertEquals(2, datamodel_lib.Record.query().count())
+
+  def testChunksStayUnderTheGroupLimit(self):
+    # Each op: a new record, a keyed parent, a new child. The school is
+    # read outside of the transaction.
+    ops = [_RecordOp('family-%d' % (i)) for i in xrange(20)]
+    ops = [(i, op, batch._Groups(op)) for i, op in enumerate(ops)]
+    chunks = list(batch._Chunks(ops))
+    # The school's and district's counter shards are shared, so 7 ops fit
+    # in 2 + 7 * 3 = 23 groups.
+    self.assertEquals([7, 7, 6], [len(c) for c in chunks])
+    self.assertEquals(range(20), [i for c in chunks for i, _, _ in c])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,130 @@
+# Description:
+#   Runs the request paths from parallel threads, as a threadsafe
+#   instance does, and checks nothing leaks or is lost between them.
+
+import threading
+import unittest
+
+from google.appengine.ext import ndb
+
+import datamodel_lib
+import metrics
+import oauth
+import rpc_stats
+import test_lib
+
+
+THREADS = 16
+
+
+class _Barrier(object):
+  """Holds threads in Wait until count of them have arrived."""
+
+  def __init__(self, count):
+    self.count = count
+    self.arrived = 0
+    self.cond = threading.Condition()
+
+  def Wait(self):
+    with self.cond:
+      self.arrived += 1
+      self.cond.notify_all()
+      while self.arrived < self.count:
+        self.cond.wait()
+
+
+def _RunInThreads(fn, count=THREADS):
+  """Runs fn(i) on count threads at once; returns results, raises errors."""
+  results = [None] * count
+  errors = []
+  start = threading.Event()
+  def _Run(i):
+    start.wait()
+    try:
+      results[i] = fn(i)
+    except Exception as e:  # Reported on the main thread.
+      errors.append(e)
+  threads = [threading.Thread(target=_Run, args=(i,)) for i in xrange(count)]
+  for t in threads:
+    t.start()
+  start.set()
+  for t in threads:
+    t.join()
+  if errors:
+    raise errors[0]
+  return results
+
+
+class ConcurrencyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = test_lib.Activate()
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.AddSuperUser()
+    datamodel_lib.District(id='test.org').put()
+    self.school = datamodel_lib.School(
+      id='test', parent=ndb.Key(datamodel_lib.District, 'test.org')).put()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testParallelRecordWrites(self):
+    def _Write(i):
+      with oauth.RequestPrincipal(datamodel_lib.User):
+        return datamodel_lib.Record.FromMessage(datamodel_lib.RecordMessage(
+          school=datamodel_lib.School.KeyToMessage(self.school),
+          parents=[datamodel_lib.PersonMessage(first_name='parent-%d' % (i))],
+          children=[datamodel_lib.PersonMessage(first_name='child-%d' % (i))]))
+    records = _RunInThreads(_Write)
+    self.assertEquals(THREADS, len(set(r.key for r in records)))
+    col = datamodel_lib.RecordCollectionMessageFromRecord(
+      datamodel_lib.Record.All(self.school).fetch())
+    self.assertEquals(
+      sorted('parent-%d' % (i) for i in xrange(THREADS)),
+      sorted(item.parents[0].first_name for item in col.items))
+
+  def testPrincipalIsPerThread(self):
+    all_in = _Barrier(THREADS)
+    def _Check(i):
+      with oauth.RequestPrincipal(datamodel_lib.User) as principal:
+        principal._is_super_user = bool(i % 2)
+        # Wait until every thread holds its own principal.
+        all_in.Wait()
+        mine = oauth.GetPrincipal()
+        return mine is principal and mine.is_super_user == bool(i % 2)
+    self.assertEquals([True] * THREADS, _RunInThreads(_Check))
+    self.assertEquals(None, getattr(oauth._request_state, 'principal', None))
+
+  def testRpcCountersArePerThread(self):
+    def _Count(i):
+      with rpc_stats.RpcCounter() as counter:
+        for _ in xrange(i):
+          datamodel_lib.District.get_by_id(
+            'test.org', use_cache=False, use_memcache=False)
+      return counter.Total('datastore_v3')
+    self.assertEquals(range(THREADS), _RunInThreads(_Count))
+
+  def testMetricsRegistry(self):
+    registry = metrics.Registry()
+    sample = {'latency_ms': 1, 'error': False}
+    sample.update((name, 1) for name in metrics.RPC_METRICS)
+    def _Add(i):
+      for _ in xrange(100):
+        registry.Add('M', sample)
+    _RunInThreads(_Add)
+    self.assertEquals(THREADS * 100, registry.Snapshot()['M']['requests'])
+
+  def testListCacheUnderParallelReads(self):
+    def _List(i):
+      if i == 0:
+        datamodel_lib.District(id='other.org').put()
+        datamodel_lib.InvalidateListCache(datamodel_lib.District._get_kind())
+      keys, _ = datamodel_lib.District.ListPage()
+      return [k.id() for k in keys]
+    _RunInThreads(_List)
+    keys, _ = datamodel_lib.District.ListPage()
+    self.assertEquals(['other.org', 'test.org'], [k.id() for k in keys])
+
+
+if __name__ == '__main__':
+  unittest.main()
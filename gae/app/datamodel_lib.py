@@ -1,22 +1,21 @@
 # Description:
 #   NDB/Endpoints objects and brokering between them.
 
+import datetime
 import endpoints
+import hashlib
 import logging
-import os
+import re
+import time
 
-from apiclient.discovery import build
-from google.appengine.api import users
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
-from google.appengine.ext import webapp
-from google.appengine.ext.webapp.util import run_wsgi_app
-from google.appengine.ext.db import BadArgumentError
-from oauth2client.appengine import OAuth2DecoratorFromClientSecrets
 from protorpc import messages
-from protorpc import message_types
-from protorpc import remote
 
 import oauth
+import paging
+import stats
+import txn
 
 
 # Users.
@@ -39,18 +38,17 @@ class User(ndb.Model):
 
   @classmethod
   def FromMessage(cls, msg):
-    oauth.ValidateUser(None, None)
-    u = oauth.GetEndpointsUser()
+    principal = oauth.ValidateUser(None, None)
     db_user = None
     changed = False
     if msg.id:
       db_user = ndb.Key(urlsafe=msg.id).get()
-      if db_user.created_by.user_id != u.user_id():  # Authorized.
+      if db_user.created_by.user_id() != principal.user_id:  # Authorized.
         raise endpoints.UnauthorizedException('Invalid Request.')
     else:  # New-user?
       db_user = User.Find()  # Email exists.
       if not db_user:  # Real-new request
-        db_user = User(email_addresses=[u.email()])
+        db_user = User(email_addresses=[principal.email])
         changed = True
     if msg.email_addresses and db_user.email_addresses != msg.email_addresses:
       changed = True
@@ -62,35 +60,131 @@ class User(ndb.Model):
 
   @classmethod
   def Find(cls, email=None):
-    oauth.ValidateUser(None, None)
-    current_user = oauth.GetEndpointsUser()
+    principal = oauth.ValidateUser(None, None)
     is_super_user = False
     if email:  # Super user attempt
-      admin = User.query(
-        User.email_addresses == current_user.email()).fetch(1)[0]
-      if not admin:
+      is_super_user = oauth.IsSuperUser(User)
+      if not is_super_user:
         return None
-      else:
-        is_super_user = admin.is_super_user
     else:
-      email = current_user.email()
+      email = principal.email
     q = User.query(User.email_addresses == email)
     for db_user in q:
-      if is_super_user or db_user.created_by.user_id() == current_user.user_id():
+      if is_super_user or db_user.created_by.user_id() == principal.user_id:
         return db_user
     return None
 
+  @classmethod
+  def Acl(cls, principal):
+    """The UserAcl of principal, see oauth.Principal.acl."""
+    return UserAcl.ForPrincipal(principal)
+
+  def _post_put_hook(self, future):
+    emails = list(self.email_addresses)
+    txn.AfterCommit(lambda: InvalidateAcls(emails))
+
   @classmethod
   def SetSuperUser(cls, user_email, val):
     oauth.ValidateUser(None, None)
-    current_user = User.Find()
-    if not current_user or not current_user.is_super_user:
+    if not oauth.IsSuperUser(User):
       raise endpoints.UnauthorizedException('Not Allowed.')
     other_user = User.Find(email=user_email)
     other_user.is_super_user = val
     other_user.put()
 
 
+# Listings of reference data (Districts, Schools) are cached in memcache,
+# page by page, under a per-kind generation. Bumping the generation drops
+# every cached page of the kind at once. Single entities need nothing
+# extra: ndb already reads get_by_id through memcache and clears it on put.
+LIST_CACHE_SECONDS = 6 * 60 * 60
+
+
+def _ListGenerationKey(kind):
+  return 'list-generation:%s' % (kind)
+
+
+def _ListGeneration(kind):
+  key = _ListGenerationKey(kind)
+  generation = memcache.get(key)
+  if generation is None:
+    # Seeded from the clock so an evicted generation is never reused.
+    generation = int(time.time() * 1000)
+    if not memcache.add(key, generation):
+      generation = memcache.get(key) or generation
+  return generation
+
+
+def InvalidateListCache(kind):
+  """Drops every cached listing page of kind. Call after the commit."""
+  memcache.incr(_ListGenerationKey(kind),
+                initial_value=int(time.time() * 1000))
+
+
+# Every School has a version stamp in memcache, bumped after each write of
+# its Records. ETags derive from it, or from the list generation for the
+# District and School listings: an unchanged stamp means an unchanged
+# response. An evicted stamp is reseeded from the clock, which only costs
+# clients a full response.
+def _SchoolVersionKey(school):
+  return 'school-version:%s/%s' % (school.parent().id(), school.id())
+
+
+def SchoolVersion(school):
+  """The version stamp of school, a School key."""
+  key = _SchoolVersionKey(school)
+  version = memcache.get(key)
+  if version is None:
+    version = int(time.time() * 1000)
+    if not memcache.add(key, version):
+      version = memcache.get(key) or version
+  return version
+
+
+def BumpSchoolVersion(*schools):
+  """Changes the version stamps of schools. Call after the commit."""
+  keys = set(_SchoolVersionKey(s) for s in schools)
+  if keys:
+    memcache.offset_multi(dict((k, 1) for k in keys),
+                          initial_value=int(time.time() * 1000))
+
+
+def _Etag(version, parts):
+  digest = hashlib.sha1(repr((version,) + tuple(parts))).hexdigest()
+  return '"%s"' % (digest[:20])
+
+
+def ListEtag(kind, *parts):
+  """ETag of a listing of kind, parts being the request (page, ...)."""
+  return _Etag(_ListGeneration(kind), (kind,) + parts)
+
+
+def SchoolEtag(school, *parts):
+  """ETag of a response about school's Records, see ListEtag."""
+  return _Etag(SchoolVersion(school), (school.urlsafe(),) + parts)
+
+
+def _CachedKeysPage(model, page_size, page_token):
+  """Read-through cache of a keys-only page of model.All().
+
+  Returns:
+    (list, str): The keys on the page and the next page's token.
+  """
+  kind = model._get_kind()
+  cache_key = 'list:%s:%s:%s:%s' % (
+    kind, _ListGeneration(kind), page_size or 0,
+    hashlib.sha1(page_token or '').hexdigest())
+  cached = memcache.get(cache_key)
+  if cached is not None:
+    urlsafe_keys, next_page_token = cached
+    return [ndb.Key(urlsafe=k) for k in urlsafe_keys], next_page_token
+  keys, next_page_token = paging.FetchPage(
+    model.All(), page_size, page_token, keys_only=True)
+  memcache.set(cache_key, ([k.urlsafe() for k in keys], next_page_token),
+               time=LIST_CACHE_SECONDS)
+  return keys, next_page_token
+
+
 # A District is also an NDB RootEntity for xg-Transactions.
 class DistrictMessage(messages.Message):
   """The endpoints protorpc for a single db record."""
@@ -100,13 +194,25 @@ class DistrictMessage(messages.Message):
 class DistrictCollectionMessage(messages.Message):
   """Used when listing all districts."""
   items = messages.MessageField(DistrictMessage, 1, repeated=True)
+  next_page_token = messages.StringField(2)
+  # Send it back as If-None-Match to get not_modified if nothing changed.
+  etag = messages.StringField(3)
+  # The If-None-Match sent is still current: only etag is set.
+  not_modified = messages.BooleanField(4)
 
 
-def DistrictCollectionMessageFromDistrict(objs):
+def DistrictCollectionMessageFromDistrict(objs, next_page_token=None):
   container = []
   for o in objs:
     container.append(District.ToMessage(o))
-  return DistrictCollectionMessage(items=container)
+  return DistrictCollectionMessage(items=container,
+                                   next_page_token=next_page_token)
+
+
+def DistrictCollectionMessageFromKeys(keys, next_page_token=None):
+  return DistrictCollectionMessage(
+    items=[District.KeyToMessage(k) for k in keys],
+    next_page_token=next_page_token)
 
 
 class District(ndb.Model):
@@ -116,7 +222,11 @@ class District(ndb.Model):
 
   @classmethod
   def ToMessage(cls, obj):
-    return DistrictMessage(domain=obj.key.id())
+    return cls.KeyToMessage(obj.key)
+
+  @classmethod
+  def KeyToMessage(cls, key):
+    return DistrictMessage(domain=key.id())
 
   @classmethod
   def FromMessage(cls, msg):
@@ -125,6 +235,7 @@ class District(ndb.Model):
       if oauth.IsSuperUser(User):
         v = District(id=msg.domain)
         v.put()
+        txn.AfterCommit(lambda: InvalidateListCache(cls._get_kind()))
       else:
         raise ValueError('District does not exist.')
     return v
@@ -133,6 +244,11 @@ class District(ndb.Model):
   def All(cls):
     return cls.query()
 
+  @classmethod
+  def ListPage(cls, page_size=None, page_token=None):
+    """A cached page of District keys, see _CachedKeysPage."""
+    return _CachedKeysPage(cls, page_size, page_token)
+
 
 # Schools are in Districts (via ancestors).
 class SchoolMessage(messages.Message):
@@ -143,18 +259,25 @@ class SchoolMessage(messages.Message):
 class SchoolCollectionMessage(messages.Message):
   """Used when listing all districts."""
   items = messages.MessageField(SchoolMessage, 1, repeated=True)
+  next_page_token = messages.StringField(2)
+  # Send it back as If-None-Match to get not_modified if nothing changed.
+  etag = messages.StringField(3)
+  # The If-None-Match sent is still current: only etag is set.
+  not_modified = messages.BooleanField(4)
 
 
-def SchoolCollectionMessageFromSchool(objs):
+def SchoolCollectionMessageFromSchool(objs, next_page_token=None):
   container = []
   for o in objs:
     container.append(School.ToMessage(o))
-  return SchoolCollectionMessage(items=container)
+  return SchoolCollectionMessage(items=container,
+                                 next_page_token=next_page_token)
 
 
-class SchoolCollectionMessage(messages.Message):
-  """Used when listing all districts."""
-  items = messages.MessageField(SchoolMessage, 1, repeated=True)
+def SchoolCollectionMessageFromKeys(keys, next_page_token=None):
+  return SchoolCollectionMessage(
+    items=[School.KeyToMessage(k) for k in keys],
+    next_page_token=next_page_token)
 
 
 class School(ndb.Model):
@@ -163,38 +286,364 @@ class School(ndb.Model):
   # name of the school is the id.
   @classmethod
   def ToMessage(cls, obj):
-    return SchoolMessage(
-      district=obj.key.parent().id(), name=obj.key.id())
+    return cls.KeyToMessage(obj.key)
+
+  @classmethod
+  def KeyToMessage(cls, key):
+    """The key carries everything in the message, so no get() is needed."""
+    return SchoolMessage(district=key.parent().id(), name=key.id())
 
   @classmethod
   def FromMessage(cls, msg):
-    oauth.ValidateUser(  # TODO(renwick): Port to SchoolUser
-      School, ndb.Key(District, msg.district, School, msg.name))
-    d = District.get_by_id(msg.district)
+    return cls.FromMessageAsync(msg).get_result()
+
+  @classmethod
+  @ndb.tasklet
+  def FromMessageAsync(cls, msg):
+    oauth.ValidateUser(None, None)
+    # Both gets are issued together.
+    d, s = yield (District.get_by_id_async(msg.district),
+                  School.get_by_id_async(
+                    msg.name, parent=ndb.Key(District, msg.district)))
     if not d:
       raise ValueError('Bad district')
-    s = School.get_by_id(id=msg.name,
-                         parent=ndb.Key(District, msg.district))
     if not s:
       if oauth.IsSuperUser(User):
         s = School(id=msg.name,
                    parent=ndb.Key(District, msg.district))
-        s.put()
+        yield s.put_async()
+        txn.AfterCommit(lambda: InvalidateListCache(cls._get_kind()))
       else:
         raise ValueError('School does not exist.')  # Opaque on purpose
-    return s
+    elif not HasSchoolAccess(s.key):
+      raise ValueError('School does not exist.')  # Same for non-members.
+    raise ndb.Return(s)
 
   @classmethod
   def All(cls):
     return cls.query()
 
+  @classmethod
+  def ListPage(cls, page_size=None, page_token=None):
+    """A cached page of School keys, see _CachedKeysPage."""
+    return _CachedKeysPage(cls, page_size, page_token)
+
+
+# Authorization. A SchoolUser makes an email a member or manager of its
+# parent School. What a user may do is materialized into one UserAcl,
+# keyed by user_id, so a request authorizes with a single get, which ndb
+# serves from memcache. A UserAcl is built on the first lookup and
+# deleted once a write to a User or SchoolUser of its email commits. That
+# deletion finds the UserAcl with a query, which may briefly miss a new
+# one, so UserAcls are also rebuilt once they are ACL_MAX_AGE_SECONDS old.
+ACL_MAX_AGE_SECONDS = 10 * 60
+
+class SchoolMemberMessage(messages.Message):
+  district = messages.StringField(1, required=True)
+  school = messages.StringField(2, required=True)
+  email = messages.StringField(3, required=True)
+  role = messages.StringField(4)
+
+
+class SchoolMemberCollectionMessage(messages.Message):
+  """Used when listing the members of a school."""
+  items = messages.MessageField(SchoolMemberMessage, 1, repeated=True)
+  next_page_token = messages.StringField(2)
+
 
 class SchoolUser(ndb.Model):
-  """Relationship between Users and schools. These are managers."""
-  pass
+  """Membership of an email in the School that is its parent."""
+  ROLES = ('member', 'manager')
+  # Also the id, lower-cased.
+  email = ndb.StringProperty(required=True)
+  role = ndb.StringProperty(choices=ROLES, default='member')
+  added_by = ndb.UserProperty(auto_current_user_add=True)
+
+  @classmethod
+  def ToMessage(cls, obj):
+    school = obj.key.parent()
+    return SchoolMemberMessage(district=school.parent().id(),
+                               school=school.id(), email=obj.email,
+                               role=obj.role)
+
+  @classmethod
+  def _Key(cls, msg):
+    email = NormalizeEmail(msg.email)
+    if not email:
+      raise ValueError('Invalid email: %s' % (msg.email))
+    school = ndb.Key(District, msg.district, School, msg.school)
+    return ndb.Key(SchoolUser, email, parent=school)
+
+  @classmethod
+  def FromMessage(cls, msg):
+    """Adds or changes a membership. Needs manager access to the school."""
+    oauth.ValidateUser(None, None)
+    key = cls._Key(msg)
+    CheckSchoolAccess(key.parent(), manage=True)
+    role = msg.role or cls.ROLES[0]
+    if role not in cls.ROLES:
+      raise ValueError('Unknown role: %s' % (role))
+    if not key.parent().get():
+      raise ValueError('School does not exist.')
+    obj = SchoolUser(key=key, email=key.id(), role=role)
+    obj.put()
+    return obj
+
+  @classmethod
+  def Remove(cls, msg):
+    """Ends a membership. Needs manager access to the school."""
+    oauth.ValidateUser(None, None)
+    key = cls._Key(msg)
+    CheckSchoolAccess(key.parent(), manage=True)
+    key.delete()
+
+  @classmethod
+  def ListPage(cls, school, page_size=None, page_token=None):
+    """A page of school's members. Needs manager access to the school."""
+    CheckSchoolAccess(school, manage=True)
+    return paging.FetchPage(cls.query(ancestor=school), page_size, page_token)
+
+  def _post_put_hook(self, future):
+    email = self.email
+    txn.AfterCommit(lambda: InvalidateAcls([email]))
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    txn.AfterCommit(lambda: InvalidateAcls([key.id()]))
+
+
+def SchoolMemberCollectionMessageFromSchoolUser(objs, next_page_token=None):
+  return SchoolMemberCollectionMessage(
+    items=[SchoolUser.ToMessage(o) for o in objs],
+    next_page_token=next_page_token)
+
+
+class UserAcl(ndb.Model):
+  """What one user (the id is their user_id) may do. Derived, see above."""
+  email = ndb.StringProperty()
+  is_super_user = ndb.BooleanProperty(default=False, indexed=False)
+  schools = ndb.KeyProperty(School, repeated=True, indexed=False)
+  managed_schools = ndb.KeyProperty(School, repeated=True, indexed=False)
+  built = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+  def CanRead(self, school):
+    return (self.is_super_user or school in self.schools or
+            school in self.managed_schools)
+
+  def CanManage(self, school):
+    return self.is_super_user or school in self.managed_schools
+
+  @classmethod
+  @ndb.non_transactional
+  def ForPrincipal(cls, principal):
+    """The UserAcl of principal, built when there is none yet.
+
+    Outside of any transaction, so it never adds an entity group to the
+    caller's.
+    """
+    acl = cls.get_by_id(principal.user_id)
+    if acl is None or acl.built < datetime.datetime.utcnow() - (
+        datetime.timedelta(seconds=ACL_MAX_AGE_SECONDS)):
+      acl = cls.Materialize(principal)
+    return acl
+
+  @classmethod
+  def Materialize(cls, principal):
+    """Builds and stores principal's UserAcl from User and SchoolUser."""
+    email = NormalizeEmail(principal.email) or principal.email
+    # As User.Find: only the caller's own User entries count.
+    users = User.query(User.email_addresses == principal.email).fetch()
+    is_super_user = any(
+      u.is_super_user and u.created_by and
+      u.created_by.user_id() == principal.user_id for u in users)
+    memberships = SchoolUser.query(SchoolUser.email == email).fetch()
+    acl = cls(id=principal.user_id, email=email, is_super_user=is_super_user,
+              schools=[m.key.parent() for m in memberships
+                       if m.role != 'manager'],
+              managed_schools=[m.key.parent() for m in memberships
+                               if m.role == 'manager'])
+    acl.put()
+    return acl
+
+
+@ndb.non_transactional
+def InvalidateAcls(emails):
+  """Deletes the UserAcls of emails, rebuilt on their next lookup."""
+  emails = set(NormalizeEmail(e) or e for e in emails)
+  if not emails:
+    return
+  keys = UserAcl.query(UserAcl.email.IN(list(emails))).fetch(keys_only=True)
+  ndb.delete_multi(keys)
+
+
+def HasSchoolAccess(school, manage=False):
+  """Whether the caller may read (or manage) school, a School key."""
+  acl = oauth.GetPrincipal(User).acl
+  return bool(acl and (acl.CanManage(school) if manage else
+                       acl.CanRead(school)))
+
+
+def CheckSchoolAccess(school, manage=False):
+  """Raises unless the caller may read (or manage) school, a School key.
+
+  Raises:
+    endpoints.ForbiddenException: When the caller may not.
+  """
+  if not HasSchoolAccess(school, manage=manage):
+    raise endpoints.ForbiddenException('No access to this school.')
+
+
+# Person search is answered from search_tokens, which holds every prefix
+# (up to MAX_PREFIX_LENGTH) of each name word, email address and phone
+# number's digits. It is a ComputedProperty, so every put keeps it current.
+MAX_PREFIX_LENGTH = 20
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_PHONE_RE = re.compile(r'^[\d\s()+.-]+$')
+
+
+def _Prefixes(term):
+  term = term[:MAX_PREFIX_LENGTH]
+  return [term[:i] for i in xrange(1, len(term) + 1)]
+
+
+def _PhoneDigits(phone):
+  return re.sub(r'\D', '', phone)
+
+
+def SearchTokens(person):
+  """The prefix tokens indexed for person."""
+  tokens = set()
+  for name in (person.first_name, person.last_name):
+    for word in _WORD_RE.findall((name or '').lower()):
+      tokens.update(_Prefixes(word))
+  for email in person.email_addresses:
+    tokens.update(_Prefixes(email.strip().lower()))
+  for phone in person.phone_numbers:
+    tokens.update(_Prefixes(_PhoneDigits(phone)))
+  return sorted(tokens)
+
+
+def SearchTerms(query):
+  """Splits a typeahead query into the terms every match must prefix."""
+  query = (query or '').strip().lower()
+  if _PHONE_RE.match(query) and _PhoneDigits(query):
+    return [_PhoneDigits(query)]
+  return [t for t in query.split() if t]
+
+
+# Person identity: a Person with an email or phone is keyed by it, per
+# School, so writing the same person twice finds the first by key.
+DEFAULT_COUNTRY_CODE = '1'
+
+
+def NormalizeEmail(email):
+  """Lower-cased email, None when it isn't one."""
+  email = (email or '').strip().lower()
+  return email if '@' in email.strip('@') else None
+
+
+def NormalizePhone(phone, country_code=DEFAULT_COUNTRY_CODE):
+  """The E.164 form of phone, e.g. '+15550100123'.
+
+  Numbers without a leading '+' are national numbers of country_code,
+  which may also already start them (1-555-...).
+
+  Returns:
+    str: The E.164 number, None when phone can't be one.
+  """
+  phone = (phone or '').strip()
+  digits = _PhoneDigits(phone)
+  if not phone.startswith('+'):
+    if not digits.startswith(country_code) or len(digits) <= 10:
+      digits = country_code + digits.lstrip('0')
+  if not 8 <= len(digits) <= 15:
+    return None
+  return '+' + digits
+
+
+def IdentityKey(school, email_addresses, phone_numbers):
+  """The Person key for the first usable email, else phone, in school.
+
+  Args:
+    school: (ndb.Key) The School.
+    email_addresses: (list) As given, in order of preference.
+    phone_numbers: (list) As given, in order of preference.
+  Returns:
+    ndb.Key: The Person key, None when there is nothing to key on.
+  """
+  identity = None
+  for email in email_addresses:
+    if NormalizeEmail(email):
+      identity = 'mailto:' + NormalizeEmail(email)
+      break
+  else:
+    for phone in phone_numbers:
+      if NormalizePhone(phone):
+        identity = 'tel:' + NormalizePhone(phone)
+        break
+  if not identity:
+    return None
+  return ndb.Key(Person, '%s/%s/%s' % (
+    school.parent().id(), school.id(), identity))
+
+
+def _ContactKeys(school, person):
+  """The IdentityKey of each email and phone of person, a PersonMessage."""
+  keys = [IdentityKey(school, [e], []) for e in person.email_addresses]
+  keys += [IdentityKey(school, [], [p]) for p in person.phone_numbers]
+  return set(k for k in keys if k)
+
+
+def FamilyIdentityKeys(school, people):
+  """The IdentityKey of each of people, the members of one family.
+
+  Family members may share an email or phone, e.g. a child listed with a
+  parent's phone. A member is only keyed on an email or phone no other
+  member listed before it, or that has an id, has; the others become
+  Persons of their own. Persons are only merged across families.
+
+  Args:
+    school: (ndb.Key) The School.
+    people: (list) The members' PersonMessages.
+  Returns:
+    list: The ndb.Key, or None, of each of people; None for those with
+      an id.
+  """
+  taken = set()
+  for person in people:
+    if person.id:
+      taken.add(KeyFromId(person.id, Person))
+      taken |= _ContactKeys(school, person)
+  keys = []
+  for person in people:
+    key = None
+    if not person.id:
+      key = IdentityKey(school, person.email_addresses, person.phone_numbers)
+      if key in taken:
+        key = None
+      taken |= _ContactKeys(school, person)
+    keys.append(key)
+  return keys
+
+
+def KeyFromId(urlsafe, model=None):
+  """The key of an id sent by a client.
+
+  Args:
+    urlsafe: (str) The id.
+    model: (class) When given, the ndb.Model the key must be of.
+  Raises:
+    ValueError: When urlsafe isn't a key, or isn't one of model.
+  """
+  try:
+    key = ndb.Key(urlsafe=urlsafe)
+  except Exception:  # Malformed urlsafe keys raise a grab bag of errors.
+    raise ValueError('Invalid id: %s' % (urlsafe))
+  if model and key.kind() != model._get_kind():
+    raise ValueError('Invalid id: %s' % (urlsafe))
+  return key
 
 
-# TODO(renwick): Build the SchoolUser functionality.
 class PersonMessage(messages.Message):
   id = messages.StringField(1)
   first_name = messages.StringField(3)
@@ -204,6 +653,20 @@ class PersonMessage(messages.Message):
   addresses = messages.StringField(7, repeated=True)
 
 
+class PersonCollectionMessage(messages.Message):
+  """Used when searching persons."""
+  items = messages.MessageField(PersonMessage, 1, repeated=True)
+  next_page_token = messages.StringField(2)
+
+
+def PersonCollectionMessageFromPerson(objs, next_page_token=None):
+  container = []
+  for o in objs:
+    container.append(Person.ToMessage(o))
+  return PersonCollectionMessage(items=container,
+                                 next_page_token=next_page_token)
+
+
 class Person(ndb.Model):
   """The database entry."""
   first_name = ndb.StringProperty()
@@ -212,6 +675,11 @@ class Person(ndb.Model):
   email_addresses = ndb.StringProperty(repeated=True)
   addresses = ndb.StringProperty(repeated=True)
   created_by = ndb.UserProperty(auto_current_user_add=True)
+  # Schools of the Records that list this person, scopes search.
+  schools = ndb.KeyProperty(School, repeated=True)
+  search_tokens = ndb.ComputedProperty(SearchTokens, repeated=True)
+  # Drives record/changes, see sync.py.
+  updated = ndb.DateTimeProperty(auto_now=True)
 
   @classmethod
   def ToMessage(cls, obj):
@@ -224,15 +692,88 @@ class Person(ndb.Model):
       addresses=obj.addresses)
 
   @classmethod
-  def FromMessage(cls, msg):
+  def FromMessage(cls, msg, school=None, changed_people=None, identity=True):
+    return cls.FromMessageAsync(
+      msg, school=school, changed_people=changed_people,
+      identity=identity).get_result()
+
+  @classmethod
+  @ndb.tasklet
+  def FromMessageAsync(cls, msg, school=None, changed_people=None,
+                       identity=True):
+    """Creates or updates a Person.
+
+    Args:
+      msg: (PersonMessage) The person.
+      school: (ndb.Key) The School listing the person.
+      changed_people: (list) When given, gets the key of an existing Person
+        whose PersonSummary changed, for person_fanout.EnqueueRefresh once
+        the write has committed.
+      identity: (bool) False doesn't key a new Person on its email or
+        phone, see FamilyIdentityKeys.
+    """
     oauth.ValidateUser(None, None)
     changed = False
     person = None
+    key = None
+    if not msg.id and school and identity:
+      key = IdentityKey(school, msg.email_addresses, msg.phone_numbers)
+    if school:
+      CheckSchoolAccess(school)
     if msg.id:
-      person = ndb.Key(urlsafe=msg.id).get()
+      person = yield KeyFromId(msg.id, Person).get_async()
+      if not person:
+        raise ValueError('No such person: %s' % (msg.id))
+      # Access to school is not enough: it would let a member pull anyone
+      # in, and read them back, by id.
+      if person.schools and not any(HasSchoolAccess(s)
+                                    for s in person.schools):
+        raise endpoints.ForbiddenException('No access to this person.')
+    elif key:
+      # A get, not a query: strongly consistent, so a resubmitted family
+      # finds the Persons its first submission wrote.
+      person = yield key.get_async()
+    before = None
+    if person:
+      before = PersonSummary.FromPerson(person)
     else:
-      person = Person()
+      person = Person(key=key)
+      changed = True
+    changed = cls.ApplyMessage(person, msg) or changed
+    if (changed_people is not None and before and
+        before != PersonSummary.FromPerson(person)):
+      changed_people.append(person.key)
+    if school and school not in person.schools:
       changed = True
+      person.schools.append(school)
+    # User's cannot make themselves super users.
+    if changed:
+      yield person.put_async()
+    raise ndb.Return(person)
+
+  @classmethod
+  def EntityGroup(cls, msg, school=None, identity=True):
+    """The entity group FromMessage(msg, school, identity=identity) writes,
+    see txn.Run.
+
+    Returns:
+      A root key, or for a new Person without an identity a placeholder
+      that no other entity group equals.
+    """
+    if msg.id:
+      return KeyFromId(msg.id, Person).root()
+    key = school and identity and IdentityKey(school, msg.email_addresses,
+                                              msg.phone_numbers)
+    return key or ('new', id(msg))
+
+  @classmethod
+  def ApplyMessage(cls, person, msg):
+    """Copies the fields set in msg onto person, without writing it.
+
+    Returns:
+      bool: Whether person changed.
+    """
+    changed = False
     if msg.first_name and person.first_name != msg.first_name:
       changed = True
       person.first_name = msg.first_name
@@ -248,10 +789,67 @@ class Person(ndb.Model):
     if msg.addresses and person.addresses != msg.addresses:
       changed = True
       person.addresses = msg.addresses
-    # User's cannot make themselves super users.
-    if changed:
-      person.put()
-    return person
+    return changed
+
+  @classmethod
+  def Search(cls, school, query):
+    """Persons of school matching every term of query as a prefix.
+
+    Each term is an equality filter on search_tokens, which the datastore
+    merges from the built-in indexes. Terms longer than MAX_PREFIX_LENGTH
+    match on their indexed prefix, see Matches.
+
+    Args:
+      school: (ndb.Key) The School to search in.
+      query: (str) What the user has typed so far.
+    Returns:
+      ndb.Query: The matches, None when query has no terms.
+    """
+    terms = SearchTerms(query)
+    if not terms:
+      return None
+    q = cls.query(cls.schools == school)
+    for term in terms:
+      q = q.filter(cls.search_tokens == term[:MAX_PREFIX_LENGTH])
+    return q
+
+  @classmethod
+  def Matches(cls, obj, query):
+    """Whether obj matches query beyond the indexed prefix lengths."""
+    fields = [w for n in (obj.first_name, obj.last_name)
+              for w in _WORD_RE.findall((n or '').lower())]
+    fields += [e.strip().lower() for e in obj.email_addresses]
+    fields += [_PhoneDigits(p) for p in obj.phone_numbers]
+    return all(any(f.startswith(t) for f in fields)
+               for t in SearchTerms(query))
+
+
+class PersonSummary(ndb.Model):
+  """The read-optimized copy of a Person that Records embed."""
+  person = ndb.KeyProperty(Person, required=True)
+  first_name = ndb.StringProperty(indexed=False)
+  last_name = ndb.StringProperty(indexed=False)
+  phone = ndb.StringProperty(indexed=False)
+  email = ndb.StringProperty(indexed=False)
+
+  @classmethod
+  def FromPerson(cls, person):
+    """The summary of person: names, first phone and first email."""
+    return cls(person=person.key,
+               first_name=person.first_name,
+               last_name=person.last_name,
+               phone=person.phone_numbers[0] if person.phone_numbers else None,
+               email=(person.email_addresses[0]
+                      if person.email_addresses else None))
+
+  @classmethod
+  def ToMessage(cls, obj):
+    return PersonMessage(
+      id=obj.person.urlsafe(),
+      first_name=obj.first_name,
+      last_name=obj.last_name,
+      phone_numbers=[obj.phone] if obj.phone else [],
+      email_addresses=[obj.email] if obj.email else [])
 
 
 class RecordMessage(messages.Message):
@@ -259,23 +857,73 @@ class RecordMessage(messages.Message):
   school = messages.MessageField(SchoolMessage, 2, required=True)
   parents = messages.MessageField(PersonMessage, 3, repeated=True)
   children = messages.MessageField(PersonMessage, 4, repeated=True)
+  num_parents = messages.IntegerField(5)
+  num_children = messages.IntegerField(6)
 
 
 class RecordCollectionMessage(messages.Message):
   """Used when listing all districts."""
   items = messages.MessageField(RecordMessage, 1, repeated=True)
+  next_page_token = messages.StringField(2)
+  # Send it back as If-None-Match to get not_modified if nothing changed.
+  etag = messages.StringField(3)
+  # The If-None-Match sent is still current: only etag is set.
+  not_modified = messages.BooleanField(4)
 
 
-def RecordCollectionMessageFromRecord(objs):
+class RecordChangesMessage(messages.Message):
+  """What changed in a school since a sync token, see sync.py."""
+  records = messages.MessageField(RecordMessage, 1, repeated=True)
+  people = messages.MessageField(PersonMessage, 2, repeated=True)
+  deleted_records = messages.StringField(3, repeated=True)
+  sync_token = messages.StringField(4)
+  # More changes are waiting: sync again with sync_token right away.
+  more = messages.BooleanField(5)
+
+
+def RecordCollectionMessageFromSnapshots(objs, next_page_token=None):
+  """Builds items from the PersonSummary snapshots the Records embed.
+
+  Records written before snapshots existed have their Persons resolved,
+  all of them in one batched get.
+  """
+  objs = list(objs)
+  people = Record.ResolvePeople([o for o in objs if not Record.HasSnapshots(o)])
   container = []
   for o in objs:
-    container.append(Record.ToMessage(o))
-  return RecordCollectionMessage(items=container)
+    if Record.HasSnapshots(o):
+      container.append(Record.SnapshotToMessage(o))
+    else:
+      container.append(Record.ToMessage(o, people=people))
+  return RecordCollectionMessage(items=container,
+                                 next_page_token=next_page_token)
 
 
-class RecordCollectionMessage(messages.Message):
-  """Used when listing all districts."""
-  items = messages.MessageField(RecordMessage, 1, repeated=True)
+def RecordCollectionMessageFromRecord(objs, next_page_token=None):
+  # Resolve every Person on the page in one batched get, not one per key.
+  objs = list(objs)
+  people = Record.ResolvePeople(objs)
+  container = []
+  for o in objs:
+    container.append(Record.ToMessage(o, people=people))
+  return RecordCollectionMessage(items=container,
+                                 next_page_token=next_page_token)
+
+
+def RecordCollectionMessageFromSummaries(objs, school, next_page_token=None):
+  """Builds compact items from a Record.SUMMARY_PROJECTION query."""
+  container = []
+  for o in objs:
+    container.append(Record.SummaryToMessage(o, school))
+  return RecordCollectionMessage(items=container,
+                                 next_page_token=next_page_token)
+
+
+def RecordCollectionMessageFromKeys(keys, school, next_page_token=None):
+  """Builds id and school only items from a keys-only query."""
+  return RecordCollectionMessage(
+    items=[Record.KeyToMessage(k, school) for k in keys],
+    next_page_token=next_page_token)
 
 
 class Record(ndb.Model):
@@ -283,49 +931,293 @@ class Record(ndb.Model):
   parents = ndb.KeyProperty(Person, repeated=True)
   children = ndb.KeyProperty(Person, repeated=True)
   created_by = ndb.UserProperty(auto_current_user_add=True)
+  # Stored so summaries can be served by a projection query, which
+  # needs the composite index in index.yaml.
+  num_parents = ndb.ComputedProperty(lambda self: len(self.parents))
+  num_children = ndb.ComputedProperty(lambda self: len(self.children))
+  # Snapshots of parents and children, in the same order, so a list can be
+  # served without reading the Persons. person_fanout refreshes them when
+  # a Person changes.
+  parent_summaries = ndb.LocalStructuredProperty(PersonSummary, repeated=True)
+  child_summaries = ndb.LocalStructuredProperty(PersonSummary, repeated=True)
+  # Drives record/changes, see sync.py.
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+  SUMMARY_PROJECTION = ('num_parents', 'num_children')
 
   @classmethod
-  def ToMessage(cls, obj):
-    msg = RecordMessage(id=obj.key.urlsafe(), school=School.ToMessage(obj.school))
-    parents = []
-    for parent in obj.parents:
-      parents.append(Person.ToMessage(parent))
-    msg.parents = parents
-    children = []
-    for child in obj.children:
-      children.append(Person.ToMessage(child))
-    msg.children = children
+  def ToMessage(cls, obj, people=None):
+    """Converts a Record, looking up Persons in people when given.
+
+    Args:
+      obj: (Record) The record to convert.
+      people: (dict) Person key -> Person, as built by ResolvePeople. When
+        None, the record's own Persons are fetched in one batch.
+    Returns:
+      RecordMessage: The message.
+    """
+    if people is None:
+      people = cls.ResolvePeople([obj])
+    msg = RecordMessage(id=obj.key.urlsafe(),
+                        school=School.KeyToMessage(obj.school),
+                        num_parents=len(obj.parents),
+                        num_children=len(obj.children))
+    msg.parents = cls._PersonMessages(obj.parents, people)
+    msg.children = cls._PersonMessages(obj.children, people)
     return msg
 
   @classmethod
-  def FromMessage(cls, msg):
-    oauth.ValidateUser(None, None)
+  def KeyToMessage(cls, key, school):
+    """The RecordMessage of key in school with only id and school set."""
+    return RecordMessage(id=key.urlsafe(), school=School.KeyToMessage(school))
+
+  @classmethod
+  def SummaryToMessage(cls, obj, school):
+    """Converts a projected Record, without its Persons.
+
+    Args:
+      obj: (Record) Projected on SUMMARY_PROJECTION.
+      school: (ndb.Key) The School the query was filtered on, since a
+        projection cannot return a property it filters on by equality.
+    Returns:
+      RecordMessage: Only id, school and the head-counts are set.
+    """
+    return RecordMessage(id=obj.key.urlsafe(),
+                         school=School.KeyToMessage(school),
+                         num_parents=obj.num_parents,
+                         num_children=obj.num_children)
+
+  @classmethod
+  def HasSnapshots(cls, obj):
+    """Whether obj's PersonSummary snapshots cover its parents and children."""
+    return ([s.person for s in obj.parent_summaries] == obj.parents and
+            [s.person for s in obj.child_summaries] == obj.children)
+
+  @classmethod
+  def SnapshotToMessage(cls, obj):
+    """Converts a Record from its snapshots, without reading any Person.
+
+    Returns:
+      RecordMessage: Persons carry names, one phone and one email.
+    """
+    return RecordMessage(
+      id=obj.key.urlsafe(),
+      school=School.KeyToMessage(obj.school),
+      parents=[PersonSummary.ToMessage(s) for s in obj.parent_summaries],
+      children=[PersonSummary.ToMessage(s) for s in obj.child_summaries],
+      num_parents=len(obj.parents),
+      num_children=len(obj.children))
+
+  @classmethod
+  def SetPeople(cls, obj, parents, children):
+    """Points obj at parents and children and snapshots them.
+
+    Args:
+      obj: (Record) The record to change, not written.
+      parents: (list) Persons.
+      children: (list) Persons.
+    Returns:
+      bool: Whether obj changed.
+    """
+    parent_summaries = [PersonSummary.FromPerson(p) for p in parents]
+    child_summaries = [PersonSummary.FromPerson(c) for c in children]
+    if (parent_summaries == obj.parent_summaries and
+        child_summaries == obj.child_summaries):
+      return False
+    obj.parents = [p.key for p in parents]
+    obj.children = [c.key for c in children]
+    obj.parent_summaries = parent_summaries
+    obj.child_summaries = child_summaries
+    return True
+
+  @classmethod
+  def RefreshSnapshot(cls, obj, person):
+    """Replaces obj's snapshots of person, without writing obj.
+
+    Returns:
+      bool: Whether obj changed.
+    """
+    summary = PersonSummary.FromPerson(person)
+    changed = False
+    for summaries in (obj.parent_summaries, obj.child_summaries):
+      for i, s in enumerate(summaries):
+        if s.person == person.key and s != summary:
+          summaries[i] = summary
+          changed = True
+    return changed
+
+  @classmethod
+  def ResolvePeople(cls, objs):
+    """Fetches every Person referenced by objs with a single multi-get.
+
+    Args:
+      objs: (list) Records.
+    Returns:
+      dict: Person key -> Person, missing entities are left out.
+    """
+    keys = []
+    seen = set()
+    for o in objs:
+      for key in o.parents + o.children:
+        if key not in seen:
+          seen.add(key)
+          keys.append(key)
+    return dict((k, v) for k, v in zip(keys, ndb.get_multi(keys)) if v)
+
+  @classmethod
+  def _PersonMessages(cls, keys, people):
+    container = []
+    for key in keys:
+      person = people.get(key)
+      if not person:
+        logging.warning('Record references a missing Person: %s', key)
+        continue
+      container.append(Person.ToMessage(person))
+    return container
+
+  @classmethod
+  def EntityGroups(cls, msg):
+    """The entity groups FromMessage(msg) writes, see txn.Run.
+
+    The School is read outside of the transaction, so it isn't one.
+
+    Returns:
+      set: Root keys, and placeholders for new entities without a key.
+    """
+    school = ndb.Key(District, msg.school.district, School, msg.school.name)
+    groups = set([KeyFromId(msg.id, Record).root() if msg.id
+                  else ('new', id(msg))])
+    people = msg.parents + msg.children
+    for person, key in zip(people, FamilyIdentityKeys(school, people)):
+      groups.add(Person.EntityGroup(person, school, identity=bool(key)))
+    groups |= stats.Groups(school)
     if msg.id:
-      record = ndb.Key(urlsafe=msg.id).get()
-    else:
-      record = Record(
-        school=School.FromMessage(msg.school).key,
-        parents=[Person.FromMessage(p).key for p in msg.parents],
-        children=[Person.FromMessage(p).key for p in msg.children])
-      record.puts()
-      return record
-    if msg.school != record.school:
-      record.school = msg.school
+      # Moving a record between schools adds the counter shards of the old
+      # one, which the message doesn't name: reserve them.
+      groups |= set(('moved from', msg.id, i)
+                    for i in xrange(len(stats.Groups(school))))
+    return groups
+
+  @classmethod
+  def FromMessage(cls, msg, changed_people=None, stat_deltas=None):
+    return cls.FromMessageAsync(
+      msg, changed_people=changed_people,
+      stat_deltas=stat_deltas).get_result()
+
+  @classmethod
+  @ndb.tasklet
+  def FromMessageAsync(cls, msg, changed_people=None, stat_deltas=None):
+    """Creates or updates a Record and its Persons.
+
+    The School and the Record are read together first, so nothing is
+    written for a bad one. Then every Person get and put is started before
+    any of them is waited on, so the write costs about two round trips.
+
+    Args:
+      msg: (RecordMessage) The record.
+      changed_people: (list) See Person.FromMessageAsync.
+      stat_deltas: (stats.Deltas) When given, gets the change to the
+        school counts, for the caller to apply once for all of its writes.
+        Otherwise they are applied here, in the caller's transaction.
+    """
+    oauth.ValidateUser(None, None)
+    school = ndb.Key(District, msg.school.district, School, msg.school.name)
+    record_future = KeyFromId(msg.id, Record).get_async() if msg.id else None
+    # Schools are never deleted, so reading it outside of the transaction
+    # is safe, and keeps its District's group out of every Record write.
+    school_future = ndb.non_transactional(School.FromMessageAsync)(msg.school)
+    yield school_future
+    record = (yield record_future) if record_future else None
+    if msg.id and not record:
+      raise ValueError('Record does not exist.')
+    if record and record.school != school:
+      CheckSchoolAccess(record.school)  # Moving it out needs access too.
+    identities = FamilyIdentityKeys(school, msg.parents + msg.children)
+    person_futures = [Person.FromMessageAsync(
+                        p, school=school, changed_people=changed_people,
+                        identity=bool(key))
+                      for p, key in zip(msg.parents + msg.children,
+                                        identities)]
+    parent_futures = person_futures[:len(msg.parents)]
+    child_futures = person_futures[len(msg.parents):]
+    parents = (yield parent_futures) if parent_futures else []
+    children = (yield child_futures) if child_futures else []
+    deltas = stats.Deltas() if stat_deltas is None else stat_deltas
+    if record:
+      deltas.Add(record.school, len(record.parents), len(record.children),
+                 sign=-1)
+    changed = False
+    if not record:
+      record = Record(school=school)
       changed = True
-    if msg.parents:
-      parents = [Person.FromMessage(p).key for p in msg.parents]
-      if parents != record.parents:
-        changed = True
-        record.parents = parents
-    if msg.children:
-      children = [Person.FromMessage(p).key for p in msg.children]
-      if children != record.children:
-        changed = True
-        record.children = children
+    if school != record.school:
+      record.school = school
+      changed = True
+    # Persons left out of msg stay as they are, snapshots included.
+    if not parents and record.parents:
+      parents = yield ndb.get_multi_async(record.parents)
+    if not children and record.children:
+      children = yield ndb.get_multi_async(record.children)
+    if cls.SetPeople(record, [p for p in parents if p],
+                     [c for c in children if c]):
+      changed = True
+    deltas.Add(record.school, len(record.parents), len(record.children))
     if changed:
-      record.put()
-    return record
+      yield record.put_async()
+    if stat_deltas is None:
+      yield stats.ApplyAsync(deltas)
+    raise ndb.Return(record)
+
+  @classmethod
+  def Delete(cls, key):
+    """Deletes the Record key and leaves a Tombstone for record/changes.
+
+    The Tombstone is the Record's child, so the transaction spans the
+    Record's group and the two counter shards it decrements.
+
+    Returns:
+      ndb.Key: The School the Record was in.
+    Raises:
+      ValueError: When there is no such Record.
+    """
+    oauth.ValidateUser(None, None)
+    def _Delete():
+      record = key.get()
+      if not record:
+        raise ValueError('Record does not exist.')
+      CheckSchoolAccess(record.school)
+      Tombstone(parent=key, id=Tombstone.ID, school=record.school).put()
+      key.delete()
+      deltas = stats.Deltas()
+      deltas.Add(record.school, len(record.parents), len(record.children),
+                 sign=-1)
+      stats.ApplyAsync(deltas).get_result()
+      return record.school
+    # The Record's group, and a shard each of its School and District.
+    return txn.Run(_Delete, groups=3)
 
   @classmethod
   def All(cls, school):
+    """Records of school, a School key."""
     return cls.query(Record.school == school)
+
+  @classmethod
+  def ListPage(cls, school, page_size=None, page_token=None):
+    """A page of school's Records, fetched keys-first.
+
+    The keys-only query costs small ops only; the entities then come from
+    one get_multi, which ndb serves from memcache when it can.
+
+    Returns:
+      (list, str): The Records and the next page's token.
+    """
+    keys, next_page_token = paging.FetchPage(
+      cls.All(school), page_size, page_token, keys_only=True)
+    return [r for r in ndb.get_multi(keys) if r], next_page_token
+
+
+class Tombstone(ndb.Model):
+  """Marks a deleted Record for record/changes, a child of its key."""
+  ID = 'deleted'
+  school = ndb.KeyProperty(School, required=True)
+  deleted = ndb.DateTimeProperty(auto_now_add=True)
@@ -6,20 +6,12 @@ import unittest
 
 from google.appengine.ext import ndb
 from google.appengine.ext import testbed
-from google.appengine.datastore import datastore_stub_util
 
 import datamodel_lib
-
-
-def _SetUser(testbed, email, user_id):
-  testbed.setup_env(
-    USER_EMAIL=email, USER_ID=user_id, USER_IS_ADMIN='0',
-    ENDPOINTS_USE_OAUTH_SCOPE='0', ENDPOINTS_AUTH_EMAIL=email,
-    ENDPOINTS_AUTH_DOMAIN=email.split('@')[-1],
-    OAUTH_ERROR_CODE='', OAUTH_LAST_SCOPE='0',
-    AUTH_DOMAIN=email.split('@')[-1],
-    OAUTH_EMAIL=email, OAUTH_AUTH_DOMAIN=email.split('@')[-1],
-    OAUTH_USER_ID=user_id, overwrite=True)
+import oauth
+import paging
+import test_lib
+import txn
 
 
 class DistrictTest(unittest.TestCase):
@@ -32,11 +24,10 @@ class DistrictTest(unittest.TestCase):
     # Next, declare which service stubs you want to use.
     self.testbed.init_datastore_v3_stub()
     self.testbed.init_memcache_stub()
-    _SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
     self.testbed.init_user_stub()
     # Set admin for these tests.
-    datamodel_lib.User(email_addresses=['admin@parentd.com'],
-                       is_super_user=True).put()
+    test_lib.AddSuperUser()
 
   def tearDown(self):
     self.testbed.deactivate()
@@ -58,27 +49,81 @@ class DistrictTest(unittest.TestCase):
     for i, item in enumerate(col.items):
       self.assertEquals('domain-%s.org' % (i), item.domain)
 
+  def testDistrictCollectionPages(self):
+    for i in xrange(5):
+      datamodel_lib.District.FromMessage(
+        datamodel_lib.DistrictMessage(domain='domain-%s.org' % (i)))
+    domains = []
+    page_token = None
+    pages = 0
+    while True:
+      objs, page_token = paging.FetchPage(
+        datamodel_lib.District.All(), 2, page_token)
+      col = datamodel_lib.DistrictCollectionMessageFromDistrict(
+        objs, next_page_token=page_token)
+      domains.extend(item.domain for item in col.items)
+      pages += 1
+      if not col.next_page_token:
+        break
+    self.assertEquals(3, pages)
+    self.assertEquals(['domain-%s.org' % (i) for i in xrange(5)], domains)
+
+  def testListPageIsCached(self):
+    datamodel_lib.District.FromMessage(
+      datamodel_lib.DistrictMessage(domain='a.org'))
+    keys, _ = datamodel_lib.District.ListPage()
+    self.assertEquals(['a.org'], [k.id() for k in keys])
+    # Written behind the cache's back, so the cached page is still served.
+    datamodel_lib.District(id='b.org').put()
+    keys, _ = datamodel_lib.District.ListPage()
+    self.assertEquals(['a.org'], [k.id() for k in keys])
+    datamodel_lib.InvalidateListCache(datamodel_lib.District._get_kind())
+    keys, next_page_token = datamodel_lib.District.ListPage()
+    self.assertEquals(['a.org', 'b.org'], [k.id() for k in keys])
+    col = datamodel_lib.DistrictCollectionMessageFromKeys(
+      keys, next_page_token=next_page_token)
+    self.assertEquals(['a.org', 'b.org'], [i.domain for i in col.items])
+    self.assertEquals(None, col.next_page_token)
+    # Creating one drops the cached pages.
+    datamodel_lib.District.FromMessage(
+      datamodel_lib.DistrictMessage(domain='c.org'))
+    keys, _ = datamodel_lib.District.ListPage()
+    self.assertEquals(['a.org', 'b.org', 'c.org'], [k.id() for k in keys])
+
+  def testBadPageToken(self):
+    self.assertRaises(endpoints.BadRequestException, paging.FetchPage,
+                      datamodel_lib.District.All(), 2, 'not-a-cursor')
+
   def testNonSuperCannotCreate(self):
-    _SetUser(self.testbed, 'joe@parentd.com', '1234')
+    test_lib.SetUser(self.testbed, 'joe@parentd.com', '1234')
     msg = datamodel_lib.DistrictMessage(domain='domain.org')
     self.assertRaises(ValueError, datamodel_lib.District.FromMessage, msg)
 
+  def testPrincipalIsResolvedOncePerRequest(self):
+    calls = []
+    acl = datamodel_lib.User.__dict__['Acl']
+    def _CountingAcl(cls, *args, **kwargs):
+      calls.append(args)
+      return acl.__func__(cls, *args, **kwargs)
+    datamodel_lib.User.Acl = classmethod(_CountingAcl)
+    try:
+      with oauth.RequestPrincipal(datamodel_lib.User) as principal:
+        for i in xrange(3):
+          datamodel_lib.District.FromMessage(
+            datamodel_lib.DistrictMessage(domain='domain-%s.org' % (i)))
+        self.assertTrue(principal.is_super_user)
+        self.assertEquals('8888', principal.user_id)
+        self.assertEquals('admin@parentd.com', principal.email)
+    finally:
+      datamodel_lib.User.Acl = acl
+    self.assertEquals(1, len(calls))
+
 
 class SchoolTest(unittest.TestCase):
 
   def setUp(self):
-    # First, create an instance of the Testbed class.
-    self.testbed = testbed.Testbed()
-    # Then activate the testbed, which prepares the service stubs for use.
-    self.testbed.activate()
-    # Create a consistency policy that will simulate the High
-    # Replication consistency model.
-    self.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
-    # Initialize the datastore stub with this policy.
-    self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
-    self.testbed.init_memcache_stub()
-    _SetUser(self.testbed, 'joe@parentd.com', '1234')
-    self.testbed.init_user_stub()
+    self.testbed = test_lib.Activate()
+    test_lib.SetUser(self.testbed, 'joe@parentd.com', '1234')
     # Make joe admin for these tests.
     datamodel_lib.User(email_addresses=['joe@parentd.com'],
                        is_super_user=True).put()
@@ -96,35 +141,74 @@ class SchoolTest(unittest.TestCase):
     new_msg = datamodel_lib.School.ToMessage(ndb)
     self.assertEquals(new_msg, msg)
 
+  def testCreateDropsListCache(self):
+    datamodel_lib.School.FromMessage(
+      datamodel_lib.SchoolMessage(district='test.org', name='a'))
+    keys, _ = datamodel_lib.School.ListPage()
+    self.assertEquals(['a'], [k.id() for k in keys])
+    # Inside a transaction, the cache is dropped once it commits.
+    txn.Run(lambda: datamodel_lib.School.FromMessage(
+      datamodel_lib.SchoolMessage(district='test.org', name='b')))
+    keys, _ = datamodel_lib.School.ListPage()
+    self.assertEquals(['a', 'b'], [k.id() for k in keys])
+
   def testNonSuperCannotCreate(self):
-    _SetUser(self.testbed, 'sam@parentd.com', '5678')
+    test_lib.SetUser(self.testbed, 'sam@parentd.com', '5678')
+    msg = datamodel_lib.SchoolMessage(district='test.org', name='test')
+    self.assertRaises(ValueError, datamodel_lib.School.FromMessage, msg)
+
+  def _Member(self, email, role=None):
+    return datamodel_lib.SchoolMemberMessage(
+      district='test.org', school='test', email=email, role=role)
+
+  def testMembership(self):
     msg = datamodel_lib.SchoolMessage(district='test.org', name='test')
+    school = datamodel_lib.School.FromMessage(msg)
+    # Sam can't see it until joe adds him.
+    test_lib.SetUser(self.testbed, 'sam@parentd.com', '5678')
+    self.assertRaises(ValueError, datamodel_lib.School.FromMessage, msg)
+    test_lib.SetUser(self.testbed, 'joe@parentd.com', '1234')
+    datamodel_lib.SchoolUser.FromMessage(self._Member('Sam@parentd.com'))
+    test_lib.SetUser(self.testbed, 'sam@parentd.com', '5678')
+    self.assertEquals(school.key, datamodel_lib.School.FromMessage(msg).key)
+    # Members can't add members, managers can.
+    self.assertRaises(endpoints.ForbiddenException,
+                      datamodel_lib.SchoolUser.FromMessage,
+                      self._Member('kim@parentd.com'))
+    test_lib.SetUser(self.testbed, 'joe@parentd.com', '1234')
+    datamodel_lib.SchoolUser.FromMessage(
+      self._Member('sam@parentd.com', role='manager'))
+    test_lib.SetUser(self.testbed, 'sam@parentd.com', '5678')
+    datamodel_lib.SchoolUser.FromMessage(self._Member('kim@parentd.com'))
+    members, _ = datamodel_lib.SchoolUser.ListPage(school.key)
+    self.assertEquals(
+      [('kim@parentd.com', 'member'), ('sam@parentd.com', 'manager')],
+      [(m.email, m.role) for m in members])
+    # And removing him takes it away again.
+    test_lib.SetUser(self.testbed, 'joe@parentd.com', '1234')
+    datamodel_lib.SchoolUser.Remove(self._Member('sam@parentd.com'))
+    test_lib.SetUser(self.testbed, 'sam@parentd.com', '5678')
     self.assertRaises(ValueError, datamodel_lib.School.FromMessage, msg)
 
+  def testUnknownRole(self):
+    datamodel_lib.School.FromMessage(
+      datamodel_lib.SchoolMessage(district='test.org', name='test'))
+    self.assertRaises(ValueError, datamodel_lib.SchoolUser.FromMessage,
+                      self._Member('sam@parentd.com', role='owner'))
+
 
 class UserTest(unittest.TestCase):
 
   def setUp(self):
-    # First, create an instance of the Testbed class.
-    self.testbed = testbed.Testbed()
-    # Then activate the testbed, which prepares the service stubs for use.
-    self.testbed.activate()
-    # Create a consistency policy that will simulate the High
-    # Replication consistency model.
-    self.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
-    # Initialize the datastore stub with this policy.
-    self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
-    self.testbed.init_memcache_stub()
-    _SetUser(self.testbed, 'admin@parentd.com', '8888')
-    self.testbed.init_user_stub()
-    datamodel_lib.User(email_addresses=['admin@parentd.com'],
-                       is_super_user=True).put()
+    self.testbed = test_lib.Activate()
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.AddSuperUser()
 
   def tearDown(self):
     self.testbed.deactivate()
 
   def testToMessage(self):
-    _SetUser(self.testbed, 'joe@parentd.com', '1234')
+    test_lib.SetUser(self.testbed, 'joe@parentd.com', '1234')
     msg = datamodel_lib.UserMessage(email_addresses=['joe@parentd.com'])
     obj = datamodel_lib.User.FromMessage(msg)
     self.assertEquals(['joe@parentd.com'], obj.email_addresses)
@@ -136,11 +220,11 @@ class UserTest(unittest.TestCase):
 
   def testCheckAdminSuper(self):
     # Validate admin.
-    _SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
     admin = datamodel_lib.User.Find(email='admin@parentd.com')
     self.assertTrue(admin.is_super_user)
     # Create joe.
-    _SetUser(self.testbed, 'joe@parentd.com', '1234')
+    test_lib.SetUser(self.testbed, 'joe@parentd.com', '1234')
     msg = datamodel_lib.UserMessage(email_addresses=['joe@parentd.com'])
     joe = datamodel_lib.User.FromMessage(msg)
     self.assertEquals('1234', joe.created_by.user_id())
@@ -148,27 +232,21 @@ class UserTest(unittest.TestCase):
     self.assertRaises(endpoints.UnauthorizedException,
                       datamodel_lib.User.SetSuperUser, 'joe@parentd.com', True)
     # But admin can.
-    _SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
     datamodel_lib.User.SetSuperUser('joe@parentd.com', True)
     joe = datamodel_lib.User.Find(email='joe@parentd.com')
     self.assertTrue(joe.is_super_user)
+    # Joe's cached ACL went with the write.
+    test_lib.SetUser(self.testbed, 'joe@parentd.com', '1234')
+    self.assertTrue(oauth.IsSuperUser(datamodel_lib.User))
 
 
 class PersonTest(unittest.TestCase):
 
   def setUp(self):
-    # First, create an instance of the Testbed class.
-    self.testbed = testbed.Testbed()
-    # Then activate the testbed, which prepares the service stubs for use.
-    self.testbed.activate()
-    # Create a consistency policy that will simulate the High
-    # Replication consistency model.
-    self.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
-    # Initialize the datastore stub with this policy.
-    self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
-    self.testbed.init_memcache_stub()
-    _SetUser(self.testbed, 'admin@parentd.com', '8888')
-    self.testbed.init_user_stub()
+    self.testbed = test_lib.Activate()
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.AddSuperUser()
     self.super = datamodel_lib.Person(first_name='super', last_name='admin',
                                       email_addresses=['admin@parentd.com']).put()
 
@@ -193,6 +271,98 @@ class PersonTest(unittest.TestCase):
     self.assertEquals(['admin@parentd.com'], msg.email_addresses)
     self.assertEquals([], msg.phone_numbers)
 
+  def testSearch(self):
+    school = ndb.Key(datamodel_lib.District, 'test.org',
+                     datamodel_lib.School, 'test')
+    other = ndb.Key(datamodel_lib.District, 'test.org',
+                    datamodel_lib.School, 'other')
+    for first, last, email, phone, s in [
+        ('Ann', 'Smith', 'ann@example.com', '(555) 010-0100', school),
+        ('Andy', 'Smithers', 'andy@example.com', '555-010-0200', school),
+        ('Bob', 'Annis', 'bob@example.com', '555-999-0300', school),
+        ('Ann', 'Other', 'ann@other.com', '555-010-0100', other)]:
+      datamodel_lib.Person.FromMessage(
+        datamodel_lib.PersonMessage(
+          first_name=first, last_name=last, email_addresses=[email],
+          phone_numbers=[phone]), school=s)
+    def _Search(query):
+      q = datamodel_lib.Person.Search(school, query)
+      return sorted(p.first_name for p in q.fetch()
+                    if datamodel_lib.Person.Matches(p, query))
+    self.assertEquals(['Andy', 'Ann', 'Bob'], _Search('an'))
+    self.assertEquals(['Ann'], _Search('ann sm'))
+    self.assertEquals(['Andy', 'Ann'], _Search('SMITH'))
+    self.assertEquals(['Andy'], _Search('andy@ex'))
+    self.assertEquals(['Andy', 'Ann'], _Search('555-010'))
+    self.assertEquals(['Ann'], _Search('(555) 010-01'))
+    self.assertEquals([], _Search('ann@example.com.longer.than.the.index'))
+    self.assertEquals(None, datamodel_lib.Person.Search(school, '  '))
+
+  def testNormalize(self):
+    self.assertEquals('ann@example.com',
+                      datamodel_lib.NormalizeEmail(' Ann@Example.COM '))
+    self.assertEquals(None, datamodel_lib.NormalizeEmail('ann'))
+    for phone in ('(555) 010-0123', '555.010.0123', '1-555-010-0123',
+                  '+1 555 010 0123'):
+      self.assertEquals('+15550100123', datamodel_lib.NormalizePhone(phone))
+    self.assertEquals('+442071234567',
+                      datamodel_lib.NormalizePhone('+44 20 7123 4567'))
+    self.assertEquals(None, datamodel_lib.NormalizePhone('911'))
+
+  def testIdentityKeyDeduplicates(self):
+    school = ndb.Key(datamodel_lib.District, 'test.org',
+                     datamodel_lib.School, 'test')
+    first = datamodel_lib.Person.FromMessage(
+      datamodel_lib.PersonMessage(first_name='Ann',
+                                  email_addresses=['ann@example.com']),
+      school=school)
+    again = datamodel_lib.Person.FromMessage(
+      datamodel_lib.PersonMessage(first_name='Ann', last_name='Smith',
+                                  email_addresses=['ANN@example.com']),
+      school=school)
+    self.assertEquals(first.key, again.key)
+    self.assertEquals('Smith', first.key.get().last_name)
+    by_phone = datamodel_lib.Person.FromMessage(
+      datamodel_lib.PersonMessage(first_name='Bob',
+                                  phone_numbers=['555-010-0123']),
+      school=school)
+    self.assertEquals('test.org/test/tel:+15550100123', by_phone.key.id())
+    # No email or phone: nothing to key on.
+    self.assertEquals(None, datamodel_lib.Person.FromMessage(
+      datamodel_lib.PersonMessage(first_name='Cal'),
+      school=school).key.string_id())
+
+  def testUnknownId(self):
+    msg = datamodel_lib.PersonMessage(
+      id=ndb.Key(datamodel_lib.Person, 'gone').urlsafe(), first_name='x')
+    self.assertRaises(ValueError, datamodel_lib.Person.FromMessage, msg)
+
+  def testIdOfAnotherSchool(self):
+    datamodel_lib.District.FromMessage(
+      datamodel_lib.DistrictMessage(domain='test.org'))
+    school_a, school_b = [
+      datamodel_lib.School.FromMessage(datamodel_lib.SchoolMessage(
+        district='test.org', name=name)).key for name in ('a', 'b')]
+    datamodel_lib.SchoolUser.FromMessage(datamodel_lib.SchoolMemberMessage(
+      district='test.org', school='a', email='joe@parentd.com'))
+    ann = datamodel_lib.Person.FromMessage(
+      datamodel_lib.PersonMessage(first_name='Ann',
+                                  email_addresses=['ann@example.com']),
+      school=school_b)
+    test_lib.SetUser(self.testbed, 'joe@parentd.com', '1234')
+    msg = datamodel_lib.PersonMessage(id=ann.key.urlsafe(), first_name='x')
+    # Naming a school of his own doesn't let joe pull Ann into it.
+    for school in (school_a, None):
+      self.assertRaises(endpoints.ForbiddenException,
+                        datamodel_lib.Person.FromMessage, msg, school=school)
+    self.assertEquals('Ann', ann.key.get().first_name)
+    self.assertEquals([school_b], ann.key.get().schools)
+    # Ids of other kinds are no Person's.
+    msg.id = school_a.urlsafe()
+    self.assertRaises(ValueError, datamodel_lib.Person.FromMessage, msg,
+                      school=school_a)
+    self.assertRaises(ValueError, datamodel_lib.Person.EntityGroup, msg)
+
   def changedData(self):
     obj = self.super.get()
     self.assertTrue(obj.phone_numbers is None)
@@ -202,7 +372,215 @@ class PersonTest(unittest.TestCase):
     self.assertEquals(['987-678-9876'], obj.phone_numbers)
 
 
-# TODO(renwick): Record Testcase needed.
+class RecordTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = test_lib.Activate()
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.AddSuperUser()
+    self.school = ndb.Key(datamodel_lib.District, 'test.org',
+                          datamodel_lib.School, 'test')
+    datamodel_lib.District(id='test.org').put()
+    datamodel_lib.School(key=self.school).put()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testFromMessage(self):
+    msg = datamodel_lib.RecordMessage(
+      school=datamodel_lib.SchoolMessage(district='test.org', name='test'),
+      parents=[datamodel_lib.PersonMessage(first_name='mom'),
+               datamodel_lib.PersonMessage(first_name='dad')],
+      children=[datamodel_lib.PersonMessage(first_name='kid')])
+    record = datamodel_lib.Record.FromMessage(msg)
+    self.assertEquals(self.school, record.school)
+    parents = ndb.get_multi(record.parents)
+    self.assertEquals(['mom', 'dad'], [p.first_name for p in parents])
+    self.assertEquals([self.school], parents[0].schools)
+    # Update: add a second child, leave the parents alone.
+    msg = datamodel_lib.Record.ToMessage(record)
+    msg.parents = []
+    msg.children.append(datamodel_lib.PersonMessage(first_name='baby'))
+    updated = datamodel_lib.Record.FromMessage(msg)
+    self.assertEquals(record.key, updated.key)
+    self.assertEquals(record.parents, updated.parents)
+    self.assertEquals(['kid', 'baby'],
+                      [c.first_name for c in ndb.get_multi(updated.children)])
+
+  def testFamilySharingContactStaysApart(self):
+    school = datamodel_lib.SchoolMessage(district='test.org', name='test')
+    msg = datamodel_lib.RecordMessage(
+      school=school,
+      parents=[datamodel_lib.PersonMessage(
+                 first_name='mom', phone_numbers=['555-010-0123'],
+                 email_addresses=['family@example.com']),
+               datamodel_lib.PersonMessage(
+                 first_name='dad', email_addresses=['family@example.com'])],
+      children=[datamodel_lib.PersonMessage(
+        first_name='kid', phone_numbers=['555-010-0123'])])
+    record = datamodel_lib.Record.FromMessage(msg)
+    people = ndb.get_multi(record.parents + record.children)
+    self.assertEquals(['mom', 'dad', 'kid'], [p.first_name for p in people])
+    self.assertEquals(3, len(set(record.parents + record.children)))
+    self.assertEquals('test.org/test/mailto:family@example.com',
+                      record.parents[0].id())
+    # Resubmitted with ids, the kid still doesn't fold into mom.
+    msg = datamodel_lib.Record.ToMessage(record)
+    msg.children = [datamodel_lib.PersonMessage(
+      first_name='baby', email_addresses=['family@example.com'])]
+    updated = datamodel_lib.Record.FromMessage(msg)
+    self.assertEquals(3, len(set(updated.parents + updated.children)))
+    # Another family with the same email is merged with mom.
+    other = datamodel_lib.Record.FromMessage(datamodel_lib.RecordMessage(
+      school=school, parents=[datamodel_lib.PersonMessage(
+        first_name='mom', email_addresses=['family@example.com'])]))
+    self.assertEquals(record.parents[:1], other.parents)
+
+  def testEntityGroupsOfAnUpdate(self):
+    msg = datamodel_lib.RecordMessage(
+      school=datamodel_lib.SchoolMessage(district='test.org', name='test'),
+      parents=[datamodel_lib.PersonMessage(first_name='mom')])
+    created = len(datamodel_lib.Record.EntityGroups(msg))
+    msg.id = datamodel_lib.Record.FromMessage(msg).key.urlsafe()
+    # The Record's own group stands in for the placeholder; the counter
+    # shards of a school it may leave come on top.
+    self.assertEquals(created + 2,
+                      len(datamodel_lib.Record.EntityGroups(msg)))
+
+  def testFromMessageBadSchool(self):
+    msg = datamodel_lib.RecordMessage(
+      school=datamodel_lib.SchoolMessage(district='nope.org', name='test'),
+      parents=[datamodel_lib.PersonMessage(first_name='mom')])
+    self.assertRaises(ValueError, datamodel_lib.Record.FromMessage, msg)
+    # Nothing was written for it.
+    self.assertEquals(0, datamodel_lib.Person.query().count())
+    # Nor for a Record that does not exist.
+    msg.school.district = 'test.org'
+    msg.id = ndb.Key(datamodel_lib.Record, 123).urlsafe()
+    self.assertRaises(ValueError, datamodel_lib.Record.FromMessage, msg)
+    self.assertEquals(0, datamodel_lib.Person.query().count())
+
+  def _MakeRecord(self, family):
+    parent = datamodel_lib.Person(first_name='parent', last_name=family).put()
+    child = datamodel_lib.Person(first_name='child', last_name=family).put()
+    return datamodel_lib.Record(school=self.school, parents=[parent],
+                                children=[child]).put().get()
+
+  def testToMessage(self):
+    record = self._MakeRecord('smith')
+    msg = datamodel_lib.Record.ToMessage(record)
+    self.assertEquals(record.key.urlsafe(), msg.id)
+    self.assertEquals('test.org', msg.school.district)
+    self.assertEquals('test', msg.school.name)
+    self.assertEquals(['parent'], [p.first_name for p in msg.parents])
+    self.assertEquals(['child'], [c.first_name for c in msg.children])
+
+  def testCollectionResolvesPeopleInOneBatch(self):
+    records = [self._MakeRecord('family-%s' % (i)) for i in xrange(5)]
+    calls = []
+    get_multi = ndb.get_multi
+    def _CountingGetMulti(keys, **kwargs):
+      calls.append(len(keys))
+      return get_multi(keys, **kwargs)
+    ndb.get_multi = _CountingGetMulti
+    try:
+      col = datamodel_lib.RecordCollectionMessageFromRecord(records)
+    finally:
+      ndb.get_multi = get_multi
+    self.assertEquals([10], calls)
+    self.assertEquals(5, len(col.items))
+    for i, item in enumerate(col.items):
+      self.assertEquals('family-%s' % (i), item.parents[0].last_name)
+      self.assertEquals('family-%s' % (i), item.children[0].last_name)
+
+  def testSummaries(self):
+    self._MakeRecord('smith')
+    self._MakeRecord('jones')
+    objs = datamodel_lib.Record.All(self.school).fetch(
+      projection=datamodel_lib.Record.SUMMARY_PROJECTION)
+    col = datamodel_lib.RecordCollectionMessageFromSummaries(objs, self.school)
+    self.assertEquals(2, len(col.items))
+    for item in col.items:
+      self.assertEquals('test', item.school.name)
+      self.assertEquals(1, item.num_parents)
+      self.assertEquals(1, item.num_children)
+      self.assertEquals([], item.parents)
+
+  def testListPage(self):
+    for i in xrange(3):
+      self._MakeRecord('family-%s' % (i))
+    other = ndb.Key(datamodel_lib.District, 'test.org',
+                    datamodel_lib.School, 'other')
+    datamodel_lib.Record(school=other).put()
+    records, page_token = datamodel_lib.Record.ListPage(self.school, 2)
+    self.assertEquals(2, len(records))
+    more, page_token = datamodel_lib.Record.ListPage(
+      self.school, 2, page_token)
+    self.assertEquals(1, len(more))
+    self.assertEquals(None, page_token)
+    self.assertTrue(all(r.school == self.school for r in records + more))
+
+  def testMissingPersonIsSkipped(self):
+    record = self._MakeRecord('jones')
+    record.parents[0].delete()
+    msg = datamodel_lib.Record.ToMessage(record)
+    self.assertEquals([], msg.parents)
+    self.assertEquals(1, len(msg.children))
+
+  def testSchoolEtag(self):
+    etag = datamodel_lib.SchoolEtag(self.school, 'full', None, None)
+    self.assertEquals(
+      etag, datamodel_lib.SchoolEtag(self.school, 'full', None, None))
+    self.assertNotEquals(
+      etag, datamodel_lib.SchoolEtag(self.school, 'summary', None, None))
+    other = ndb.Key(datamodel_lib.District, 'test.org',
+                    datamodel_lib.School, 'other')
+    datamodel_lib.BumpSchoolVersion(other)
+    self.assertEquals(
+      etag, datamodel_lib.SchoolEtag(self.school, 'full', None, None))
+    datamodel_lib.BumpSchoolVersion(self.school)
+    self.assertNotEquals(
+      etag, datamodel_lib.SchoolEtag(self.school, 'full', None, None))
+    kind = datamodel_lib.District._get_kind()
+    etag = datamodel_lib.ListEtag(kind, None, None)
+    datamodel_lib.InvalidateListCache(kind)
+    self.assertNotEquals(etag, datamodel_lib.ListEtag(kind, None, None))
+
+  def testSnapshots(self):
+    record = datamodel_lib.Record.FromMessage(datamodel_lib.RecordMessage(
+      school=datamodel_lib.SchoolMessage(district='test.org', name='test'),
+      parents=[datamodel_lib.PersonMessage(
+        first_name='mom', last_name='smith',
+        phone_numbers=['555-0100', '555-0199'],
+        email_addresses=['mom@example.com'])],
+      children=[datamodel_lib.PersonMessage(first_name='kid')]))
+    self.assertTrue(datamodel_lib.Record.HasSnapshots(record))
+    self.assertEquals('mom', record.parent_summaries[0].first_name)
+    self.assertEquals('555-0100', record.parent_summaries[0].phone)
+    # Written before snapshots: its Persons are resolved instead.
+    old = self._MakeRecord('jones')
+    self.assertFalse(datamodel_lib.Record.HasSnapshots(old))
+    col = datamodel_lib.RecordCollectionMessageFromSnapshots(
+      [record.key.get(), old])
+    mom = col.items[0].parents[0]
+    self.assertEquals(record.parents[0].urlsafe(), mom.id)
+    self.assertEquals(['555-0100'], mom.phone_numbers)
+    self.assertEquals(['mom@example.com'], mom.email_addresses)
+    self.assertEquals('kid', col.items[0].children[0].first_name)
+    self.assertEquals('jones', col.items[1].parents[0].last_name)
+
+  def testChangedPeople(self):
+    msg = datamodel_lib.RecordMessage(
+      school=datamodel_lib.SchoolMessage(district='test.org', name='test'),
+      parents=[datamodel_lib.PersonMessage(
+        first_name='mom', email_addresses=['mom@example.com'])])
+    changed = []
+    datamodel_lib.Record.FromMessage(msg, changed_people=changed)
+    self.assertEquals([], changed)  # New Persons have no snapshots yet.
+    msg.parents[0].last_name = 'smith'
+    record = datamodel_lib.Record.FromMessage(msg, changed_people=changed)
+    self.assertEquals(record.parents, changed)
+    self.assertEquals('smith', record.parent_summaries[0].last_name)
 
 
 if __name__ == '__main__':
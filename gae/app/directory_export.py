@@ -0,0 +1,300 @@
+# Description:
+#   Export of a school's directory to a blobstore file through the task
+#   queue.
+#
+#   Each task reads one batch of Records with a cursor, resolves their
+#   Persons with one get_multi, formats them as CSV, vCard or JSONL and
+#   appends the result to an unfinalized Files API file, so memory stays
+#   bounded by the batch whatever the size of the school. The last task
+#   finalizes the file and the job's blob becomes downloadable from
+#   /export/download/<job_id>.
+#
+#   Appends carry the batch number as their sequence_key, which the Files
+#   API refuses to go back on: a retried task cannot write its rows twice.
+
+import cStringIO
+import csv
+import endpoints
+import json
+import logging
+import urllib
+import webapp2
+
+from google.appengine.api import files
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from google.appengine.ext.webapp import blobstore_handlers
+from protorpc import messages
+
+import datamodel_lib
+import oauth
+import roster_import
+
+
+QUEUE_NAME = 'directory-export'
+BATCH_URL = '/tasks/export/batch'
+DOWNLOAD_URL = '/export/download/%s'
+BATCH_SIZE = 200  # Records per task.
+
+# Format -> (mime type, file extension).
+FORMATS = {
+  'csv': ('text/csv', 'csv'),
+  'vcard': ('text/vcard', 'vcf'),
+  'jsonl': ('application/x-ndjson', 'jsonl'),
+}
+# The roster_import columns, so an export can be imported again. The
+# family column holds the Record id.
+CSV_COLUMNS = roster_import.CSV_COLUMNS
+
+
+class ExportError(ValueError):
+  """An export that cannot be started."""
+
+
+class ExportStatusMessage(messages.Message):
+  job_id = messages.StringField(1)
+  state = messages.StringField(2)
+  format = messages.StringField(3)
+  records_done = messages.IntegerField(4)
+  # Set once the export is done.
+  download_url = messages.StringField(5)
+
+
+class ExportJob(ndb.Model):
+  """One export of a school's directory."""
+  school = ndb.KeyProperty(datamodel_lib.School, required=True)
+  format = ndb.StringProperty(choices=FORMATS.keys())
+  state = ndb.StringProperty(default='running')  # running -> done.
+  filename = ndb.StringProperty(indexed=False)  # The Files API file.
+  blob_key = ndb.BlobKeyProperty()
+  batches_done = ndb.IntegerProperty(default=0)
+  records_done = ndb.IntegerProperty(default=0)
+  created_by = ndb.UserProperty(auto_current_user_add=True)
+  created = ndb.DateTimeProperty(auto_now_add=True)
+
+  @classmethod
+  def ToMessage(cls, obj):
+    msg = ExportStatusMessage(job_id=obj.key.urlsafe(), state=obj.state,
+                              format=obj.format,
+                              records_done=obj.records_done)
+    if obj.state == 'done':
+      msg.download_url = DOWNLOAD_URL % (obj.key.urlsafe())
+    return msg
+
+
+def _PersonDict(person):
+  d = {}
+  for field in CSV_COLUMNS[2:]:
+    value = getattr(person, field)
+    if value:
+      d[field] = value
+  return d
+
+
+def _Utf8(value):
+  return (value or u'').encode('utf-8')
+
+
+def _FormatCsv(out, families, first):
+  writer = csv.writer(out)
+  if first:
+    writer.writerow(CSV_COLUMNS)
+  for record, members in families:
+    for role, person in members:
+      row = [str(record.key.id()), role]
+      for field in CSV_COLUMNS[2:]:
+        value = getattr(person, field)
+        if field in roster_import.REPEATED_FIELDS:
+          value = u';'.join(value)
+        row.append(_Utf8(value))
+      writer.writerow(row)
+
+
+def _VcardEscape(value):
+  value = (value or u'').replace('\\', '\\\\').replace('\n', '\\n')
+  return _Utf8(value.replace(',', '\\,').replace(';', '\\;'))
+
+
+def _FormatVcard(out, families, first):
+  for record, members in families:
+    for role, person in members:
+      out.write('BEGIN:VCARD\r\nVERSION:3.0\r\n')
+      out.write('N:%s;%s;;;\r\n' % (_VcardEscape(person.last_name),
+                                    _VcardEscape(person.first_name)))
+      name = u' '.join(n for n in (person.first_name, person.last_name) if n)
+      out.write('FN:%s\r\n' % (_VcardEscape(name)))
+      for phone in person.phone_numbers:
+        out.write('TEL:%s\r\n' % (_VcardEscape(phone)))
+      for email in person.email_addresses:
+        out.write('EMAIL:%s\r\n' % (_VcardEscape(email)))
+      for address in person.addresses:
+        out.write('ADR:;;%s;;;;\r\n' % (_VcardEscape(address)))
+      out.write('CATEGORIES:%s\r\nUID:%s\r\nEND:VCARD\r\n' % (
+        role, person.key.urlsafe()))
+
+
+def _FormatJsonl(out, families, first):
+  for record, members in families:
+    family = {'id': record.key.urlsafe(), 'parents': [], 'children': []}
+    for role, person in members:
+      family[roster_import.ROLES[role]].append(_PersonDict(person))
+    out.write(json.dumps(family, sort_keys=True))
+    out.write('\n')
+
+
+_FORMATTERS = {'csv': _FormatCsv, 'vcard': _FormatVcard,
+               'jsonl': _FormatJsonl}
+
+
+def _Families(records):
+  """Pairs each Record with its (role, Person) members, read in one batch."""
+  people = datamodel_lib.Record.ResolvePeople(records)
+  for record in records:
+    members = [('parent', people[k]) for k in record.parents if k in people]
+    members += [('child', people[k]) for k in record.children if k in people]
+    yield record, members
+
+
+def _Task(job, batch, cursor=None):
+  return taskqueue.Task(
+    url=BATCH_URL, name='export-%s-%d' % (job.key.id(), batch),
+    payload=json.dumps({'job': job.key.urlsafe(), 'batch': batch,
+                        'cursor': cursor}))
+
+
+def _Enqueue(task):
+  try:
+    taskqueue.Queue(QUEUE_NAME).add(task)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass  # Queued by an earlier attempt.
+
+
+def StartExport(school, fmt):
+  """Creates the export file and queues the first batch.
+
+  Args:
+    school: (School) The school to export.
+    fmt: (str) One of FORMATS.
+  Returns:
+    ExportJob: The job to poll with GetStatus.
+  Raises:
+    ExportError: When fmt is unknown.
+  """
+  if fmt not in FORMATS:
+    raise ExportError('Unknown export format: %s' % (fmt))
+  mime_type, extension = FORMATS[fmt]
+  job = ExportJob(school=school.key, format=fmt)
+  job.filename = files.blobstore.create(
+    mime_type=mime_type,
+    _blobinfo_uploaded_filename='%s-%s.%s' % (
+      school.key.parent().id(), school.key.id(), extension))
+  job.put()
+  _Enqueue(_Task(job, 0))
+  logging.info('Started export %s of %s', job.key.id(), school.key)
+  return job
+
+
+def ExportBatch(payload):
+  """Appends one batch of Records to the job's file.
+
+  Args:
+    payload: (dict) As queued by StartExport or the previous batch.
+  Returns:
+    int: The number of Records appended.
+  """
+  job = ndb.Key(urlsafe=payload['job']).get()
+  batch = payload['batch']
+  if not job or job.state != 'running' or job.batches_done > batch:
+    return 0  # Done by an earlier attempt.
+  start = Cursor(urlsafe=payload['cursor']) if payload['cursor'] else None
+  records, cursor, more = datamodel_lib.Record.All(job.school).fetch_page(
+    BATCH_SIZE, start_cursor=start)
+  out = cStringIO.StringIO()
+  _FORMATTERS[job.format](out, _Families(records), batch == 0)
+  data = out.getvalue()
+  if data:
+    try:
+      with files.open(job.filename, 'a') as f:
+        f.write(data, sequence_key='%010d' % (batch))
+    except files.SequenceKeyOutOfOrderError:
+      logging.info('Batch %d of export %s was already written',
+                   batch, job.key.id())
+    except files.FinalizationError:
+      pass  # Finalized by an attempt that failed before job.put().
+  job.batches_done = batch + 1
+  job.records_done += len(records)
+  if more and cursor:
+    job.put()
+    _Enqueue(_Task(job, batch + 1, cursor.urlsafe()))
+  else:
+    try:
+      files.finalize(job.filename)
+    except files.FinalizationError:
+      pass  # See above.
+    job.blob_key = files.blobstore.get_blob_key(job.filename)
+    job.state = 'done'
+    job.put()
+  return len(records)
+
+
+def GetJob(job_id):
+  """The ExportJob of job_id.
+
+  Raises:
+    endpoints.NotFoundException: When there is no such export.
+  """
+  try:
+    job = ndb.Key(urlsafe=job_id).get()
+  except Exception:  # Malformed urlsafe keys raise a grab bag of errors.
+    job = None
+  if not isinstance(job, ExportJob):
+    raise endpoints.NotFoundException('No such export.')
+  return job
+
+
+def GetStatus(job_id):
+  """Returns the ExportStatusMessage of job_id.
+
+  Raises:
+    endpoints.NotFoundException: When there is no such export.
+    endpoints.ForbiddenException: When the caller may not read its school.
+  """
+  job = GetJob(job_id)
+  datamodel_lib.CheckSchoolAccess(job.school)
+  return ExportJob.ToMessage(job)
+
+
+class ExportBatchHandler(webapp2.RequestHandler):
+  """Task queue worker for one batch."""
+
+  def post(self):
+    payload = json.loads(self.request.body)
+    logging.info('Exported %d records in batch %d',
+                 ExportBatch(payload), payload['batch'])
+
+
+class DownloadHandler(blobstore_handlers.BlobstoreDownloadHandler):
+  """GET /export/download/<job_id>: the finished file, to its creator."""
+
+  def get(self, job_id):
+    job_id = urllib.unquote(job_id)
+    try:
+      # Not an Endpoints request: authenticated by hand.
+      with oauth.RequestPrincipal(datamodel_lib.User,
+                                  oauth.GetRouteUser) as principal:
+        if not principal.user:
+          self.abort(401, headers={'WWW-Authenticate': 'Bearer'})
+        job = GetJob(job_id)
+        # Jobs of a request without a user have no creator.
+        creator = job.created_by and job.created_by.user_id()
+        allowed = (datamodel_lib.HasSchoolAccess(job.school) and
+                   (principal.is_super_user or
+                    bool(creator) and creator == principal.user_id))
+    except endpoints.NotFoundException:
+      self.abort(404)
+    if not allowed:
+      self.abort(403)
+    if job.state != 'done':
+      self.abort(404, detail='The export is not done yet.')
+    self.send_blob(job.blob_key, save_as=True)
@@ -0,0 +1,148 @@
+# Description:
+#   unittests for directory_export.py
+
+import endpoints
+import json
+import StringIO
+import unittest
+
+import webapp2
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import datamodel_lib
+import directory_export
+import main
+import roster_import
+import test_lib
+
+
+class DirectoryExportTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = test_lib.Activate(taskqueue=True)
+    self.testbed.init_blobstore_stub()
+    self.testbed.init_files_stub()
+    self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.AddSuperUser()
+    self.school = datamodel_lib.School(
+      id='test', parent=ndb.Key(datamodel_lib.District, 'test.org'))
+    self.school.put()
+    for name in ('smith', 'jones', 'lee'):
+      datamodel_lib.Record.FromMessage(datamodel_lib.RecordMessage(
+        school=datamodel_lib.SchoolMessage(district='test.org', name='test'),
+        parents=[datamodel_lib.PersonMessage(
+          first_name='Pat', last_name=name,
+          email_addresses=['pat@%s.com' % (name)],
+          phone_numbers=['555-0100', '555-0101'])],
+        children=[datamodel_lib.PersonMessage(
+          first_name='Kim', last_name=name)]))
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def _Export(self, fmt):
+    """Runs an export to the end and returns its file's contents."""
+    return blobstore.BlobReader(self._RunExport(fmt).blob_key).read()
+
+  def _RunExport(self, fmt):
+    """Runs an export to the end and returns its ExportJob."""
+    job = directory_export.StartExport(self.school, fmt)
+    while True:
+      tasks = self.taskqueue.get_filtered_tasks(
+        queue_names=[directory_export.QUEUE_NAME])
+      if not tasks:
+        break
+      self.taskqueue.FlushQueue(directory_export.QUEUE_NAME)
+      for task in tasks:
+        directory_export.ExportBatch(json.loads(task.payload))
+    job = job.key.get()
+    self.assertEquals('done', job.state)
+    self.assertEquals(3, job.records_done)
+    status = directory_export.GetStatus(job.key.urlsafe())
+    self.assertEquals(directory_export.DOWNLOAD_URL % (job.key.urlsafe()),
+                      status.download_url)
+    return job
+
+  def testCsvCanBeImportedAgain(self):
+    data = self._Export('csv')
+    families = [f for _, f in roster_import.ParseRoster(
+      StringIO.StringIO(data), 'csv')]
+    self.assertEquals(3, len(families))
+    for family in families:
+      self.assertEquals(['555-0100', '555-0101'],
+                        family['parents'][0]['phone_numbers'])
+      self.assertEquals('Kim', family['children'][0]['first_name'])
+
+  def testVcard(self):
+    data = self._Export('vcard')
+    self.assertEquals(6, data.count('BEGIN:VCARD\r\n'))
+    self.assertTrue('FN:Pat smith\r\n' in data)
+    self.assertTrue('EMAIL:pat@smith.com\r\n' in data)
+    self.assertTrue('CATEGORIES:child\r\n' in data)
+
+  def testJsonlInBatches(self):
+    directory_export.BATCH_SIZE, batch_size = 1, directory_export.BATCH_SIZE
+    try:
+      data = self._Export('jsonl')
+    finally:
+      directory_export.BATCH_SIZE = batch_size
+    families = [json.loads(line) for line in data.splitlines()]
+    self.assertEquals(3, len(families))
+    self.assertEquals(
+      ['jones', 'lee', 'smith'],
+      sorted(f['parents'][0]['last_name'] for f in families))
+
+  def testRetriedBatchIsSkipped(self):
+    job = directory_export.StartExport(self.school, 'csv')
+    payload = json.loads(self.taskqueue.get_filtered_tasks(
+      queue_names=[directory_export.QUEUE_NAME])[0].payload)
+    self.assertEquals(3, directory_export.ExportBatch(payload))
+    self.assertEquals(0, directory_export.ExportBatch(payload))
+    self.assertEquals(3, job.key.get().records_done)
+
+  def testUnknownFormat(self):
+    self.assertRaises(directory_export.ExportError,
+                      directory_export.StartExport, self.school, 'pdf')
+
+  def testStatusNeedsSchoolAccess(self):
+    job = directory_export.StartExport(self.school, 'csv')
+    test_lib.SetUser(self.testbed, 'joe@parentd.com', '1234')
+    self.assertRaises(endpoints.ForbiddenException,
+                      directory_export.GetStatus, job.key.urlsafe())
+
+  def testDownloadHandler(self):
+    job = self._RunExport('csv')
+    url = directory_export.DOWNLOAD_URL % (job.key.urlsafe())
+    get = lambda: webapp2.Request.blank(url).get_response(main.app)
+    # Downloads are no Endpoints requests.
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888',
+                     endpoints=False)
+    response = get()
+    self.assertEquals(200, response.status_int)
+    self.assertEquals(str(job.blob_key),
+                      response.headers[blobstore.BLOB_KEY_HEADER])
+    test_lib.SetUser(self.testbed, 'joe@parentd.com', '1234',
+                     endpoints=False)
+    self.assertEquals(403, get().status_int)
+    test_lib.SetAnonymous(self.testbed)
+    self.assertEquals(401, get().status_int)
+
+  def testDownloadWithoutCreator(self):
+    job = self._RunExport('csv')
+    job.created_by = None
+    job.put()
+    url = directory_export.DOWNLOAD_URL % (job.key.urlsafe())
+    # A member who isn't the creator, nor a super user.
+    datamodel_lib.SchoolUser.FromMessage(datamodel_lib.SchoolMemberMessage(
+      district='test.org', school='test', email='joe@parentd.com'))
+    test_lib.SetUser(self.testbed, 'joe@parentd.com', '1234',
+                     endpoints=False)
+    response = webapp2.Request.blank(url).get_response(main.app)
+    self.assertEquals(403, response.status_int)
+
+
+if __name__ == '__main__':
+  unittest.main()
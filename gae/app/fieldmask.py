@@ -0,0 +1,98 @@
+# Description:
+#   Partial responses for the list endpoints.
+#
+#   fields= names the fields of each item to send, separated by commas,
+#   with dots into message fields: fields=id,parents.first_name keeps the
+#   id and the parents' first names of every item. Fields of the collection
+#   itself (next_page_token, etag) are always sent, and so are required
+#   fields, which a message cannot be sent without.
+
+import endpoints
+
+from protorpc import messages
+
+
+class FieldMask(object):
+  """The fields kept of one message type.
+
+  Attributes:
+    message_type: (class) The Message class the mask applies to.
+  """
+
+  def __init__(self, message_type):
+    self.message_type = message_type
+    # Field name -> the FieldMask of a message field, or None to keep it
+    # whole.
+    self._fields = {}
+
+  @classmethod
+  def Parse(cls, spec, message_type):
+    """Parses a fields= value.
+
+    Args:
+      spec: (str) Comma separated field paths, e.g. 'id,parents.first_name'.
+      message_type: (class) The item Message class the paths are into.
+    Returns:
+      FieldMask: The mask, None when spec is empty, which keeps everything.
+    Raises:
+      endpoints.BadRequestException: When a path names no field.
+    """
+    paths = [p.strip() for p in (spec or '').split(',') if p.strip()]
+    if not paths:
+      return None
+    mask = cls(message_type)
+    for path in paths:
+      mask._Add(path.split('.'), path)
+    return mask
+
+  def _Add(self, names, path):
+    try:
+      field = self.message_type.field_by_name(names[0])
+    except KeyError:
+      raise endpoints.BadRequestException('Unknown field: %s' % (path))
+    if len(names) == 1:
+      self._fields[field.name] = None
+      return
+    if not isinstance(field, messages.MessageField):
+      raise endpoints.BadRequestException('Not a message field: %s' % (path))
+    if field.name in self._fields and self._fields[field.name] is None:
+      return  # Kept whole already.
+    sub = self._fields.setdefault(field.name, FieldMask(field.message_type))
+    sub._Add(names[1:], path)
+
+  def Has(self, name):
+    """Whether the mask keeps any part of the field name."""
+    return name in self._fields
+
+  def Apply(self, msg):
+    """Clears the fields of msg, a message_type, that the mask drops.
+
+    Returns:
+      The trimmed msg.
+    """
+    for field in msg.all_fields():
+      if field.name not in self._fields:
+        if not field.required:
+          msg.reset(field.name)
+        continue
+      sub = self._fields[field.name]
+      value = msg.get_assigned_value(field.name)
+      if sub is None or value is None:
+        continue
+      for item in (value if field.repeated else [value]):
+        sub.Apply(item)
+    return msg
+
+
+def Parse(spec, message_type):
+  """FieldMask.Parse: the mask of a fields= value, None when it is empty."""
+  return FieldMask.Parse(spec, message_type)
+
+
+def Trim(mask, items):
+  """Applies mask, which may be None, to each of items. Returns items."""
+  if mask:
+    for item in items:
+      mask.Apply(item)
+  return items
+
@@ -0,0 +1,57 @@
+# Description:
+#   unittests for fieldmask.py
+
+import endpoints
+import unittest
+
+import datamodel_lib
+import fieldmask
+
+
+def _Record():
+  return datamodel_lib.RecordMessage(
+    id='r1',
+    school=datamodel_lib.SchoolMessage(district='test.org', name='test'),
+    parents=[datamodel_lib.PersonMessage(
+      id='p1', first_name='Ann', last_name='Smith',
+      email_addresses=['ann@example.com', 'ann@work.com'],
+      addresses=['1 Main St'])],
+    children=[datamodel_lib.PersonMessage(id='c1', first_name='Cal')],
+    num_parents=1, num_children=1)
+
+
+class FieldMaskTest(unittest.TestCase):
+
+  def testEmptyKeepsEverything(self):
+    for spec in (None, '', ' , '):
+      self.assertEquals(
+        None, fieldmask.Parse(spec, datamodel_lib.RecordMessage))
+    self.assertEquals([_Record()], fieldmask.Trim(None, [_Record()]))
+
+  def testTrims(self):
+    mask = fieldmask.Parse('id, parents.first_name,parents.id',
+                           datamodel_lib.RecordMessage)
+    self.assertTrue(mask.Has('parents'))
+    self.assertFalse(mask.Has('children'))
+    msg = mask.Apply(_Record())
+    self.assertEquals('r1', msg.id)
+    # Required, so sent whether asked for or not.
+    self.assertEquals('test', msg.school.name)
+    self.assertEquals([datamodel_lib.PersonMessage(id='p1', first_name='Ann')],
+                      list(msg.parents))
+    self.assertEquals([], list(msg.children))
+    self.assertEquals(None, msg.num_parents)
+
+  def testWholeFieldWins(self):
+    mask = fieldmask.Parse('parents.first_name,parents',
+                           datamodel_lib.RecordMessage)
+    self.assertEquals(_Record().parents, mask.Apply(_Record()).parents)
+
+  def testUnknownFields(self):
+    for spec in ('nope', 'parents.nope', 'id.first_name'):
+      self.assertRaises(endpoints.BadRequestException, fieldmask.Parse,
+                        spec, datamodel_lib.RecordMessage)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,104 @@
+# Description:
+#   WSGI entry point for everything but the Endpoints API (services.api).
+#
+#   The app is threadsafe: per-request state lives in os.environ (request
+#   local on the python27 runtime), the ndb context or threading.local
+#   (oauth's principal, rpc_stats' counters). Module-level objects shared
+#   by requests (metrics.REGISTRY) guard themselves with a lock.
+#
+#   Handlers are named by string, so webapp2 imports their module on the
+#   first request that matches and loading this module costs only webapp2.
+#   /_ah/warmup (see inbound_services in app.yaml) does those imports
+#   before the instance takes traffic, and logs what each one cost.
+
+import importlib
+import json
+import logging
+import sys
+import time
+import webapp2
+
+
+# Imported by /_ah/warmup, dependencies first, so each one's time is
+# mostly its own.
+WARM_MODULES = (
+  'oauth',
+  'paging',
+  'fieldmask',
+  'rpc_stats',
+  'txn',
+  'stats',
+  'datamodel_lib',
+  'metrics',
+  'person_fanout',
+  'backfill',
+  'roster_import',
+  'directory_export',
+  'sync',
+  'batch',
+  'services',
+  'wire',
+)
+
+
+def ImportModules(names):
+  """Imports names in order and times each.
+
+  Args:
+    names: (list) Module names.
+  Returns:
+    list: (name, milliseconds) pairs; 0 for modules already loaded.
+  """
+  costs = []
+  for name in names:
+    if name in sys.modules:
+      costs.append((name, 0))
+      continue
+    start = time.time()
+    importlib.import_module(name)
+    costs.append((name, int((time.time() - start) * 1000)))
+  return costs
+
+
+def PrimeCaches():
+  """Fills the District and School first-page list caches."""
+  import datamodel_lib
+  datamodel_lib.District.ListPage()
+  datamodel_lib.School.ListPage()
+
+
+class WarmupHandler(webapp2.RequestHandler):
+  """GET /_ah/warmup: loads the app before the instance serves users."""
+
+  def get(self):
+    start = time.time()
+    costs = ImportModules(WARM_MODULES)
+    imported = time.time()
+    try:
+      PrimeCaches()
+    except Exception:  # A cold cache is no reason to fail the warmup.
+      logging.exception('Priming the list caches failed.')
+    result = {'imports_ms': dict(costs),
+              'import_total_ms': int((imported - start) * 1000),
+              'prime_ms': int((time.time() - imported) * 1000)}
+    logging.info('warmup %s', json.dumps(result, sort_keys=True))
+    self.response.content_type = 'application/json'
+    self.response.write(json.dumps(result, sort_keys=True))
+
+
+app = webapp2.WSGIApplication([
+  ('/_ah/warmup', WarmupHandler),
+  ('/import/roster', 'roster_import.RosterUploadHandler'),
+  # roster_import.CHUNK_URL.
+  ('/tasks/import/chunk', 'roster_import.ImportChunkHandler'),
+  # person_fanout.REFRESH_URL.
+  ('/tasks/person/refresh', 'person_fanout.RefreshHandler'),
+  # directory_export.BATCH_URL and DOWNLOAD_URL.
+  ('/tasks/export/batch', 'directory_export.ExportBatchHandler'),
+  ('/export/download/([^/]+)', 'directory_export.DownloadHandler'),
+  # backfill.PAGE_URL.
+  ('/tasks/backfill/page', 'backfill.PageHandler'),
+  ('/admin/backfill/([^/]+)', 'backfill.StartHandler'),
+  ('/admin/stats', 'metrics.StatsHandler'),
+  ('/wire/(.+)', 'wire.CollectionHandler'),
+])
@@ -0,0 +1,40 @@
+# Description:
+#   unittests for main.py
+
+import json
+import unittest
+
+import webapp2
+
+import main
+import test_lib
+
+
+class WarmupTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = test_lib.Activate()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testWarmup(self):
+    response = webapp2.Request.blank('/_ah/warmup').get_response(main.app)
+    self.assertEquals(200, response.status_int)
+    result = json.loads(response.body)
+    self.assertEquals(sorted(main.WARM_MODULES),
+                      sorted(result['imports_ms']))
+    # The first pages are cached now.
+    import datamodel_lib
+    import rpc_stats
+    with rpc_stats.RpcCounter() as counter:
+      datamodel_lib.District.ListPage()
+      datamodel_lib.School.ListPage()
+    self.assertEquals(0, counter.Total('datastore_v3'))
+
+  def testImportModulesSkipsLoaded(self):
+    self.assertEquals([('json', 0)], main.ImportModules(['json']))
+
+
+if __name__ == '__main__':
+  unittest.main()
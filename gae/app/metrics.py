@@ -0,0 +1,179 @@
+# Description:
+#   Per-endpoint RPC and latency metrics for the Endpoints API.
+#
+#   MetricsMiddleware wraps services.api. For every method call it counts
+#   datastore gets/puts/queries, memcache hits/misses, transaction
+#   conflicts/retries and wall latency, logs them as one structured line
+#   and adds them to rolling one-minute histograms. /admin/stats serves
+#   those histograms as JSON. They live in instance memory, so the
+#   endpoint shows the instance that serves it; the log lines are the
+#   record across instances.
+
+import collections
+import json
+import logging
+import threading
+import time
+import webapp2
+
+import rpc_stats
+
+
+WINDOW_SECONDS = 60
+WINDOWS = 60  # An hour of one-minute windows.
+LATENCY_BOUNDS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+COUNT_BOUNDS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+# Histogram name -> the rpc_stats counts it sums.
+RPC_METRICS = collections.OrderedDict([
+  ('datastore_gets', ('datastore_v3.Get',)),
+  ('datastore_puts', ('datastore_v3.Put',)),
+  ('datastore_queries', ('datastore_v3.RunQuery', 'datastore_v3.Next')),
+  ('memcache_hits', (rpc_stats.MEMCACHE_HITS,)),
+  ('memcache_misses', (rpc_stats.MEMCACHE_MISSES,)),
+  ('txn_conflicts', (rpc_stats.TXN_CONFLICTS,)),
+  ('txn_retries', (rpc_stats.TXN_RETRIES,)),
+])
+
+
+class Histogram(object):
+  """Counts of values per bucket; bucket i holds values <= bounds[i]."""
+
+  def __init__(self, bounds):
+    self.bounds = bounds
+    self.buckets = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.sum = 0
+
+  def Add(self, value):
+    i = 0
+    while i < len(self.bounds) and value > self.bounds[i]:
+      i += 1
+    self.buckets[i] += 1
+    self.count += 1
+    self.sum += value
+
+  def Merge(self, other):
+    for i, n in enumerate(other.buckets):
+      self.buckets[i] += n
+    self.count += other.count
+    self.sum += other.sum
+
+  def ToDict(self):
+    labels = ['<=%s' % (b) for b in self.bounds] + ['>%s' % (self.bounds[-1])]
+    return {'count': self.count, 'sum': self.sum,
+            'buckets': dict((l, n) for l, n in zip(labels, self.buckets) if n)}
+
+
+class MethodStats(object):
+  """The histograms of one endpoint method in one window."""
+
+  def __init__(self):
+    self.errors = 0
+    self.histograms = collections.OrderedDict(
+      [('latency_ms', Histogram(LATENCY_BOUNDS_MS))] +
+      [(name, Histogram(COUNT_BOUNDS)) for name in RPC_METRICS])
+
+  def Add(self, sample):
+    if sample['error']:
+      self.errors += 1
+    for name, histogram in self.histograms.iteritems():
+      histogram.Add(sample[name])
+
+  def Merge(self, other):
+    self.errors += other.errors
+    for name, histogram in self.histograms.iteritems():
+      histogram.Merge(other.histograms[name])
+
+  def ToDict(self):
+    d = dict((n, h.ToDict()) for n, h in self.histograms.iteritems())
+    d['requests'] = self.histograms['latency_ms'].count
+    d['errors'] = self.errors
+    return d
+
+
+class Registry(object):
+  """Rolling windows of MethodStats, safe to share between threads."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._windows = collections.OrderedDict()  # start -> {method: stats}
+
+  def Add(self, method, sample, now=None):
+    start = int(now or time.time()) // WINDOW_SECONDS * WINDOW_SECONDS
+    with self._lock:
+      window = self._windows.get(start)
+      if window is None:
+        window = self._windows[start] = {}
+        while len(self._windows) > WINDOWS:
+          self._windows.popitem(last=False)
+      if method not in window:
+        window[method] = MethodStats()
+      window[method].Add(sample)
+
+  def Snapshot(self, minutes=WINDOWS, now=None):
+    """Merges the last minutes windows, the current one included."""
+    since = int(now or time.time()) - minutes * WINDOW_SECONDS
+    merged = {}
+    with self._lock:
+      for start, window in self._windows.iteritems():
+        if start <= since:
+          continue
+        for method, stats in window.iteritems():
+          if method not in merged:
+            merged[method] = MethodStats()
+          merged[method].Merge(stats)
+    return dict((m, s.ToDict()) for m, s in merged.iteritems())
+
+
+REGISTRY = Registry()
+
+
+def Sample(counter, seconds, error):
+  """Turns an RpcCounter into the values MethodStats records."""
+  sample = {'latency_ms': int(seconds * 1000), 'error': error}
+  for name, keys in RPC_METRICS.iteritems():
+    sample[name] = sum(counter.counts[k] for k in keys)
+  return sample
+
+
+class MetricsMiddleware(object):
+  """WSGI middleware recording one sample per Endpoints method call."""
+
+  def __init__(self, app, registry=REGISTRY):
+    self.app = app
+    self.registry = registry
+
+  def __call__(self, environ, start_response):
+    # Endpoints calls arrive as /_ah/spi/<Service>.<Method>.
+    method = environ.get('PATH_INFO', '').rsplit('/', 1)[-1]
+    status = []
+    def _StartResponse(s, headers, exc_info=None):
+      status.append(s)
+      return start_response(s, headers, exc_info)
+    error = True
+    with rpc_stats.RpcCounter() as counter:
+      start = time.time()
+      try:
+        body = self.app(environ, _StartResponse)
+        error = not status or not status[0].startswith(('2', '3'))
+        return body
+      finally:
+        sample = Sample(counter, time.time() - start, error)
+        self.registry.Add(method, sample)
+        logging.info('endpoint_stats %s', json.dumps(
+          dict(sample, method=method), sort_keys=True))
+
+
+class StatsHandler(webapp2.RequestHandler):
+  """GET /admin/stats[?minutes=N]: this instance's histograms as JSON."""
+
+  def get(self):
+    try:
+      minutes = int(self.request.get('minutes') or WINDOWS)
+    except ValueError:
+      self.abort(400, detail='minutes must be an integer.')
+    self.response.content_type = 'application/json'
+    self.response.write(json.dumps(
+      {'window_seconds': WINDOW_SECONDS, 'minutes': minutes,
+       'methods': REGISTRY.Snapshot(minutes)}, sort_keys=True))
@@ -0,0 +1,87 @@
+# Description:
+#   unittests for metrics.py
+
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import metrics
+
+
+class Thing(ndb.Model):
+  name = ndb.StringProperty()
+
+
+def _App(environ, start_response):
+  """Does a put, a get and a query, then answers 200 (or 404 on /missing)."""
+  key = Thing(name='a').put()
+  memcache.get_multi(['x', 'y'])
+  memcache.set('x', 1)
+  memcache.get('x')
+  key.get(use_cache=False, use_memcache=False)
+  Thing.query().fetch(use_cache=False)
+  if environ['PATH_INFO'].endswith('missing'):
+    start_response('404 Not Found', [])
+  else:
+    start_response('200 OK', [])
+  return ['{}']
+
+
+class MetricsTest(unittest.TestCase):
+
+  def setUp(self):
+    # First, create an instance of the Testbed class.
+    self.testbed = testbed.Testbed()
+    # Then activate the testbed, which prepares the service stubs for use.
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.registry = metrics.Registry()
+    self.app = metrics.MetricsMiddleware(_App, registry=self.registry)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def _Call(self, path):
+    self.app({'PATH_INFO': path}, lambda status, headers, exc_info=None: None)
+
+  def testCountsPerMethod(self):
+    self._Call('/_ah/spi/RecordService.RecordList')
+    self._Call('/_ah/spi/RecordService.RecordList')
+    self._Call('/_ah/spi/SchoolService.missing')
+    stats = self.registry.Snapshot()
+    records = stats['RecordService.RecordList']
+    self.assertEquals(2, records['requests'])
+    self.assertEquals(0, records['errors'])
+    self.assertEquals(2, records['datastore_gets']['sum'])
+    self.assertEquals(2, records['datastore_puts']['sum'])
+    self.assertEquals(2, records['datastore_queries']['count'])
+    self.assertEquals(2, records['memcache_hits']['sum'])
+    self.assertEquals(4, records['memcache_misses']['sum'])
+    self.assertEquals(1, stats['SchoolService.missing']['errors'])
+
+  def testWindowsRollOff(self):
+    sample = {'latency_ms': 12, 'error': False}
+    sample.update((name, 1) for name in metrics.RPC_METRICS)
+    start = 1000000 * metrics.WINDOW_SECONDS
+    for minute in xrange(metrics.WINDOWS + 5):
+      self.registry.Add('M', sample, now=start + minute * 60)
+    now = start + (metrics.WINDOWS + 4) * 60
+    self.assertEquals(
+      metrics.WINDOWS, self.registry.Snapshot(now=now)['M']['requests'])
+    self.assertEquals(2, self.registry.Snapshot(2, now=now)['M']['requests'])
+
+  def testHistogram(self):
+    h = metrics.Histogram((1, 10))
+    for v in (0, 1, 5, 50):
+      h.Add(v)
+    self.assertEquals([2, 1, 1], h.buckets)
+    self.assertEquals({'count': 4, 'sum': 56,
+                       'buckets': {'<=1': 2, '<=10': 1, '>10': 1}},
+                      h.ToDict())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,41 +1,147 @@
 # Description:
 #   Utilities for authorizing http requests.
 
+import contextlib
 import endpoints
+import threading
 
+from google.appengine.api import oauth as gae_oauth
 from google.appengine.api import users
-from google.appengine.ext import ndb
-from httplib2 import Http
-from oauth2client.appengine import CredentialsModel
-from oauth2client.appengine import OAuth2DecoratorFromClientSecrets
-from oauth2client.appengine import StorageByKeyName
+
+
+# Holds the Principal of the request being served on this thread.
+_request_state = threading.local()
+
+WEB_CLIENT_ID = '884138883203.apps.googleusercontent.com'
+EMAIL_SCOPE = endpoints.EMAIL_SCOPE
+# OAuth 2.0 clients whose bearer tokens the webapp2 routes accept, see
+# GetRouteUser. The Endpoints API has its own list.
+ROUTE_CLIENT_IDS = (WEB_CLIENT_ID,)
+
+
+class Principal(object):
+  """The caller of the current request.
+
+  Attributes:
+    user: (User) The authenticated user, None when anonymous.
+    user_id: (str) user.user_id().
+    email: (str) user.email().
+  """
+
+  def __init__(self, user, user_cls=None):
+    self.user = user
+    self.user_id = user.user_id() if user else None
+    self.email = user.email() if user else None
+    self._user_cls = user_cls
+    self._acl = None
+    self._is_super_user = None
+
+  @property
+  def acl(self):
+    """The caller's UserAcl, looked up on first use; None when anonymous."""
+    if self._acl is None and self.user and self._user_cls:
+      self._acl = self._user_cls.Acl(self)
+    return self._acl
+
+  @property
+  def is_super_user(self):
+    if self._is_super_user is None:
+      self._is_super_user = bool(self.acl and self.acl.is_super_user)
+    return self._is_super_user
+
+
+@contextlib.contextmanager
+def RequestPrincipal(user_cls, get_user=None):
+  """Resolves the Principal once and serves it for the rest of the request.
+
+  Inside another RequestPrincipal, e.g. a service method a webapp2 route
+  calls, serves the outer Principal.
+
+  Args:
+    user_cls: (class) The datamodel User, used for the super-user lookup.
+    get_user: (function) Returns the caller's users.User, or None;
+      GetEndpointsUser by default, GetRouteUser for webapp2 routes.
+  Yields:
+    Principal: The caller.
+  """
+  outer = getattr(_request_state, 'principal', None)
+  if outer:
+    yield outer
+    return
+  _request_state.principal = Principal((get_user or GetEndpointsUser)(),
+                                       user_cls)
+  try:
+    yield _request_state.principal
+  finally:
+    _request_state.principal = None
+
+
+def GetPrincipal(user_cls=None):
+  """The request's Principal, or a fresh one outside of RequestPrincipal.
+
+  Args:
+    user_cls: (class) The datamodel User, used for the super-user lookup.
+  Returns:
+    Principal: The caller.
+  """
+  principal = getattr(_request_state, 'principal', None)
+  if principal:
+    if not principal._user_cls:
+      principal._user_cls = user_cls
+    return principal
+  return Principal(GetEndpointsUser(), user_cls)
 
 
 def GetEndpointsUser():
   """Since the endpoints.User doesn't have user_id set, we just use User.
 
+  Outside of an Endpoints request, this is GetRouteUser.
+
   Returns:
     user: (User) Gets the user struct.
   """
-  user = endpoints.get_current_user()
-  if not user.user_id():
+  try:
+    user = endpoints.get_current_user()
+  except endpoints.InvalidGetUserCall:
+    return GetRouteUser()
+  if not user or not user.user_id():
     user = users.get_current_user()
   return user
 
 
+def GetRouteUser():
+  """The caller of a request to a webapp2 route, which Endpoints doesn't
+  authenticate.
+
+  Returns:
+    User: The owner of the request's bearer token for EMAIL_SCOPE, when one
+      of ROUTE_CLIENT_IDS issued it, else the user signed in to the users
+      API; None when neither.
+  """
+  try:
+    user = gae_oauth.get_current_user(EMAIL_SCOPE)
+    if gae_oauth.get_client_id(EMAIL_SCOPE) not in ROUTE_CLIENT_IDS:
+      user = None
+  except gae_oauth.Error:
+    user = None
+  return user or users.get_current_user()
+
+
 def ValidateUser(cls, key):
-  """Container about how to validate."""
-  current_user = GetEndpointsUser()
+  """Container about how to validate.
+
+  Returns:
+    Principal: The validated caller.
+  """
+  principal = GetPrincipal()
   # Check that user is allowed in root_key.
-  if not current_user:
+  if not principal.user:
     raise endpoints.UnauthorizedException('Invalid User!')
+  return principal
 
 
 def IsSuperUser(user_cls):
-  u = user_cls.Find()
-  if not u:
-    return False
-  return u.is_super_user
+  return GetPrincipal(user_cls).is_super_user
 
 
 def EndpointsGetAuthorizedHttp():
@@ -44,6 +150,11 @@ def EndpointsGetAuthorizedHttp():
   Returns:
     Http: An authorized Http connection.
   """
+  # Imported here: nothing on the request path needs them, and they are
+  # the slowest imports of a cold start.
+  from httplib2 import Http
+  from oauth2client.appengine import CredentialsModel
+  from oauth2client.appengine import StorageByKeyName
   user = users.get_current_user()
   storage = StorageByKeyName(
     CredentialsModel, user.user_id(), 'credentials')
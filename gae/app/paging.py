@@ -0,0 +1,95 @@
+# Description:
+#   Cursor-based paging shared by the list endpoints.
+
+import endpoints
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import db
+from protorpc import messages
+from protorpc import message_types
+
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# Request for the list endpoints that take no other arguments.
+PageResource = endpoints.ResourceContainer(
+  message_types.VoidMessage,
+  page_size=messages.IntegerField(1, variant=messages.Variant.INT32),
+  page_token=messages.StringField(2))
+
+
+def PageSize(page_size):
+  """The number of results to fetch for a requested page_size.
+
+  Args:
+    page_size: (int) As requested; None or 0 for DEFAULT_PAGE_SIZE.
+  Returns:
+    int: page_size, capped at MAX_PAGE_SIZE.
+  Raises:
+    endpoints.BadRequestException: When page_size is negative.
+  """
+  if page_size is not None and page_size < 0:
+    raise endpoints.BadRequestException('Invalid page_size.')
+  return min(page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+
+
+def FetchPage(query, page_size=None, page_token=None, **kwargs):
+  """Fetches one page of query, starting where page_token left off.
+
+  Args:
+    query: (ndb.Query) The query to page through.
+    page_size: (int) Results wanted, capped at MAX_PAGE_SIZE.
+    page_token: (str) The next_page_token of the previous page.
+    **kwargs: Passed on to fetch_page (keys_only, projection, ...).
+  Returns:
+    (list, str): The results and the token of the next page, None when
+      this is the last one.
+  Raises:
+    endpoints.BadRequestException: When page_size is negative or
+      page_token is not a valid cursor.
+  """
+  page_size = PageSize(page_size)
+  cursor = None
+  if page_token:
+    try:
+      cursor = Cursor(urlsafe=page_token)
+    except (db.BadValueError, db.BadRequestError, TypeError, ValueError):
+      raise endpoints.BadRequestException('Invalid page_token.')
+  results, next_cursor, more = query.fetch_page(
+    page_size, start_cursor=cursor, **kwargs)
+  if not more or not next_cursor:
+    return results, None
+  return results, next_cursor.urlsafe()
+
+
+def FetchMatchingPage(query, matches, page_size=None, page_token=None,
+                      **kwargs):
+  """FetchPage, keeping only the results matches is true of.
+
+  Fetches on from where the last fetch ended until the page is full or
+  query is exhausted, so only the last page comes back short. Each fetch
+  asks for no more than the page still lacks, which keeps the token at
+  the last result returned.
+
+  Args:
+    query: (ndb.Query) The query to page through.
+    matches: (callable) Takes a result, returns whether to keep it.
+    page_size: (int) Results wanted, capped at MAX_PAGE_SIZE.
+    page_token: (str) The next_page_token of the previous page.
+    **kwargs: Passed on to fetch_page (keys_only, projection, ...).
+  Returns:
+    (list, str): The results and the token of the next page, None when
+      this is the last one.
+  Raises:
+    endpoints.BadRequestException: As FetchPage.
+  """
+  page_size = PageSize(page_size)
+  results = []
+  while True:
+    batch, page_token = FetchPage(query, page_size - len(results),
+                                  page_token, **kwargs)
+    results.extend(r for r in batch if matches(r))
+    if len(results) >= page_size or not page_token:
+      return results, page_token
+
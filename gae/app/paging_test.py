@@ -0,0 +1,65 @@
+# Description:
+#   unittests for paging.py
+
+import endpoints
+import unittest
+
+from google.appengine.ext import ndb
+
+import paging
+import test_lib
+
+
+class _Item(ndb.Model):
+  n = ndb.IntegerProperty()
+
+
+class PagingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = test_lib.Activate()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testPageSize(self):
+    self.assertEquals(paging.DEFAULT_PAGE_SIZE, paging.PageSize(None))
+    self.assertEquals(paging.DEFAULT_PAGE_SIZE, paging.PageSize(0))
+    self.assertEquals(7, paging.PageSize(7))
+    self.assertEquals(paging.MAX_PAGE_SIZE,
+                      paging.PageSize(paging.MAX_PAGE_SIZE + 1))
+    self.assertRaises(endpoints.BadRequestException, paging.PageSize, -1)
+
+  def testFetchPage(self):
+    ndb.put_multi([_Item() for _ in xrange(5)])
+    seen = []
+    items, token = paging.FetchPage(_Item.query(), 3)
+    seen.extend(items)
+    self.assertEquals(3, len(items))
+    items, token = paging.FetchPage(_Item.query(), 3, token)
+    seen.extend(items)
+    self.assertEquals(None, token)
+    self.assertEquals(5, len(set(i.key for i in seen)))
+    self.assertRaises(endpoints.BadRequestException, paging.FetchPage,
+                      _Item.query(), -1)
+
+
+  def testFetchMatchingPage(self):
+    ndb.put_multi([_Item(id=i + 1, n=i) for i in xrange(10)])
+    # One in three matches: every page takes several fetches to fill.
+    def _Matches(item):
+      return item.n % 3 == 0
+    pages = []
+    token = None
+    while True:
+      items, token = paging.FetchMatchingPage(_Item.query(), _Matches, 2,
+                                              token)
+      pages.append([i.n for i in items])
+      if not token:
+        break
+    self.assertEquals([[0, 3], [6, 9]], pages[:2])
+    self.assertEquals([], sum(pages[2:], []))
+
+
+if __name__ == '__main__':
+  unittest.main()
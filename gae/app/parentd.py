@@ -1,23 +1,21 @@
 # Description:
 #   Bare-bones, online database with parent/kid contact information.
 #   Uses GAE Endpoints to make things simple in the clients.
+#
+#   Legacy: app.yaml serves the API from services.py and everything else
+#   from main.py. Nothing may import this module next to datamodel_lib,
+#   since both register models for the same kinds in ndb's kind map.
 
 import endpoints
 import logging
-import os
 
-from apiclient.discovery import build
-from google.appengine.api import users
 from google.appengine.ext import ndb
-from google.appengine.ext import webapp
-from google.appengine.ext.webapp.util import run_wsgi_app
 from google.appengine.ext.db import BadArgumentError
-from oauth2client.appengine import OAuth2DecoratorFromClientSecrets
 from protorpc import messages
-from protorpc import message_types
 from protorpc import remote
 
 import oauth
+import paging
 
 
 U = '884138883203.apps.googleusercontent.com'
@@ -43,6 +41,7 @@ class DistrictMessage(messages.Message):
 class DistrictCollectionMessage(messages.Message):
   """Used when listing all districts."""
   items = messages.MessageField(DistrictMessage, 1, repeated=True)
+  next_page_token = messages.StringField(2)
 
 
 # Broker between District formats
@@ -67,11 +66,12 @@ def DistrictMessageFromDistrict(obj):
   return o
 
 
-def DistrictCollectionMessageFromDistrict(objs):
+def DistrictCollectionMessageFromDistrict(objs, next_page_token=None):
   container = []
   for o in objs:
     container.append(DistrictMessageFromDistrict(o))
-  return DistrictCollectionMessage(items=container)
+  return DistrictCollectionMessage(items=container,
+                                   next_page_token=next_page_token)
 
 
 # Districts have schools. Usually schools are unique within a
@@ -89,6 +89,7 @@ class SchoolMessage(messages.Message):
 class SchoolCollectionMessage(messages.Message):
   """Used when listing all districts."""
   items = messages.MessageField(SchoolMessage, 1, repeated=True)
+  next_page_token = messages.StringField(2)
 
 
 # Broker between School formats
@@ -115,11 +116,12 @@ def SchoolMessageFromSchool(obj):
   return o
 
 
-def SchoolCollectionMessageFromSchool(objs):
+def SchoolCollectionMessageFromSchool(objs, next_page_token=None):
   container = []
   for o in objs:
     container.append(SchoolMessageFromSchool(o))
-  return SchoolCollectionMessage(items=container)
+  return SchoolCollectionMessage(items=container,
+                                 next_page_token=next_page_token)
 
 
 # Only some people are allowed into a school.
@@ -136,6 +138,7 @@ class AllowedMessage(messages.Message):
 class AllowedCollectionMessage(messages.Message):
   """Used when listing all districts."""
   items = messages.MessageField(AllowedMessage, 1, repeated=True)
+  next_page_token = messages.StringField(2)
 
 
 # Broker between Allowed formats
@@ -168,11 +171,12 @@ def AllowedMessageFromAllowed(obj):
   return o
 
 
-def AllowedCollectionMessageFromAllowed(objs):
+def AllowedCollectionMessageFromAllowed(objs, next_page_token=None):
   container = []
   for o in objs:
     container.append(AllowedMessageFromAllowed(o))
-  return AllowedCollectionMessage(items=container)
+  return AllowedCollectionMessage(items=container,
+                                  next_page_token=next_page_token)
 
 
 
@@ -198,6 +202,7 @@ class PersonMessage(messages.Message):
 class PersonCollectionMessage(messages.Message):
   """Used when listing all districts."""
   items = messages.MessageField(PersonMessage, 1, repeated=True)
+  next_page_token = messages.StringField(2)
 
 
 # Broker between Person formats
@@ -211,12 +216,12 @@ def PersonFromPersonMessage(pb, **kwargs):
   s = School.get_by_id(pb.school, parent=d.key)
   if not s:
     raise BadArgumentError('No School: %s' % (pb.school))
+  # An ancestor query, so it is strongly consistent.
   v = Person.query(Person.first_name == pb.first_name,
                    Person.last_name == pb.last_name,
-                   ancestor=(d.key, s.key))
+                   ancestor=s.key).get()
   if not v:
-    v = Person(parent=ndb.Key(District, pb.district,
-                               School, pb.school),
+    v = Person(parent=s.key,
                first_name=pb.first_name, last_name=pb.last_name,
                phone_number=pb.phone_number,
                email_address=pb.email_address,
@@ -240,11 +245,12 @@ def PersonMessageFromPerson(obj):
   return o
 
 
-def PersonCollectionMessageFromPerson(objs):
+def PersonCollectionMessageFromPerson(objs, next_page_token=None):
   container = []
   for o in objs:
     container.append(PersonMessageFromPerson(o))
-  return PersonCollectionMessage(items=container)
+  return PersonCollectionMessage(items=container,
+                                 next_page_token=next_page_token)
 
 
 # Finally - A record in the datastore.
@@ -267,6 +273,7 @@ class RecordMessage(messages.Message):
 class RecordCollectionMessage(messages.Message):
   """Used when listing all districts."""
   items = messages.MessageField(RecordMessage, 1, repeated=True)
+  next_page_token = messages.StringField(2)
 
 
 # Broker between Record formats
@@ -320,11 +327,12 @@ def RecordMessageFromRecord(obj):
   return o
 
 
-def RecordCollectionMessageFromRecord(objs):
+def RecordCollectionMessageFromRecord(objs, next_page_token=None):
   container = []
   for o in objs:
     container.append(RecordMessageFromRecord(o))
-  return RecordCollectionMessage(items=container)
+  return RecordCollectionMessage(items=container,
+                                 next_page_token=next_page_token)
 
 
 parentd_api = endpoints.api(
@@ -334,12 +342,14 @@ parentd_api = endpoints.api(
 
 @parentd_api.api_class(resource_name='district')
 class DistrictService(remote.Service):
-  @endpoints.method(message_types.VoidMessage, DistrictCollectionMessage,
+  @endpoints.method(paging.PageResource, DistrictCollectionMessage,
                     path='district/list', http_method='GET', name='list')
-  def DistrictList(self, unused_request):
+  def DistrictList(self, request):
     q = District.query()
-    districts = q.fetch()
-    return DistrictCollectionMessageFromDistrict(districts)
+    districts, next_page_token = paging.FetchPage(
+      q, request.page_size, request.page_token)
+    return DistrictCollectionMessageFromDistrict(
+      districts, next_page_token=next_page_token)
 
   @endpoints.method(DistrictMessage, DistrictMessage,
                     path='district/add', http_method='POST', name='add')
@@ -353,12 +363,14 @@ class DistrictService(remote.Service):
 
 @parentd_api.api_class(resource_name='school')
 class SchoolService(remote.Service):
-  @endpoints.method(message_types.VoidMessage, SchoolCollectionMessage,
+  @endpoints.method(paging.PageResource, SchoolCollectionMessage,
                     path='school/list', http_method='GET', name='list')
-  def SchoolList(self, unused_request):
+  def SchoolList(self, request):
     q = School.query()
-    schools = q.fetch()
-    return SchoolCollectionMessageFromSchool(schools)
+    schools, next_page_token = paging.FetchPage(
+      q, request.page_size, request.page_token)
+    return SchoolCollectionMessageFromSchool(
+      schools, next_page_token=next_page_token)
 
   @endpoints.method(SchoolMessage, SchoolMessage,
                     path='school/add', http_method='POST', name='add')
@@ -371,12 +383,14 @@ class SchoolService(remote.Service):
 
 @parentd_api.api_class(resource_name='allowed')
 class AllowedService(remote.Service):
-  @endpoints.method(message_types.VoidMessage, AllowedCollectionMessage,
+  @endpoints.method(paging.PageResource, AllowedCollectionMessage,
                     path='allowed/list', http_method='GET', name='list')
-  def AllowedList(self, unused_request):
+  def AllowedList(self, request):
     q = Allowed.query()
-    alloweds = q.fetch()
-    return AllowedCollectionMessageFromAllowed(alloweds)
+    alloweds, next_page_token = paging.FetchPage(
+      q, request.page_size, request.page_token)
+    return AllowedCollectionMessageFromAllowed(
+      alloweds, next_page_token=next_page_token)
 
   @endpoints.method(AllowedMessage, AllowedMessage,
                     path='allowed/add', http_method='POST', name='add')
@@ -390,12 +404,14 @@ class AllowedService(remote.Service):
 
 @parentd_api.api_class(resource_name='person')
 class PersonService(remote.Service):
-  @endpoints.method(message_types.VoidMessage, PersonCollectionMessage,
+  @endpoints.method(paging.PageResource, PersonCollectionMessage,
                     path='person/list', http_method='GET', name='list')
-  def PersonList(self, unused_request):
+  def PersonList(self, request):
     q = Person.query()
-    persons = q.fetch()
-    return PersonCollectionMessageFromPerson(persons)
+    persons, next_page_token = paging.FetchPage(
+      q, request.page_size, request.page_token)
+    return PersonCollectionMessageFromPerson(
+      persons, next_page_token=next_page_token)
 
   @endpoints.method(PersonMessage, PersonMessage,
                     path='person/add', http_method='POST', name='add')
@@ -409,12 +425,14 @@ class PersonService(remote.Service):
 
 @parentd_api.api_class(resource_name='record')
 class RecordService(remote.Service):
-  @endpoints.method(message_types.VoidMessage, RecordCollectionMessage,
+  @endpoints.method(paging.PageResource, RecordCollectionMessage,
                     path='record/list', http_method='GET', name='list')
-  def RecordList(self, unused_request):
+  def RecordList(self, request):
     q = Record.query()
-    records = q.fetch()
-    return RecordCollectionMessageFromRecord(records)
+    records, next_page_token = paging.FetchPage(
+      q, request.page_size, request.page_token)
+    return RecordCollectionMessageFromRecord(
+      records, next_page_token=next_page_token)
 
   @endpoints.method(RecordMessage, RecordMessage,
                     path='record/add', http_method='POST', name='add')
@@ -431,12 +449,3 @@ api = endpoints.api_server([
     AllowedService,
     PersonService,
     RecordService])
-
-
-def main():
-  logging.getLogger().setLevel(logging.DEBUG)
-  webapp.util.run_wsgi_app(APPLICATION)
-
-
-if __name__ == '__main__':
-  main()
@@ -0,0 +1,99 @@
+# Description:
+#   Refreshes the PersonSummary snapshots Records embed when a Person
+#   changes.
+#
+#   Writers collect the Persons whose summary changed and call
+#   EnqueueRefresh once their write has committed. A task then walks the
+#   Records listing each Person as a parent, then as a child, a page at a
+#   time, and rewrites the stale snapshots, each Record in its own
+#   transaction so a concurrent Record write is never overwritten.
+
+import json
+import logging
+import webapp2
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import datamodel_lib
+
+
+QUEUE_NAME = 'person-fanout'
+REFRESH_URL = '/tasks/person/refresh'
+PAGE_SIZE = 100  # Records per task.
+ENQUEUE_BATCH = 100  # Tasks per Queue.add() call, the API's limit.
+FIELDS = ('parents', 'children')
+
+
+def _Task(person, field=FIELDS[0], cursor=None):
+  return taskqueue.Task(url=REFRESH_URL, payload=json.dumps(
+    {'person': person.urlsafe(), 'field': field, 'cursor': cursor}))
+
+
+def EnqueueRefresh(person_keys):
+  """Queues a refresh of every Record listing one of person_keys.
+
+  Args:
+    person_keys: (list) Person keys, duplicates are dropped.
+  """
+  tasks = []
+  seen = set()
+  for key in person_keys:
+    if key not in seen:
+      seen.add(key)
+      tasks.append(_Task(key))
+  queue = taskqueue.Queue(QUEUE_NAME)
+  for i in xrange(0, len(tasks), ENQUEUE_BATCH):
+    queue.add(tasks[i:i + ENQUEUE_BATCH])
+
+
+@ndb.transactional_tasklet
+def _RefreshAsync(record_key, person):
+  """Returns the School of the Record when it was rewritten, else None."""
+  record = yield record_key.get_async()
+  if record and datamodel_lib.Record.RefreshSnapshot(record, person):
+    yield record.put_async()
+    raise ndb.Return(record.school)
+  raise ndb.Return(None)
+
+
+def RefreshRecords(payload):
+  """Refreshes one page of Records and queues the task for the next.
+
+  Args:
+    payload: (dict) As queued by EnqueueRefresh.
+  Returns:
+    int: The number of Records rewritten.
+  """
+  person_key = ndb.Key(urlsafe=payload['person'])
+  person = person_key.get()
+  if not person:
+    return 0
+  field = payload['field']
+  prop = getattr(datamodel_lib.Record, field)
+  start = Cursor(urlsafe=payload['cursor']) if payload['cursor'] else None
+  keys, cursor, more = datamodel_lib.Record.query(prop == person_key).fetch_page(
+    PAGE_SIZE, keys_only=True, start_cursor=start)
+  # The transactions run side by side, one entity group each.
+  futures = [_RefreshAsync(k, person) for k in keys]
+  schools = [f.get_result() for f in futures]
+  schools = [s for s in schools if s]
+  datamodel_lib.BumpSchoolVersion(*schools)
+  refreshed = len(schools)
+  if more:
+    taskqueue.Queue(QUEUE_NAME).add(
+      _Task(person_key, field, cursor.urlsafe()))
+  elif field != FIELDS[-1]:
+    taskqueue.Queue(QUEUE_NAME).add(
+      _Task(person_key, FIELDS[FIELDS.index(field) + 1]))
+  return refreshed
+
+
+class RefreshHandler(webapp2.RequestHandler):
+  """Task queue worker for one page of Records."""
+
+  def post(self):
+    payload = json.loads(self.request.body)
+    refreshed = RefreshRecords(payload)
+    logging.info('Refreshed %d Records of %s', refreshed, payload['person'])
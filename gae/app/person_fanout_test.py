@@ -0,0 +1,77 @@
+# Description:
+#   unittests for person_fanout.py
+
+import json
+import unittest
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import datamodel_lib
+import person_fanout
+import test_lib
+
+
+class PersonFanoutTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = test_lib.Activate(taskqueue=True)
+    self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.AddSuperUser()
+    datamodel_lib.District(id='test.org').put()
+    datamodel_lib.School(
+      id='test', parent=ndb.Key(datamodel_lib.District, 'test.org')).put()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def _RunTasks(self):
+    """Runs queued tasks, and the ones they queue, until none are left."""
+    runs = 0
+    while True:
+      tasks = self.taskqueue.get_filtered_tasks(
+        queue_names=[person_fanout.QUEUE_NAME])
+      if not tasks:
+        return runs
+      self.taskqueue.FlushQueue(person_fanout.QUEUE_NAME)
+      for task in tasks:
+        person_fanout.RefreshRecords(json.loads(task.payload))
+        runs += 1
+
+  def _Family(self, mom, kid):
+    return datamodel_lib.RecordMessage(
+      school=datamodel_lib.SchoolMessage(district='test.org', name='test'),
+      parents=[datamodel_lib.PersonMessage(
+        first_name='mom', email_addresses=[mom])],
+      children=[datamodel_lib.PersonMessage(
+        first_name=kid, email_addresses=['%s@example.com' % (kid)])])
+
+  def testRefreshesEveryRecord(self):
+    # Three families share mom: a page per Record, then the children pass.
+    records = [datamodel_lib.Record.FromMessage(
+                 self._Family('mom@example.com', 'kid%d' % (i)))
+               for i in xrange(3)]
+    mom = records[0].parents[0]
+    person = mom.get()
+    person.last_name = 'smith'
+    person.put()
+    person_fanout.PAGE_SIZE, page_size = 1, person_fanout.PAGE_SIZE
+    try:
+      person_fanout.EnqueueRefresh([mom, mom])
+      # fetch_page may report more results at the end of the last page.
+      self.assertTrue(self._RunTasks() >= 4)
+    finally:
+      person_fanout.PAGE_SIZE = page_size
+    for record in ndb.get_multi([r.key for r in records]):
+      self.assertEquals('smith', record.parent_summaries[0].last_name)
+      self.assertTrue(datamodel_lib.Record.HasSnapshots(record))
+
+  def testMissingPerson(self):
+    self.assertEquals(0, person_fanout.RefreshRecords(
+      {'person': ndb.Key(datamodel_lib.Person, 'gone').urlsafe(),
+       'field': 'parents', 'cursor': None}))
+
+
+if __name__ == '__main__':
+  unittest.main()
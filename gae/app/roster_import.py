@@ -0,0 +1,447 @@
+# Description:
+#   Bulk import of school rosters through the task queue.
+#
+#   An upload is parsed as a stream, families are grouped into chunks and
+#   each chunk is written by a task with a single put_multi. Workers record
+#   their results as children of the ImportJob, so progress never contends
+#   on one entity. The result is written in one transaction with the
+#   chunk's school counts (stats.py), so a retried chunk is counted once.
+#
+#   A family's Record is keyed on the school and its members, so importing
+#   a roster again updates the Records of the families it had, rather than
+#   adding them twice. A family whose members changed, in contact details
+#   or names where they have none, gets a new Record; its old one stays
+#   until deleted.
+
+import csv
+import endpoints
+import hashlib
+import json
+import logging
+import webapp2
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from protorpc import messages
+
+import datamodel_lib
+import oauth
+import person_fanout
+import stats
+import txn
+
+
+QUEUE_NAME = 'roster-import'
+CHUNK_URL = '/tasks/import/chunk'
+CHUNK_SIZE = 100  # Families per task, keeps payloads well under 100KB.
+ENQUEUE_BATCH = 20  # Tasks per Queue.add() call.
+MAX_ERRORS = 100  # Errors kept per job and per chunk.
+
+FORMATS = ('csv', 'jsonl')
+# CSV columns. Repeated values are separated by ';'. Consecutive rows with
+# the same family make up one Record.
+CSV_COLUMNS = ('family', 'role', 'first_name', 'last_name', 'phone_numbers',
+               'email_addresses', 'addresses')
+REPEATED_FIELDS = ('phone_numbers', 'email_addresses', 'addresses')
+ROLES = {'parent': 'parents', 'child': 'children'}
+
+
+class RosterError(ValueError):
+  """A roster row that cannot be imported."""
+
+
+class ImportStatusMessage(messages.Message):
+  job_id = messages.StringField(1)
+  state = messages.StringField(2)
+  chunks_total = messages.IntegerField(3)
+  chunks_done = messages.IntegerField(4)
+  families_total = messages.IntegerField(5)
+  families_imported = messages.IntegerField(6)
+  errors = messages.StringField(7, repeated=True)
+
+
+class ImportJob(ndb.Model):
+  """One roster upload."""
+  school = ndb.KeyProperty(datamodel_lib.School, required=True)
+  format = ndb.StringProperty(choices=FORMATS)
+  state = ndb.StringProperty(default='parsing')  # parsing -> queued.
+  chunks_total = ndb.IntegerProperty(default=0)
+  families_total = ndb.IntegerProperty(default=0)
+  errors = ndb.TextProperty(repeated=True)
+  created_by = ndb.UserProperty(auto_current_user_add=True)
+  created = ndb.DateTimeProperty(auto_now_add=True)
+
+  @classmethod
+  def ToMessage(cls, obj):
+    # Ancestor query, so the counts are strongly consistent.
+    chunks = ImportChunkResult.query(ancestor=obj.key).fetch()
+    errors = list(obj.errors)
+    for chunk in chunks:
+      errors.extend(chunk.errors)
+    state = obj.state
+    if state == 'queued' and len(chunks) >= obj.chunks_total:
+      state = 'done'
+    return ImportStatusMessage(
+      job_id=obj.key.urlsafe(), state=state,
+      chunks_total=obj.chunks_total, chunks_done=len(chunks),
+      families_total=obj.families_total,
+      families_imported=sum(c.imported for c in chunks),
+      errors=errors[:MAX_ERRORS])
+
+
+class ImportChunkResult(ndb.Model):
+  """Written by the worker once its chunk is in. Child of the ImportJob."""
+  imported = ndb.IntegerProperty(default=0)
+  errors = ndb.TextProperty(repeated=True)
+
+
+class ImportChunkDeltas(ndb.Model):
+  """The school counts a chunk changes, stats.Deltas.ToDict, fixed before
+  its first write: a retry finds the Records already written and could
+  no longer tell. Keyed by job and chunk, a root entity so the chunks of
+  a job don't contend on its group.
+  """
+  deltas = ndb.JsonProperty()
+
+
+def _ParseCsv(roster):
+  """Yields (line, family) from a CSV roster, grouping consecutive rows."""
+  reader = csv.reader(roster)
+  header = [c.strip().lower() for c in next(reader, [])]
+  missing = set(('family', 'role')) - set(header)
+  if missing:
+    raise RosterError('line 1: missing columns %s' % (', '.join(missing)))
+  family_id = family = line = None
+  for row in reader:
+    if not any(row):
+      continue
+    # Short rows leave their last columns out.
+    values = dict(zip(header, [v.decode('utf-8').strip() for v in row]))
+    if values.get('family', '') != family_id:
+      if family:
+        yield line, family
+      family_id = values.get('family', '')
+      family = {'parents': [], 'children': []}
+      line = reader.line_num
+    role = ROLES.get(values.get('role', '').lower())
+    if not role:
+      family.setdefault('errors', []).append(
+        'line %d: missing role' % (reader.line_num) if not values.get('role')
+        else 'line %d: unknown role %r' % (reader.line_num, values['role']))
+      continue
+    person = {}
+    for field in CSV_COLUMNS[2:]:
+      value = values.get(field, '')
+      if field in REPEATED_FIELDS:
+        value = [v.strip() for v in value.split(';') if v.strip()]
+      if value:
+        person[field] = value
+    family[role].append(person)
+  if family:
+    yield line, family
+
+
+def _ParseJsonl(roster):
+  """Yields (line, family) from a roster with one JSON family per line."""
+  for line, text in enumerate(roster, 1):
+    if not text.strip():
+      continue
+    try:
+      family = json.loads(text)
+    except ValueError as e:
+      yield line, {'errors': ['line %d: %s' % (line, e)]}
+      continue
+    if not isinstance(family, dict):
+      yield line, {'errors': ['line %d: expected an object' % (line)]}
+      continue
+    yield line, {'parents': family.get('parents') or [],
+                 'children': family.get('children') or []}
+
+
+def ParseRoster(roster, fmt):
+  """Parses roster lazily, never holding more than one family.
+
+  Args:
+    roster: (file) The upload.
+    fmt: (str) One of FORMATS.
+  Returns:
+    generator: (line, family) pairs. A family is a dict of parents and
+      children lists of PersonMessage-shaped dicts, plus the errors found
+      while parsing it.
+  """
+  if fmt == 'csv':
+    return _ParseCsv(roster)
+  return _ParseJsonl(roster)
+
+
+def _Chunks(families, size):
+  chunk = []
+  for item in families:
+    chunk.append(item)
+    if len(chunk) >= size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+
+def StartImport(school, roster, fmt):
+  """Parses roster into chunks and queues a worker for each.
+
+  Args:
+    school: (School) The school the roster belongs to.
+    roster: (file) The upload.
+    fmt: (str) One of FORMATS.
+  Returns:
+    ImportJob: The job to poll with GetStatus.
+  """
+  if fmt not in FORMATS:
+    raise RosterError('Unknown roster format: %s' % (fmt))
+  job = ImportJob(school=school.key, format=fmt)
+  job.put()
+  queue = taskqueue.Queue(QUEUE_NAME)
+  tasks = []
+  errors = []
+  try:
+    families = ParseRoster(roster, fmt)
+    for index, chunk in enumerate(_Chunks(families, CHUNK_SIZE)):
+      job.chunks_total += 1
+      job.families_total += len(chunk)
+      payload = {'job': job.key.urlsafe(), 'chunk': index,
+                 'families': chunk}
+      tasks.append(taskqueue.Task(
+        url=CHUNK_URL, payload=json.dumps(payload),
+        name='import-%s-%d' % (job.key.id(), index)))
+      if len(tasks) >= ENQUEUE_BATCH:
+        queue.add(tasks)
+        tasks = []
+  except (RosterError, csv.Error, UnicodeDecodeError) as e:
+    errors.append(str(e))
+  if tasks:
+    queue.add(tasks)
+  job.errors = errors
+  job.state = 'queued'
+  job.put()
+  logging.info('Queued import %s: %d families in %d chunks',
+               job.key.id(), job.families_total, job.chunks_total)
+  return job
+
+
+def _PersonMessage(values):
+  """The PersonMessage of values, a person's roster columns."""
+  msg = datamodel_lib.PersonMessage()
+  for field in CSV_COLUMNS[2:]:
+    value = values.get(field)
+    if value:
+      setattr(msg, field, value)
+  if not (msg.first_name or msg.last_name):
+    raise RosterError('person without a name')
+  return msg
+
+
+def _People(families, job):
+  """The Persons of families, read with one get_multi and updated in place.
+
+  Args:
+    families: (list) (Record key, parent messages, child messages, Person
+      keys) of each family, keys in parents then children order.
+    job: (ImportJob) The job importing families.
+  Returns:
+    (dict, list): Person key -> the Person to put, and the keys of the
+      existing Persons whose PersonSummary changes.
+  """
+  keys = list(set(k for family in families for k in family[3]))
+  people = dict((k, p) for k, p in zip(keys, ndb.get_multi(keys)) if p)
+  before = dict((k, datamodel_lib.PersonSummary.FromPerson(p))
+                for k, p in people.iteritems())
+  for _, parents, children, person_keys in families:
+    for msg, key in zip(parents + children, person_keys):
+      # A Person named by two families of the chunk is updated once per
+      # family, in roster order.
+      person = people.setdefault(key, datamodel_lib.Person(
+        key=key, created_by=job.created_by))
+      datamodel_lib.Person.ApplyMessage(person, msg)
+      if job.school not in person.schools:
+        person.schools.append(job.school)
+  changed = [k for k, summary in before.iteritems()
+             if summary != datamodel_lib.PersonSummary.FromPerson(people[k])]
+  return people, changed
+
+
+def _RecordKey(school, members, identities):
+  """The Record key of a family, the same in every roster of school.
+
+  Args:
+    school: (ndb.Key) The School.
+    members: (list) The PersonMessages of the parents and children.
+    identities: (list) Their FamilyIdentityKeys.
+  Returns:
+    ndb.Key: Derived from the identities, or the names of members
+      without one.
+  """
+  tokens = sorted(
+    identity.id() if identity else u'name:%s %s' % (
+      (msg.first_name or '').lower(), (msg.last_name or '').lower())
+    for msg, identity in zip(members, identities))
+  digest = hashlib.sha1(u'\n'.join(tokens).encode('utf-8')).hexdigest()
+  return ndb.Key(datamodel_lib.Record, '%s/%s/roster:%s' % (
+    school.parent().id(), school.id(), digest))
+
+
+def ImportChunk(payload):
+  """Writes one chunk of families with a single put_multi.
+
+  Record keys derive from the school and the family's members (see
+  _RecordKey), Person keys from the person's identity
+  (datamodel_lib.FamilyIdentityKeys) or else the Record key, so a retried
+  task rewrites what an earlier attempt wrote rather than duplicating it,
+  and a reimported roster updates the Records and Persons it named.
+  Existing Records and Persons are read and updated, so what the roster
+  leaves out of a Person, other schools included, is kept.
+
+  Args:
+    payload: (dict) As queued by StartImport.
+  Returns:
+    ImportChunkResult: The outcome, also stored under the job.
+  """
+  job = ndb.Key(urlsafe=payload['job']).get()
+  # Integer ids start at 1.
+  result_key = ndb.Key(ImportChunkResult, payload['chunk'] + 1,
+                       parent=job.key)
+  result = result_key.get()
+  if result:
+    return result  # Already imported by an earlier attempt.
+  result = ImportChunkResult(key=result_key)
+  families = []
+  for line, family in payload['families']:
+    result.errors.extend(family.get('errors', []))
+    try:
+      parents = [_PersonMessage(p) for p in family.get('parents', [])]
+      children = [_PersonMessage(c) for c in family.get('children', [])]
+    except (RosterError, AttributeError, TypeError,
+            messages.ValidationError) as e:
+      result.errors.append('line %d: %s' % (line, e))
+      continue
+    if not (parents or children):
+      continue
+    identities = datamodel_lib.FamilyIdentityKeys(job.school,
+                                                  parents + children)
+    record_key = _RecordKey(job.school, parents + children, identities)
+    name = record_key.id()
+    own_keys = ([ndb.Key(datamodel_lib.Person, '%s-p%d' % (name, i))
+                 for i in xrange(len(parents))] +
+                [ndb.Key(datamodel_lib.Person, '%s-c%d' % (name, i))
+                 for i in xrange(len(children))])
+    families.append((record_key, parents, children,
+                     [i or k for i, k in zip(identities, own_keys)]))
+  # Both gets go out together.
+  records_future = ndb.get_multi_async(
+    list(set(family[0] for family in families)))
+  people, changed_people = _People(families, job)
+  records = dict((r.key, r) for r in
+                 [f.get_result() for f in records_future] if r)
+  entities = people.values()
+  deltas = stats.Deltas()
+  for record in records.itervalues():
+    deltas.Add(record.school, len(record.parents), len(record.children),
+               sign=-1)
+  for record_key, parents, children, person_keys in families:
+    # A family listed twice in the chunk is one Record, the last one wins.
+    record = records.setdefault(record_key, datamodel_lib.Record(
+      key=record_key, school=job.school, created_by=job.created_by))
+    record.school = job.school
+    datamodel_lib.Record.SetPeople(
+      record, [people[k] for k in person_keys[:len(parents)]],
+      [people[k] for k in person_keys[len(parents):]])
+    result.imported += 1
+  for record in records.itervalues():
+    deltas.Add(record.school, len(record.parents), len(record.children))
+  entities.extend(records.itervalues())
+  # Of two attempts, the counts of the one that wrote first are kept.
+  deltas = stats.Deltas.FromDict(ImportChunkDeltas.get_or_insert(
+    '%s-%d' % (job.key.id(), payload['chunk']),
+    deltas=deltas.ToDict()).deltas)
+  ndb.put_multi(entities)
+  datamodel_lib.BumpSchoolVersion(*deltas.Schools())
+  person_fanout.EnqueueRefresh(changed_people)
+  result.errors = result.errors[:MAX_ERRORS]
+  groups = set([job.key])
+  for school in deltas.Schools():
+    groups |= stats.Groups(school)
+  def _Finish():
+    # Checked again with the counts, so of two attempts racing to finish
+    # only one counts the chunk.
+    if not result_key.get():
+      result.put()
+      stats.ApplyAsync(deltas).get_result()
+  txn.Run(_Finish, groups=len(groups))
+  return result
+
+
+def GetStatus(job_id):
+  """Returns the ImportStatusMessage of job_id.
+
+  Raises:
+    endpoints.NotFoundException: When there is no such job.
+    endpoints.ForbiddenException: When the caller may not read its school.
+  """
+  try:
+    job = ndb.Key(urlsafe=job_id).get()
+  except Exception:  # Malformed urlsafe keys raise a grab bag of errors.
+    job = None
+  if not isinstance(job, ImportJob):
+    raise endpoints.NotFoundException('No such import.')
+  # Its errors quote the roster.
+  datamodel_lib.CheckSchoolAccess(job.school)
+  return ImportJob.ToMessage(job)
+
+
+def _RosterFormat(request, upload):
+  fmt = request.get('format')
+  if fmt:
+    return fmt.lower()
+  filename = getattr(upload, 'filename', '') or ''
+  if filename.endswith('.jsonl') or filename.endswith('.json'):
+    return 'jsonl'
+  if 'json' in request.content_type:
+    return 'jsonl'
+  return 'csv'
+
+
+class RosterUploadHandler(webapp2.RequestHandler):
+  """POST /import/roster?district=&school=[&format=csv|jsonl].
+
+  The roster is the request body, or the 'roster' field of a multipart
+  form.
+  """
+
+  def post(self):
+    if not (self.request.get('district') and self.request.get('school')):
+      self.abort(400, detail='district and school are required.')
+    upload = self.request.POST.get('roster')
+    roster = upload.file if hasattr(upload, 'file') else self.request.body_file
+    try:
+      # Not an Endpoints request: authenticated by hand.
+      with oauth.RequestPrincipal(datamodel_lib.User,
+                                  oauth.GetRouteUser) as principal:
+        if not principal.user:
+          raise endpoints.UnauthorizedException('Sign in first.')
+        school = datamodel_lib.School.FromMessage(
+          datamodel_lib.SchoolMessage(district=self.request.get('district'),
+                                      name=self.request.get('school')))
+        job = StartImport(school, roster, _RosterFormat(self.request, upload))
+    except endpoints.UnauthorizedException:
+      self.abort(401, headers={'WWW-Authenticate': 'Bearer'})
+    except (ValueError, messages.ValidationError) as e:
+      self.abort(400, detail=str(e))
+    self.response.content_type = 'application/json'
+    self.response.write(json.dumps({'job_id': job.key.urlsafe()}))
+
+
+class ImportChunkHandler(webapp2.RequestHandler):
+  """Task queue worker for one chunk."""
+
+  def post(self):
+    result = ImportChunk(json.loads(self.request.body))
+    logging.info('Imported %d families, %d errors',
+                 result.imported, len(result.errors))
@@ -0,0 +1,229 @@
+# Description:
+#   unittests for roster_import.py
+
+import endpoints
+import json
+import StringIO
+import unittest
+
+import webapp2
+from google.appengine.api import users
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import datamodel_lib
+import main
+import roster_import
+import stats
+import test_lib
+
+
+CSV_ROSTER = """family,role,first_name,last_name,phone_numbers,email_addresses
+1,parent,Ann,Smith,555-0100,ann@example.com
+1,parent,Bob,Smith,,bob@example.com;bob@work.com
+1,child,Cal,Smith,,
+2,parent,Dee,Jones,555-0101,
+2,teacher,Eve,Jones,,
+2,child,,,,
+"""
+
+JSONL_ROSTER = '\n'.join([
+  json.dumps({'parents': [{'first_name': 'Fay', 'last_name': 'Lee'}],
+              'children': [{'first_name': 'Gus', 'last_name': 'Lee'}]}),
+  '',
+  'not json',
+  json.dumps({'parents': [{'first_name': 'Hal', 'last_name': 'Kim'}]})])
+
+
+def _Upload(url, roster):
+  request = webapp2.Request.blank(url)
+  request.method = 'POST'
+  request.content_type = 'text/csv'
+  request.body = roster
+  return request.get_response(main.app)
+
+
+class RosterImportTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = test_lib.Activate(taskqueue=True)
+    self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.AddSuperUser()
+    self.school = datamodel_lib.School(
+      id='test', parent=ndb.Key(datamodel_lib.District, 'test.org'))
+    self.school.put()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def _RunTasks(self):
+    tasks = self.taskqueue.get_filtered_tasks(
+      queue_names=[roster_import.QUEUE_NAME])
+    for task in tasks:
+      roster_import.ImportChunk(json.loads(task.payload))
+    return len(tasks)
+
+  def testCsvImport(self):
+    job = roster_import.StartImport(
+      self.school, StringIO.StringIO(CSV_ROSTER), 'csv')
+    status = roster_import.GetStatus(job.key.urlsafe())
+    self.assertEquals('queued', status.state)
+    self.assertEquals(2, status.families_total)
+    self.assertEquals(1, self._RunTasks())
+    status = roster_import.GetStatus(job.key.urlsafe())
+    self.assertEquals('done', status.state)
+    self.assertEquals(1, status.families_imported)
+    self.assertEquals(2, len(status.errors))
+    records = datamodel_lib.Record.query().fetch()
+    self.assertEquals(1, len(records))
+    msg = datamodel_lib.Record.ToMessage(records[0])
+    self.assertEquals(['Ann', 'Bob'], [p.first_name for p in msg.parents])
+    self.assertEquals(['bob@example.com', 'bob@work.com'],
+                      msg.parents[1].email_addresses)
+    self.assertEquals(['Cal'], [c.first_name for c in msg.children])
+
+  def testJsonlImportInChunks(self):
+    roster_import.CHUNK_SIZE, chunk_size = 1, roster_import.CHUNK_SIZE
+    try:
+      job = roster_import.StartImport(
+        self.school, StringIO.StringIO(JSONL_ROSTER), 'jsonl')
+    finally:
+      roster_import.CHUNK_SIZE = chunk_size
+    self.assertEquals(3, self._RunTasks())
+    status = roster_import.GetStatus(job.key.urlsafe())
+    self.assertEquals('done', status.state)
+    self.assertEquals(3, status.chunks_done)
+    self.assertEquals(2, status.families_imported)
+    self.assertEquals(1, len(status.errors))
+    self.assertEquals(2, datamodel_lib.Record.query().count())
+
+  def testRetriedChunkDoesNotDuplicate(self):
+    roster_import.StartImport(
+      self.school, StringIO.StringIO(CSV_ROSTER), 'csv')
+    tasks = self.taskqueue.get_filtered_tasks(
+      queue_names=[roster_import.QUEUE_NAME])
+    payload = json.loads(tasks[0].payload)
+    roster_import.ImportChunk(payload)
+    ndb.Key(roster_import.ImportChunkResult, 1,
+            parent=ndb.Key(urlsafe=payload['job'])).delete()
+    roster_import.ImportChunk(payload)
+    self.assertEquals(1, datamodel_lib.Record.query().count())
+    self.assertEquals(3, datamodel_lib.Person.query().count())
+
+  def testRetriedChunkCountsOnce(self):
+    roster_import.StartImport(
+      self.school, StringIO.StringIO(CSV_ROSTER), 'csv')
+    tasks = self.taskqueue.get_filtered_tasks(
+      queue_names=[roster_import.QUEUE_NAME])
+    payload = json.loads(tasks[0].payload)
+    for _ in xrange(2):
+      roster_import.ImportChunk(payload)
+    msg = stats.SchoolStats(self.school.key)
+    self.assertEquals((1, 1, 2), (msg.families, msg.students, msg.parents))
+
+  def testReimportUpdatesFamilies(self):
+    for _ in xrange(2):
+      roster_import.StartImport(
+        self.school, StringIO.StringIO(CSV_ROSTER), 'csv')
+    self.assertEquals(2, self._RunTasks())
+    self.assertEquals(1, datamodel_lib.Record.query().count())
+    # Cal has nothing to key on but his family.
+    names = sorted(p.first_name for p in datamodel_lib.Person.query())
+    self.assertEquals(['Ann', 'Bob', 'Cal'], names)
+    msg = stats.SchoolStats(self.school.key)
+    self.assertEquals((1, 1, 2), (msg.families, msg.students, msg.parents))
+
+  def testRetryAfterWritesCountsOnce(self):
+    roster_import.StartImport(
+      self.school, StringIO.StringIO(CSV_ROSTER), 'csv')
+    tasks = self.taskqueue.get_filtered_tasks(
+      queue_names=[roster_import.QUEUE_NAME])
+    payload = json.loads(tasks[0].payload)
+    # The first attempt dies between writing the Records and counting them.
+    def _Fail(fn, groups=None):
+      raise RuntimeError('instance went away')
+    run, roster_import.txn.Run = roster_import.txn.Run, _Fail
+    try:
+      self.assertRaises(RuntimeError, roster_import.ImportChunk, payload)
+    finally:
+      roster_import.txn.Run = run
+    self.assertEquals(1, datamodel_lib.Record.query().count())
+    roster_import.ImportChunk(payload)
+    msg = stats.SchoolStats(self.school.key)
+    self.assertEquals((1, 1, 2), (msg.families, msg.students, msg.parents))
+
+  def testReimportUpdatesInPlace(self):
+    other = ndb.Key(datamodel_lib.District, 'test.org',
+                    datamodel_lib.School, 'other')
+    ann = datamodel_lib.IdentityKey(self.school.key, ['ann@example.com'], [])
+    datamodel_lib.Person(
+      key=ann, first_name='Ann', addresses=['1 Main St'], schools=[other],
+      created_by=users.User('first@parentd.com')).put()
+    roster_import.StartImport(
+      self.school, StringIO.StringIO(CSV_ROSTER), 'csv')
+    self._RunTasks()
+    person = ann.get()
+    self.assertEquals('Smith', person.last_name)
+    self.assertEquals(['1 Main St'], person.addresses)
+    self.assertEquals([other, self.school.key], person.schools)
+    self.assertEquals('first@parentd.com', person.created_by.email())
+
+  def testFamilySharingContactStaysApart(self):
+    job = roster_import.StartImport(self.school, StringIO.StringIO(
+      'family,role,first_name,phone_numbers\n'
+      '1,parent,Ann,555-0100\n'
+      '1,child,Cal,555-0100\n'
+      '2,parent,Ann,555-0100\n'), 'csv')
+    self._RunTasks()
+    self.assertEquals(2, roster_import.GetStatus(
+      job.key.urlsafe()).families_imported)
+    records = datamodel_lib.Record.query().fetch()
+    keys = [k for r in records for k in r.parents + r.children]
+    # Ann is one Person in both families, Cal one of his own.
+    self.assertEquals(3, len(keys))
+    self.assertEquals(2, len(set(keys)))
+    self.assertEquals(['Ann', 'Cal'],
+                      sorted(p.first_name for p in ndb.get_multi(set(keys))))
+
+  def testMissingColumns(self):
+    job = roster_import.StartImport(
+      self.school, StringIO.StringIO('first_name,last_name\n'), 'csv')
+    status = roster_import.GetStatus(job.key.urlsafe())
+    self.assertEquals('done', status.state)
+    self.assertEquals(0, status.chunks_total)
+    self.assertEquals(1, len(status.errors))
+
+  def testShortRows(self):
+    job = roster_import.StartImport(
+      self.school, StringIO.StringIO(
+        'family,role,first_name\n1,parent,Ann\n2\n\n3,\n'), 'csv')
+    self._RunTasks()
+    status = roster_import.GetStatus(job.key.urlsafe())
+    self.assertEquals(1, status.families_imported)
+    self.assertEquals(['line 3: missing role', 'line 5: missing role'],
+                      status.errors)
+
+  def testStatusNeedsSchoolAccess(self):
+    job = roster_import.StartImport(
+      self.school, StringIO.StringIO(CSV_ROSTER), 'csv')
+    test_lib.SetUser(self.testbed, 'joe@parentd.com', '1234')
+    self.assertRaises(endpoints.ForbiddenException,
+                      roster_import.GetStatus, job.key.urlsafe())
+
+  def testUploadHandler(self):
+    url = '/import/roster?district=test.org&school=test&format=csv'
+    # Uploads are no Endpoints requests.
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888',
+                     endpoints=False)
+    response = _Upload(url, CSV_ROSTER)
+    self.assertEquals(200, response.status_int)
+    job_id = json.loads(response.body)['job_id']
+    self.assertEquals(2, roster_import.GetStatus(job_id).families_total)
+    test_lib.SetAnonymous(self.testbed)
+    response = _Upload(url, CSV_ROSTER)
+    self.assertEquals(401, response.status_int)
+
+
+if __name__ == '__main__':
+  unittest.main()
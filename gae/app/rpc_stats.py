@@ -0,0 +1,84 @@
+# Description:
+#   Counts the API RPCs (datastore, memcache, ...) made on a thread.
+
+import collections
+import threading
+
+from google.appengine.api import apiproxy_stub_map
+
+
+_HOOK_NAME = 'parentd_rpc_stats'
+_local = threading.local()
+_install_lock = threading.Lock()
+_installed_on = []  # The apiproxy the hook is on; testbed swaps it.
+
+# Keys outside of the 'service.Call' namespace, so Total skips them.
+MEMCACHE_HITS = 'memcache:hits'
+MEMCACHE_MISSES = 'memcache:misses'
+# Counted by txn.Run.
+TXN_CONFLICTS = 'txn:conflicts'
+TXN_RETRIES = 'txn:retries'
+
+
+def _PreCallHook(service, call, request, response):
+  for counts in getattr(_local, 'active', ()):
+    counts['%s.%s' % (service, call)] += 1
+
+
+def _PostCallHook(service, call, request, response):
+  if service != 'memcache' or call != 'Get':
+    return
+  hits = response.item_size()
+  for counts in getattr(_local, 'active', ()):
+    counts[MEMCACHE_HITS] += hits
+    counts[MEMCACHE_MISSES] += request.key_size() - hits
+
+
+def Increment(name, delta=1):
+  """Adds delta to name in every active RpcCounter of this thread."""
+  for counts in getattr(_local, 'active', ()):
+    counts[name] += delta
+
+
+def Install():
+  """Hooks the current apiproxy. Safe to call on every request."""
+  proxy = apiproxy_stub_map.apiproxy
+  if _installed_on and _installed_on[0] is proxy:
+    return
+  with _install_lock:
+    if _installed_on and _installed_on[0] is proxy:
+      return
+    proxy.GetPreCallHooks().Append(_HOOK_NAME, _PreCallHook)
+    proxy.GetPostCallHooks().Append(_HOOK_NAME, _PostCallHook)
+    _installed_on[:] = [proxy]
+
+
+class RpcCounter(object):
+  """Counts the RPCs made on this thread while active.
+
+    with rpc_stats.RpcCounter() as counter:
+      datamodel_lib.Record.ToMessage(record)
+    counter.Total('datastore_v3')
+
+  Attributes:
+    counts: (Counter) 'service.Call' -> number of RPCs, plus the memcache
+      hits and misses and anything passed to Increment.
+  """
+
+  def __init__(self):
+    self.counts = collections.Counter()
+
+  def __enter__(self):
+    Install()
+    if not hasattr(_local, 'active'):
+      _local.active = []
+    _local.active.append(self.counts)
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    _local.active.remove(self.counts)
+
+  def Total(self, service):
+    """The number of RPCs made to service, e.g. 'datastore_v3'."""
+    prefix = service + '.'
+    return sum(n for k, n in self.counts.items() if k.startswith(prefix))
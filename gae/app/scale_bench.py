@@ -0,0 +1,251 @@
+# Description:
+#   Scale benchmarks for datamodel_lib and services.py.
+#
+#   Generates a synthetic tenant, then times every FromMessage/ToMessage,
+#   collection builder and service method and counts its datastore RPCs.
+#   An operation fails when it goes over its entry in RPC_BUDGETS. Run
+#   with:
+#     pytester.py --TEST_DIR=. --PATTERN='*_bench.py'
+#   PARENTD_BENCH_SCALES picks the tenant sizes, in families; the default
+#   only runs 1000 since the stubs keep everything in memory.
+
+import logging
+import os
+import time
+import unittest
+
+from google.appengine.ext import ndb
+
+import datamodel_lib
+import oauth
+import paging
+import rpc_stats
+import services
+import test_lib
+
+
+SCALES = [int(s) for s in
+          os.environ.get('PARENTD_BENCH_SCALES', '1000').split(',')]
+FAMILIES_PER_SCHOOL = 500
+SCHOOLS_PER_DISTRICT = 20
+PAGE_SIZE = 100
+PUT_BATCH = 500
+
+# Datastore RPC ceilings, per operation, at any scale. Lower one when an
+# optimization lands; raising one needs a reason in the commit.
+RPC_BUDGETS = {
+  'District.FromMessage': 1,
+  'District.ListPage': 2,
+  'School.FromMessage': 1,
+  'School.ListPage': 2,
+  'Person.FromMessage': 1,
+  'Person.ToMessage': 0,
+  'Record.FromMessage': 5,
+  'Record.ToMessage': 1,
+  'Record.ListPage': 3,
+  'DistrictCollectionMessageFromKeys': 0,
+  'SchoolCollectionMessageFromKeys': 0,
+  'RecordCollectionMessageFromRecord': 1,
+  'RecordCollectionMessageFromSummaries': 0,
+  'RecordCollectionMessageFromSnapshots': 0,
+  'DistrictService.DistrictList': 2,
+  'DistrictService.DistrictAdd': 6,
+  'SchoolService.SchoolList': 2,
+  'SchoolService.SchoolAdd': 6,
+  'RecordService.RecordList': 5,
+  'RecordService.RecordList.snapshot': 4,
+  'RecordService.RecordList.summary': 4,
+  'RecordService.RecordList.ids': 3,
+  'RecordService.RecordAdd': 9,
+  'SchoolService.SchoolStats': 1,
+  'DistrictService.DistrictStats': 1,
+  'PersonService.PersonSearch': 4,
+}
+
+
+def _PutInBatches(entities):
+  for i in xrange(0, len(entities), PUT_BATCH):
+    ndb.put_multi(entities[i:i + PUT_BATCH])
+
+
+def GenerateTenant(families):
+  """Writes families Records (two parents, one child each).
+
+  Returns:
+    list: The School keys, in order.
+  """
+  schools = []
+  num_schools = max(1, families // FAMILIES_PER_SCHOOL)
+  for i in xrange(num_schools):
+    district = ndb.Key(datamodel_lib.District,
+                       'district-%d.org' % (i // SCHOOLS_PER_DISTRICT))
+    schools.append(ndb.Key(datamodel_lib.School, 'school-%d' % (i),
+                           parent=district))
+  _PutInBatches([datamodel_lib.District(key=k) for k in
+                 set(s.parent() for s in schools)])
+  _PutInBatches([datamodel_lib.School(key=k) for k in schools])
+  batch = []
+  for i in xrange(families):
+    school = schools[i % num_schools]
+    last_name = 'family%d' % (i)
+    people = [datamodel_lib.Person(
+                id='%s-%s' % (first, last_name),
+                first_name=first, last_name=last_name, schools=[school],
+                email_addresses=['%s.%s@example.com' % (first, last_name)],
+                phone_numbers=['555-%07d' % (i)])
+              for first in ('mom', 'dad', 'kid')]
+    batch.extend(people)
+    record = datamodel_lib.Record(school=school)
+    datamodel_lib.Record.SetPeople(record, people[:2], people[2:])
+    batch.append(record)
+    if len(batch) >= PUT_BATCH:
+      _PutInBatches(batch)
+      batch = []
+  _PutInBatches(batch)
+  return schools
+
+
+class ScaleBenchmark(unittest.TestCase):
+  """Runs every operation at each of SCALES."""
+
+  def setUp(self):
+    self.results = []
+    self.over_budget = []
+
+  def tearDown(self):
+    for name, families, seconds, rpcs in self.results:
+      logging.info('%-40s %7d families %9.2fms %3d datastore RPCs',
+                   name, families, seconds * 1000, rpcs)
+
+  def _Activate(self):
+    self.testbed = test_lib.Activate(taskqueue=True)
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.AddSuperUser()
+    # Build the admin's UserAcl and load it into memcache, as the requests
+    # before these would have.
+    oauth.IsSuperUser(datamodel_lib.User)
+    ndb.get_context().clear_cache()
+    datamodel_lib.UserAcl.get_by_id('8888')
+
+  def _Measure(self, name, families, fn, *args, **kwargs):
+    # Start cold: nothing from the in-context cache of earlier calls.
+    ndb.get_context().clear_cache()
+    with rpc_stats.RpcCounter() as counter:
+      start = time.time()
+      result = fn(*args, **kwargs)
+      seconds = time.time() - start
+    rpcs = counter.Total('datastore_v3')
+    self.results.append((name, families, seconds, rpcs))
+    if rpcs > RPC_BUDGETS[name]:
+      self.over_budget.append('%s at %d families: %d datastore RPCs, '
+                              'budget %d' % (name, families, rpcs,
+                                             RPC_BUDGETS[name]))
+    return result
+
+  def _RunScale(self, families):
+    schools = GenerateTenant(families)
+    school = schools[0]
+    school_msg = datamodel_lib.School.KeyToMessage(school)
+    measure = lambda name, fn, *a, **kw: self._Measure(
+      name, families, fn, *a, **kw)
+
+    # Datamodel.
+    measure('District.FromMessage', datamodel_lib.District.FromMessage,
+            datamodel_lib.DistrictMessage(domain=school.parent().id()))
+    measure('School.FromMessage', datamodel_lib.School.FromMessage,
+            school_msg)
+    keys, _ = measure('District.ListPage', datamodel_lib.District.ListPage,
+                      PAGE_SIZE)
+    measure('DistrictCollectionMessageFromKeys',
+            datamodel_lib.DistrictCollectionMessageFromKeys, keys)
+    keys, _ = measure('School.ListPage', datamodel_lib.School.ListPage,
+                      PAGE_SIZE)
+    measure('SchoolCollectionMessageFromKeys',
+            datamodel_lib.SchoolCollectionMessageFromKeys, keys)
+    person = measure(
+      'Person.FromMessage', datamodel_lib.Person.FromMessage,
+      datamodel_lib.PersonMessage(first_name='new', last_name='person'),
+      school=school)
+    measure('Person.ToMessage', datamodel_lib.Person.ToMessage, person)
+    record = measure(
+      'Record.FromMessage', datamodel_lib.Record.FromMessage,
+      datamodel_lib.RecordMessage(
+        school=school_msg,
+        parents=[datamodel_lib.PersonMessage(first_name='mom'),
+                 datamodel_lib.PersonMessage(first_name='dad')],
+        children=[datamodel_lib.PersonMessage(first_name='kid')]))
+    measure('Record.ToMessage', datamodel_lib.Record.ToMessage, record)
+    records, _ = measure('Record.ListPage', datamodel_lib.Record.ListPage,
+                         school, PAGE_SIZE)
+    measure('RecordCollectionMessageFromRecord',
+            datamodel_lib.RecordCollectionMessageFromRecord, records)
+    measure('RecordCollectionMessageFromSnapshots',
+            datamodel_lib.RecordCollectionMessageFromSnapshots, records)
+    summaries = datamodel_lib.Record.All(school).fetch(
+      PAGE_SIZE, projection=datamodel_lib.Record.SUMMARY_PROJECTION)
+    measure('RecordCollectionMessageFromSummaries',
+            datamodel_lib.RecordCollectionMessageFromSummaries,
+            summaries, school)
+
+    # Services.
+    page = paging.PageResource.combined_message_class
+    measure('DistrictService.DistrictList',
+            services.DistrictService().DistrictList, page(page_size=PAGE_SIZE))
+    measure('DistrictService.DistrictAdd',
+            services.DistrictService().DistrictAdd,
+            datamodel_lib.DistrictMessage(domain='bench.org'))
+    measure('SchoolService.SchoolList',
+            services.SchoolService().SchoolList, page(page_size=PAGE_SIZE))
+    measure('SchoolService.SchoolAdd', services.SchoolService().SchoolAdd,
+            datamodel_lib.SchoolMessage(district='bench.org', name='bench'))
+    record_list = services.RecordService.RecordListResource
+    record_list = record_list.combined_message_class
+    measure('RecordService.RecordList', services.RecordService().RecordList,
+            record_list(district=school.parent().id(), school=school.id(),
+                        page_size=PAGE_SIZE))
+    measure('RecordService.RecordList.snapshot',
+            services.RecordService().RecordList,
+            record_list(district=school.parent().id(), school=school.id(),
+                        page_size=PAGE_SIZE, view='snapshot'))
+    measure('RecordService.RecordList.summary',
+            services.RecordService().RecordList,
+            record_list(district=school.parent().id(), school=school.id(),
+                        page_size=PAGE_SIZE, view='summary'))
+    measure('RecordService.RecordList.ids',
+            services.RecordService().RecordList,
+            record_list(district=school.parent().id(), school=school.id(),
+                        page_size=PAGE_SIZE, fields='id'))
+    measure('RecordService.RecordAdd', services.RecordService().RecordAdd,
+            datamodel_lib.RecordMessage(
+              school=school_msg,
+              parents=[datamodel_lib.PersonMessage(first_name='mom')],
+              children=[datamodel_lib.PersonMessage(first_name='kid')]))
+    school_stats = services.SchoolService.SchoolStatsResource
+    measure('SchoolService.SchoolStats', services.SchoolService().SchoolStats,
+            school_stats.combined_message_class(
+              district=school.parent().id(), school=school.id()))
+    district_stats = services.DistrictService.DistrictStatsResource
+    measure('DistrictService.DistrictStats',
+            services.DistrictService().DistrictStats,
+            district_stats.combined_message_class(
+              district=school.parent().id()))
+    search = services.PersonService.PersonSearchResource
+    measure('PersonService.PersonSearch',
+            services.PersonService().PersonSearch,
+            search.combined_message_class(
+              district=school.parent().id(), school=school.id(),
+              q='family1', page_size=PAGE_SIZE))
+
+  def testScales(self):
+    for families in SCALES:
+      self._Activate()
+      try:
+        self._RunScale(families)
+      finally:
+        self.testbed.deactivate()
+    self.assertEquals([], self.over_budget)
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
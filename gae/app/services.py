@@ -2,21 +2,60 @@
 #   Endpoints interface for the parentd app.
 
 import endpoints
+import functools
 import logging
 
-from apiclient.discovery import build
-from google.appengine.api import users
-# from protorpc import messages
-# from protorpc import message_types
-# from protorpc import remote
+from google.appengine.ext import ndb
+from protorpc import messages
+from protorpc import message_types
+from protorpc import remote
 
+import batch
 import datamodel_lib
+import directory_export
+import fieldmask
+import metrics
+import oauth
+import paging
+import person_fanout
+import roster_import
+import stats
+import sync
+import txn
 
 # TODO(renwick): Might need to pass around district for all commands.
 
-U = '884138883203.apps.googleusercontent.com'
+U = oauth.WEB_CLIENT_ID
 ANDROID_AUDIENCE = WEB_CLIENT_ID = U
 
+def _WithPrincipal(method):
+  """Resolves the caller once, the datamodel reads it for the request."""
+  @functools.wraps(method)
+  def _Wrapper(self, request):
+    with oauth.RequestPrincipal(datamodel_lib.User):
+      return method(self, request)
+  return _Wrapper
+
+
+def _NotModified(service, etag):
+  """Whether the request's If-None-Match has etag.
+
+  Endpoints can't send a 304, so the list methods answer a current
+  If-None-Match with an empty collection that has not_modified set.
+
+  Args:
+    service: (remote.Service) The service serving the request.
+    etag: (str) The ETag of the response about to be built.
+  """
+  # Unset when a method is called directly, as the tests and benchmarks do.
+  request_state = getattr(service, 'request_state', None)
+  header = request_state and request_state.headers.get('If-None-Match')
+  if not header:
+    return False
+  return (header.strip() == '*' or
+          etag in [t.strip() for t in header.split(',')])
+
+
 parentd_api = endpoints.api(
   name='parentd', version='v1.0',
   allowed_client_ids=[WEB_CLIENT_ID, endpoints.API_EXPLORER_CLIENT_ID],
@@ -24,80 +63,402 @@ parentd_api = endpoints.api(
 
 @parentd_api.api_class(resource_name='district')
 class DistrictService(remote.Service):
-  @endpoints.method(message_types.VoidMessage,
+  @endpoints.method(paging.PageResource,
                     datamodel_lib.DistrictCollectionMessage,
                     path='district/list', http_method='GET', name='list')
-  def DistrictList(self, unused_request):
-    q = datamodel_lib.District.All()
-    districts = q.fetch()
-    return DistrictCollectionMessageFromDistrict(districts)
+  @_WithPrincipal
+  def DistrictList(self, request):
+    etag = datamodel_lib.ListEtag(datamodel_lib.District._get_kind(),
+                                  request.page_size, request.page_token)
+    if _NotModified(self, etag):
+      return datamodel_lib.DistrictCollectionMessage(etag=etag, not_modified=True)
+    keys, next_page_token = datamodel_lib.District.ListPage(
+      request.page_size, request.page_token)
+    msg = datamodel_lib.DistrictCollectionMessageFromKeys(
+      keys, next_page_token=next_page_token)
+    msg.etag = etag
+    return msg
 
   @endpoints.method(datamodel_lib.DistrictMessage, datamodel_lib.DistrictMessage,
                     path='district/add', http_method='POST', name='add')
+  @_WithPrincipal
   def DistrictAdd(self, request):
     def _AddTransaction():
       return datamodel_lib.District.FromMessage(request)
     logging.info('Adding district: %s' % (request))
-    obj = ndb.transaction(_AddTransaction, xg=True)
+    obj = txn.Run(_AddTransaction, groups=1)
     return datamodel_lib.District.ToMessage(obj)
 
+  DistrictStatsResource = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    district=messages.StringField(1, required=True))
+
+  @endpoints.method(DistrictStatsResource, stats.StatsMessage,
+                    path='district/stats/{district}', http_method='GET',
+                    name='stats')
+  @_WithPrincipal
+  def DistrictStats(self, request):
+    oauth.ValidateUser(None, None)
+    if not oauth.IsSuperUser(datamodel_lib.User):
+      raise endpoints.ForbiddenException('Not Allowed.')
+    return stats.DistrictStats(request.district)
+
 
 @parentd_api.api_class(resource_name='school')
 class SchoolService(remote.Service):
-  @endpoints.method(message_types.VoidMessage,
+  @endpoints.method(paging.PageResource,
                     datamodel_lib.SchoolCollectionMessage,
                     path='school/list', http_method='GET', name='list')
-  def SchoolList(self, unused_request):
-    q = datamodel_lib.School.All()
-    schools = q.fetch()
-    return SchoolCollectionMessageFromSchool(schools)
+  @_WithPrincipal
+  def SchoolList(self, request):
+    etag = datamodel_lib.ListEtag(datamodel_lib.School._get_kind(),
+                                  request.page_size, request.page_token)
+    if _NotModified(self, etag):
+      return datamodel_lib.SchoolCollectionMessage(etag=etag, not_modified=True)
+    keys, next_page_token = datamodel_lib.School.ListPage(
+      request.page_size, request.page_token)
+    msg = datamodel_lib.SchoolCollectionMessageFromKeys(
+      keys, next_page_token=next_page_token)
+    msg.etag = etag
+    return msg
 
   @endpoints.method(datamodel_lib.SchoolMessage,
                     datamodel_lib.SchoolMessage,
                     path='school/add', http_method='POST', name='add')
+  @_WithPrincipal
   def SchoolAdd(self, request):
     def _AddTransaction():
       return datamodel_lib.School.FromMessage(request)
     logging.info('Adding school: %s' % (request))
-    obj = ndb.transaction(_AddTransaction, xg=True)
+    # The School is a child of its District: one group.
+    obj = txn.Run(_AddTransaction, groups=1)
     return datamodel_lib.School.ToMessage(obj)
 
+  SchoolStatsResource = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    district=messages.StringField(1, required=True),
+    school=messages.StringField(2, required=True))
+
+  @endpoints.method(SchoolStatsResource, stats.StatsMessage,
+                    path='school/stats/{district}/{school}',
+                    http_method='GET', name='stats')
+  @_WithPrincipal
+  def SchoolStats(self, request):
+    oauth.ValidateUser(None, None)
+    school = ndb.Key(datamodel_lib.District, request.district,
+                     datamodel_lib.School, request.school)
+    datamodel_lib.CheckSchoolAccess(school)
+    return stats.SchoolStats(school)
+
+  SchoolMembersResource = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    district=messages.StringField(1, required=True),
+    school=messages.StringField(2, required=True),
+    page_size=messages.IntegerField(3, variant=messages.Variant.INT32),
+    page_token=messages.StringField(4))
+
+  # Memberships are managed by the school's managers and super users.
+  @endpoints.method(SchoolMembersResource,
+                    datamodel_lib.SchoolMemberCollectionMessage,
+                    path='school/members/{district}/{school}',
+                    http_method='GET', name='members')
+  @_WithPrincipal
+  def SchoolMembers(self, request):
+    oauth.ValidateUser(None, None)
+    members, next_page_token = datamodel_lib.SchoolUser.ListPage(
+      ndb.Key(datamodel_lib.District, request.district,
+              datamodel_lib.School, request.school),
+      request.page_size, request.page_token)
+    return datamodel_lib.SchoolMemberCollectionMessageFromSchoolUser(
+      members, next_page_token=next_page_token)
+
+  @endpoints.method(datamodel_lib.SchoolMemberMessage,
+                    datamodel_lib.SchoolMemberMessage,
+                    path='school/members/add', http_method='POST',
+                    name='addMember')
+  @_WithPrincipal
+  def SchoolMemberAdd(self, request):
+    logging.info('Adding school member: %s' % (request))
+    try:
+      obj = datamodel_lib.SchoolUser.FromMessage(request)
+    except ValueError as e:
+      raise endpoints.BadRequestException(str(e))
+    return datamodel_lib.SchoolUser.ToMessage(obj)
+
+  @endpoints.method(datamodel_lib.SchoolMemberMessage,
+                    message_types.VoidMessage,
+                    path='school/members/remove', http_method='POST',
+                    name='removeMember')
+  @_WithPrincipal
+  def SchoolMemberRemove(self, request):
+    logging.info('Removing school member: %s' % (request))
+    try:
+      datamodel_lib.SchoolUser.Remove(request)
+    except ValueError as e:
+      raise endpoints.BadRequestException(str(e))
+    return message_types.VoidMessage()
+
 
 @parentd_api.api_class(resource_name='record')
 class RecordService(remote.Service):
   RecordListResource = endpoints.ResourceContainer(
     message_types.VoidMessage,
     district=messages.StringField(1, required=True),
-    school=messages.StringField(1, required=True))
-    
+    school=messages.StringField(2, required=True),
+    page_size=messages.IntegerField(3, variant=messages.Variant.INT32),
+    page_token=messages.StringField(4),
+    view=messages.StringField(5, default='full'),
+    fields=messages.StringField(6))
+
+  # full: records with their Persons, read in one batch. snapshot: records
+  # with the PersonSummary snapshots they embed (names, one phone, one
+  # email), without reading any Person. summary: ids, school and
+  # head-counts from a projection query, which only sees Records put since
+  # the head-counts were added: run backfill.py for the Record kind once.
+  # fields= trims the items, see fieldmask.py. When it asks for nothing of
+  # parents or children, the view is served as summary, or from a
+  # keys-only query when it asks for no head-count either, whatever view
+  # was named. Page tokens are only good for the same fields.
+  RECORD_VIEWS = ('full', 'snapshot', 'summary')
+
   @endpoints.method(RecordListResource,
                     datamodel_lib.RecordCollectionMessage,
                     path='record/list/{district}/{school}',
                     http_method='GET', name='list')
+  @_WithPrincipal
   def RecordList(self, request):
+    if request.view not in self.RECORD_VIEWS:
+      raise endpoints.BadRequestException('Unknown view: %s' % (request.view))
+    mask = fieldmask.Parse(request.fields, datamodel_lib.RecordMessage)
+    view = request.view
+    if mask and not (mask.Has('parents') or mask.Has('children')):
+      view = 'summary'
+      if not (mask.Has('num_parents') or mask.Has('num_children')):
+        view = 'keys'
+    school_key = ndb.Key(datamodel_lib.District, request.district,
+                         datamodel_lib.School, request.school)
+    # Even not_modified is only for members.
+    datamodel_lib.CheckSchoolAccess(school_key)
+    # The stamp is read before anything else, so a write racing with this
+    # request leaves a stale ETag behind, never a stale response.
+    etag = datamodel_lib.SchoolEtag(
+      school_key, request.view, request.page_size, request.page_token,
+      request.fields)
+    if _NotModified(self, etag):
+      return datamodel_lib.RecordCollectionMessage(etag=etag,
+                                                   not_modified=True)
     # Assert the school exists.
     school = datamodel_lib.School.FromMessage(
       datamodel_lib.SchoolMessage(
         district=request.district, name=request.school))
     if not school:
       raise endpoints.NotFoundException('School/District are invalid')
-    q = datamodel_lib.Record.All(request.school)
-    records = q.fetch()
-    return RecordCollectionMessageFromRecord(records)
+    if view == 'keys':
+      keys, next_page_token = paging.FetchPage(
+        datamodel_lib.Record.All(school.key),
+        request.page_size, request.page_token, keys_only=True)
+      msg = datamodel_lib.RecordCollectionMessageFromKeys(
+        keys, school.key, next_page_token=next_page_token)
+    elif view == 'summary':
+      records, next_page_token = paging.FetchPage(
+        datamodel_lib.Record.All(school.key),
+        request.page_size, request.page_token,
+        projection=datamodel_lib.Record.SUMMARY_PROJECTION)
+      msg = datamodel_lib.RecordCollectionMessageFromSummaries(
+        records, school.key, next_page_token=next_page_token)
+    else:
+      records, next_page_token = datamodel_lib.Record.ListPage(
+        school.key, request.page_size, request.page_token)
+      if view == 'snapshot':
+        msg = datamodel_lib.RecordCollectionMessageFromSnapshots(
+          records, next_page_token=next_page_token)
+      else:
+        msg = datamodel_lib.RecordCollectionMessageFromRecord(
+          records, next_page_token=next_page_token)
+    fieldmask.Trim(mask, msg.items)
+    msg.etag = etag
+    return msg
 
   @endpoints.method(datamodel_lib.RecordMessage,
                     datamodel_lib.RecordMessage,
                     path='record/add', http_method='POST', name='add')
+  @_WithPrincipal
   def RecordAdd(self, request):
+    changed_people = []
+    schools = []
     def _AddTransaction():
-      return datamodel_lib.Record.FromMessage(request)
+      del changed_people[:]  # From an attempt that was retried.
+      # Counted here rather than in FromMessage, for the schools it names:
+      # moving a Record changes the listing it left too.
+      deltas = stats.Deltas()
+      obj = datamodel_lib.Record.FromMessage(
+        request, changed_people=changed_people, stat_deltas=deltas)
+      stats.ApplyAsync(deltas).get_result()
+      schools[:] = deltas.Schools()
+      return obj
     logging.info('Adding record: %s' % (request))
-    obj = ndb.transaction(_AddTransaction, xg=True)
+    try:
+      groups = datamodel_lib.Record.EntityGroups(request)
+    except ValueError as e:
+      raise endpoints.BadRequestException(str(e))
+    if len(groups) > txn.MAX_GROUPS:
+      raise endpoints.BadRequestException('Too many people in one record.')
+    obj = txn.Run(_AddTransaction, groups=len(groups))
+    datamodel_lib.BumpSchoolVersion(*schools)
+    person_fanout.EnqueueRefresh(changed_people)
     return datamodel_lib.Record.ToMessage(obj)
 
+  RecordDeleteResource = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    id=messages.StringField(1, required=True))
+
+  @endpoints.method(RecordDeleteResource, message_types.VoidMessage,
+                    path='record/delete', http_method='POST', name='delete')
+  @_WithPrincipal
+  def RecordDelete(self, request):
+    try:
+      key = ndb.Key(urlsafe=request.id)
+    except Exception:  # Malformed urlsafe keys raise a grab bag of errors.
+      key = None
+    if not key or key.kind() != datamodel_lib.Record._get_kind():
+      raise endpoints.NotFoundException('No such record.')
+    try:
+      school = datamodel_lib.Record.Delete(key)
+    except ValueError:
+      raise endpoints.NotFoundException('No such record.')
+    datamodel_lib.BumpSchoolVersion(school)
+    return message_types.VoidMessage()
+
+  RecordChangesResource = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    district=messages.StringField(1, required=True),
+    school=messages.StringField(2, required=True),
+    sync_token=messages.StringField(3),
+    page_size=messages.IntegerField(4, variant=messages.Variant.INT32))
+
+  # Delta sync: pass the sync_token of the previous response, none the
+  # first time. See sync.py.
+  @endpoints.method(RecordChangesResource,
+                    datamodel_lib.RecordChangesMessage,
+                    path='record/changes/{district}/{school}',
+                    http_method='GET', name='changes')
+  @_WithPrincipal
+  def RecordChanges(self, request):
+    school = datamodel_lib.School.FromMessage(
+      datamodel_lib.SchoolMessage(
+        district=request.district, name=request.school))
+    return sync.Changes(school.key, request.sync_token, request.page_size)
+
+
+@parentd_api.api_class(resource_name='person')
+class PersonService(remote.Service):
+  PersonSearchResource = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    district=messages.StringField(1, required=True),
+    school=messages.StringField(2, required=True),
+    q=messages.StringField(3, required=True),
+    page_size=messages.IntegerField(4, variant=messages.Variant.INT32),
+    page_token=messages.StringField(5),
+    fields=messages.StringField(6))
+
+  # fields= trims the items, see fieldmask.py.
+  @endpoints.method(PersonSearchResource,
+                    datamodel_lib.PersonCollectionMessage,
+                    path='person/search/{district}/{school}',
+                    http_method='GET', name='search')
+  @_WithPrincipal
+  def PersonSearch(self, request):
+    mask = fieldmask.Parse(request.fields, datamodel_lib.PersonMessage)
+    school = datamodel_lib.School.FromMessage(
+      datamodel_lib.SchoolMessage(
+        district=request.district, name=request.school))
+    q = datamodel_lib.Person.Search(school.key, request.q)
+    if not q:
+      return datamodel_lib.PersonCollectionMessage()
+    persons, next_page_token = paging.FetchMatchingPage(
+      q, lambda p: datamodel_lib.Person.Matches(p, request.q),
+      request.page_size, request.page_token)
+    msg = datamodel_lib.PersonCollectionMessageFromPerson(
+      persons, next_page_token=next_page_token)
+    fieldmask.Trim(mask, msg.items)
+    return msg
+
+
+@parentd_api.api_class(resource_name='import')
+class ImportService(remote.Service):
+  ImportStatusResource = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    job_id=messages.StringField(1, required=True))
+
+  # Rosters are uploaded to /import/roster, see roster_import.py.
+  @endpoints.method(ImportStatusResource,
+                    roster_import.ImportStatusMessage,
+                    path='import/status/{job_id}',
+                    http_method='GET', name='status')
+  @_WithPrincipal
+  def ImportStatus(self, request):
+    oauth.ValidateUser(None, None)
+    return roster_import.GetStatus(request.job_id)
+
+
+@parentd_api.api_class(resource_name='batch')
+class BatchService(remote.Service):
+  # Mixed Person and Record creates and updates, in few transactions.
+  # See batch.py.
+  @endpoints.method(batch.BatchRequestMessage, batch.BatchResponseMessage,
+                    path='batch', http_method='POST', name='apply')
+  @_WithPrincipal
+  def BatchApply(self, request):
+    oauth.ValidateUser(None, None)
+    return batch.Apply(request)
+
+
+@parentd_api.api_class(resource_name='export')
+class ExportService(remote.Service):
+  ExportStartResource = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    district=messages.StringField(1, required=True),
+    school=messages.StringField(2, required=True),
+    format=messages.StringField(3, default='csv'))
+
+  ExportStatusResource = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    job_id=messages.StringField(1, required=True))
+
+  # Poll export/status until done, then fetch its download_url.
+  @endpoints.method(ExportStartResource,
+                    directory_export.ExportStatusMessage,
+                    path='export/start/{district}/{school}',
+                    http_method='POST', name='start')
+  @_WithPrincipal
+  def ExportStart(self, request):
+    school = datamodel_lib.School.FromMessage(
+      datamodel_lib.SchoolMessage(
+        district=request.district, name=request.school))
+    if not school:
+      raise endpoints.NotFoundException('School/District are invalid')
+    try:
+      job = directory_export.StartExport(school, request.format.lower())
+    except directory_export.ExportError as e:
+      raise endpoints.BadRequestException(str(e))
+    return directory_export.ExportJob.ToMessage(job)
+
+  @endpoints.method(ExportStatusResource,
+                    directory_export.ExportStatusMessage,
+                    path='export/status/{job_id}',
+                    http_method='GET', name='status')
+  @_WithPrincipal
+  def ExportStatus(self, request):
+    oauth.ValidateUser(None, None)
+    return directory_export.GetStatus(request.job_id)
+
 
 # TODO(renwick): Add in the UserService
-api = endpoints.api_server([
+api = metrics.MetricsMiddleware(endpoints.api_server([
     DistrictService,
     SchoolService,
-    RecordService])
+    PersonService,
+    RecordService,
+    ImportService,
+    ExportService,
+    BatchService]))
@@ -0,0 +1,132 @@
+# Description:
+#   unittests for services.py
+
+import unittest
+
+from protorpc import remote
+
+import datamodel_lib
+import paging
+import services
+import test_lib
+
+
+def _WithEtag(service, etag):
+  """service, serving a request with If-None-Match: etag."""
+  service.initialize_request_state(
+    remote.HttpRequestState(headers=[('If-None-Match', etag)]))
+  return service
+
+
+class NotModifiedTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = test_lib.Activate()
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.AddSuperUser()
+    datamodel_lib.District.FromMessage(
+      datamodel_lib.DistrictMessage(domain='test.org'))
+    self.school = datamodel_lib.SchoolMessage(district='test.org',
+                                              name='test')
+    datamodel_lib.School.FromMessage(self.school)
+    self._AddFamily()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def _AddFamily(self):
+    services.RecordService().RecordAdd(datamodel_lib.RecordMessage(
+      school=self.school,
+      parents=[datamodel_lib.PersonMessage(first_name='mom')],
+      children=[datamodel_lib.PersonMessage(first_name='kid')]))
+
+  def testRecordList(self):
+    record_list = services.RecordService.RecordListResource
+    request = record_list.combined_message_class(district='test.org',
+                                                 school='test')
+    msg = services.RecordService().RecordList(request)
+    self.assertEquals(1, len(msg.items))
+    self.assertFalse(msg.not_modified)
+    same = _WithEtag(services.RecordService(), msg.etag).RecordList(request)
+    self.assertTrue(same.not_modified)
+    self.assertEquals(msg.etag, same.etag)
+    self.assertEquals([], list(same.items))
+    # A write makes the etag stale.
+    self._AddFamily()
+    changed = _WithEtag(services.RecordService(), msg.etag).RecordList(
+      request)
+    self.assertFalse(changed.not_modified)
+    self.assertEquals(2, len(changed.items))
+    self.assertNotEquals(msg.etag, changed.etag)
+
+  def testMovedRecordChangesItsOldSchool(self):
+    record_list = services.RecordService.RecordListResource
+    request = record_list.combined_message_class(district='test.org',
+                                                 school='test')
+    msg = services.RecordService().RecordList(request)
+    datamodel_lib.School.FromMessage(
+      datamodel_lib.SchoolMessage(district='test.org', name='other'))
+    moved = msg.items[0]
+    moved.school.name = 'other'
+    services.RecordService().RecordAdd(moved)
+    changed = _WithEtag(services.RecordService(), msg.etag).RecordList(
+      request)
+    self.assertFalse(changed.not_modified)
+    self.assertEquals([], list(changed.items))
+
+  def testSchoolList(self):
+    request = paging.PageResource.combined_message_class()
+    msg = services.SchoolService().SchoolList(request)
+    self.assertEquals(1, len(msg.items))
+    same = _WithEtag(services.SchoolService(), '"other", %s' % (msg.etag)
+                     ).SchoolList(request)
+    self.assertTrue(same.not_modified)
+    self.assertEquals([], list(same.items))
+    self.assertFalse(_WithEtag(services.SchoolService(), 'other').SchoolList(
+      request).not_modified)
+
+
+class RecordViewTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = test_lib.Activate()
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.AddSuperUser()
+    datamodel_lib.District.FromMessage(
+      datamodel_lib.DistrictMessage(domain='test.org'))
+    school = datamodel_lib.SchoolMessage(district='test.org', name='test')
+    datamodel_lib.School.FromMessage(school)
+    services.RecordService().RecordAdd(datamodel_lib.RecordMessage(
+      school=school,
+      parents=[datamodel_lib.PersonMessage(
+        first_name='mom', email_addresses=['mom@a.com', 'mom@b.com'],
+        addresses=['1 Main St'])],
+      children=[datamodel_lib.PersonMessage(first_name='kid')]))
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def _List(self, **kwargs):
+    record_list = services.RecordService.RecordListResource
+    return services.RecordService().RecordList(
+      record_list.combined_message_class(district='test.org', school='test',
+                                         **kwargs)).items[0]
+
+  def testFullHasWholePersons(self):
+    mom = self._List().parents[0]
+    self.assertEquals(['mom@a.com', 'mom@b.com'], mom.email_addresses)
+    self.assertEquals(['1 Main St'], mom.addresses)
+    self.assertEquals(mom, self._List(view='full').parents[0])
+
+  def testSnapshot(self):
+    item = self._List(view='snapshot')
+    mom = item.parents[0]
+    self.assertEquals('mom', mom.first_name)
+    self.assertEquals(['mom@a.com'], mom.email_addresses)
+    self.assertEquals([], mom.addresses)
+    self.assertEquals('kid', item.children[0].first_name)
+    self.assertEquals(self._List().id, item.id)
+
+
+if __name__ == '__main__':
+  unittest.main()
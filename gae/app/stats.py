@@ -0,0 +1,159 @@
+# Description:
+#   Family, student and parent counts per School and per District.
+#
+#   Each School and each District has SHARDS CounterShards. A write adds
+#   its change to one shard of its School and one of its District, picked
+#   at random, inside the write's own transaction, so the counts move with
+#   the Records and concurrent writers rarely contend on a shard.
+#
+#   Reading the counts sums the shards with one get_multi. The sums are
+#   kept in memcache, and committed writes offset the cached sums rather
+#   than dropping them. An offset that races with a refill can be lost,
+#   so the cached sums also expire after CACHE_SECONDS.
+#
+#   A Record counts as one family, its children as students and its parents
+#   as parents. Someone listed in two Records is counted in both.
+
+import collections
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from protorpc import messages
+
+import txn
+
+
+SHARDS = 20
+CACHE_SECONDS = 10 * 60
+FIELDS = ('families', 'students', 'parents')
+
+
+class StatsMessage(messages.Message):
+  """The counts of a District, or of a School when school is set."""
+  district = messages.StringField(1)
+  school = messages.StringField(2)
+  families = messages.IntegerField(3)
+  students = messages.IntegerField(4)
+  parents = messages.IntegerField(5)
+
+
+class CounterShard(ndb.Model):
+  """One shard of a scope's counts, see Scope. A root entity, so shards
+  don't contend with each other or with the School.
+  """
+  families = ndb.IntegerProperty(default=0, indexed=False)
+  students = ndb.IntegerProperty(default=0, indexed=False)
+  parents = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def Scope(school):
+  """The scopes counted for school, a School key: (school's, district's)."""
+  district = school.parent().id()
+  return ('%s/%s' % (district, school.id()), district)
+
+
+def _ShardKey(scope, shard):
+  return ndb.Key(CounterShard, '%s#%d' % (scope, shard))
+
+
+def _CacheKey(scope, field):
+  return 'stats:%s:%s' % (scope, field)
+
+
+def Groups(school):
+  """Placeholders for the two entity groups ApplyAsync writes for school;
+  only their number matters, see txn.Run.
+  """
+  return set(('stats', scope) for scope in Scope(school))
+
+
+class Deltas(object):
+  """Count changes of one or more writes, by School key."""
+
+  def __init__(self):
+    self.by_school = collections.defaultdict(collections.Counter)
+
+  def Add(self, school, parents, children, sign=1):
+    """Counts a family of school with parents and children, or uncounts it
+    when sign is -1.
+    """
+    counts = self.by_school[school]
+    counts['families'] += sign
+    counts['students'] += sign * children
+    counts['parents'] += sign * parents
+
+  def ToDict(self):
+    """The counts as a JSON-able dict, for FromDict."""
+    return dict((school.urlsafe(), dict(counts))
+                for school, counts in self.by_school.iteritems())
+
+  @classmethod
+  def FromDict(cls, value):
+    deltas = cls()
+    for school, counts in value.iteritems():
+      deltas.by_school[ndb.Key(urlsafe=school)].update(counts)
+    return deltas
+
+  def Schools(self):
+    """The School keys counted, whether or not their counts changed: the
+    schools a write added a family to, or took one from.
+    """
+    return self.by_school.keys()
+
+
+@ndb.tasklet
+def ApplyAsync(deltas):
+  """Adds deltas to one random shard per scope.
+
+  Call it inside the transaction that made the changes; the cached sums
+  are offset once it commits.
+  """
+  by_scope = collections.defaultdict(collections.Counter)
+  for school, counts in deltas.by_school.iteritems():
+    for scope in Scope(school):
+      by_scope[scope].update(counts)
+  by_scope = dict((s, c) for s, c in by_scope.iteritems() if any(c.values()))
+  if not by_scope:
+    return
+  keys = [_ShardKey(scope, random.randint(0, SHARDS - 1))
+          for scope in by_scope]
+  shards = yield ndb.get_multi_async(keys)
+  shards = [s or CounterShard(key=k) for k, s in zip(keys, shards)]
+  offsets = {}
+  for shard, (scope, counts) in zip(shards, by_scope.iteritems()):
+    for field in FIELDS:
+      setattr(shard, field, getattr(shard, field) + counts[field])
+      if counts[field]:
+        offsets[_CacheKey(scope, field)] = counts[field]
+  yield ndb.put_multi_async(shards)
+  # Only offsets sums that are cached; a miss refills from the shards.
+  txn.AfterCommit(lambda: memcache.offset_multi(offsets))
+
+
+def Get(scope):
+  """The counts of scope, see Scope.
+
+  Returns:
+    dict: field -> count, for each of FIELDS.
+  """
+  cache_keys = [_CacheKey(scope, field) for field in FIELDS]
+  cached = memcache.get_multi(cache_keys)
+  if len(cached) == len(FIELDS):
+    return dict((f, int(cached[k])) for f, k in zip(FIELDS, cache_keys))
+  shards = ndb.get_multi([_ShardKey(scope, i) for i in xrange(SHARDS)])
+  counts = dict((f, sum(getattr(s, f) for s in shards if s)) for f in FIELDS)
+  memcache.add_multi(dict((k, counts[f]) for f, k in zip(FIELDS, cache_keys)),
+                     time=CACHE_SECONDS)
+  return counts
+
+
+def SchoolStats(school):
+  """The StatsMessage of school, a School key."""
+  return StatsMessage(district=school.parent().id(), school=school.id(),
+                      **Get(Scope(school)[0]))
+
+
+def DistrictStats(district):
+  """The StatsMessage of district, a District id."""
+  return StatsMessage(district=district, **Get(district))
@@ -0,0 +1,80 @@
+# Description:
+#   unittests for stats.py
+
+import unittest
+
+from google.appengine.ext import ndb
+
+import datamodel_lib
+import rpc_stats
+import stats
+import test_lib
+
+
+def _Counts(msg):
+  return (msg.families, msg.students, msg.parents)
+
+
+class StatsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = test_lib.Activate()
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.AddSuperUser()
+    datamodel_lib.District(id='test.org').put()
+    self.schools = [ndb.Key(datamodel_lib.District, 'test.org',
+                            datamodel_lib.School, name)
+                    for name in ('north', 'south')]
+    for school in self.schools:
+      datamodel_lib.School(key=school).put()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def _Family(self, school, parents, children, record_id=None):
+    return datamodel_lib.Record.FromMessage(datamodel_lib.RecordMessage(
+      id=record_id,
+      school=datamodel_lib.School.KeyToMessage(school),
+      parents=[datamodel_lib.PersonMessage(first_name='parent')
+               for _ in xrange(parents)],
+      children=[datamodel_lib.PersonMessage(first_name='child')
+                for _ in xrange(children)]))
+
+  def testCounts(self):
+    north, south = self.schools
+    self._Family(north, 2, 1)
+    self._Family(north, 1, 2)
+    self._Family(south, 1, 1)
+    self.assertEquals((2, 3, 3), _Counts(stats.SchoolStats(north)))
+    self.assertEquals((1, 1, 1), _Counts(stats.SchoolStats(south)))
+    self.assertEquals((3, 4, 4), _Counts(stats.DistrictStats('test.org')))
+
+  def testCachedCountsFollowWrites(self):
+    north, south = self.schools
+    record = self._Family(north, 1, 1)
+    self.assertEquals((1, 1, 1), _Counts(stats.SchoolStats(north)))
+    # Another child, then the family moves school.
+    record = self._Family(north, 0, 2, record_id=record.key.urlsafe())
+    self.assertEquals((1, 2, 1), _Counts(stats.SchoolStats(north)))
+    self._Family(south, 0, 0, record_id=record.key.urlsafe())
+    self.assertEquals((0, 0, 0), _Counts(stats.SchoolStats(north)))
+    self.assertEquals((1, 2, 1), _Counts(stats.SchoolStats(south)))
+    datamodel_lib.Record.Delete(record.key)
+    self.assertEquals((0, 0, 0), _Counts(stats.SchoolStats(south)))
+    self.assertEquals((0, 0, 0), _Counts(stats.DistrictStats('test.org')))
+
+  def testReadsAreCheap(self):
+    north = self.schools[0]
+    for _ in xrange(5):
+      self._Family(north, 1, 1)
+    ndb.get_context().clear_cache()
+    with rpc_stats.RpcCounter() as counter:
+      stats.SchoolStats(north)
+    self.assertEquals(1, counter.Total('datastore_v3'))
+    with rpc_stats.RpcCounter() as counter:
+      self.assertEquals((5, 5, 5), _Counts(stats.SchoolStats(north)))
+    self.assertEquals(0, counter.Total('datastore_v3'))
+
+
+if __name__ == '__main__':
+  unittest.main()
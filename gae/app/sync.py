@@ -0,0 +1,143 @@
+# Description:
+#   Delta sync of a school for record/changes.
+#
+#   Records and Persons carry an auto_now 'updated' timestamp and deleted
+#   Records leave a Tombstone. A sync token is the time the client has
+#   synced up to; Changes returns what was written at or after it, each
+#   kind read with one (school, timestamp) index scan, so a sync costs
+#   what changed and not the size of the school.
+#
+#   Timestamps come from the clock of the instance that wrote the entity
+#   and are taken before the write commits, so an entity can become
+#   visible with a timestamp a little in the past. The token handed out
+#   therefore trails the current time by SKEW_SECONDS: a client sees the
+#   changes of that window twice rather than missing any of them.
+#
+#   When a kind has more than a page of changes, the token instead carries
+#   where each kind's (timestamp, key) ordered scan stopped, as a query
+#   cursor, so a page of entities sharing one timestamp is resumed inside
+#   it rather than skipped. Once every kind is read to the end, the token
+#   is the time of the first page again, less SKEW_SECONDS.
+
+import calendar
+import datetime
+import endpoints
+
+import datamodel_lib
+import paging
+
+
+SKEW_SECONDS = 30
+TOKEN_VERSION = 'v1'
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# (model, school property, timestamp property) of each kind synced.
+KINDS = (
+  (datamodel_lib.Record, datamodel_lib.Record.school,
+   datamodel_lib.Record.updated),
+  (datamodel_lib.Person, datamodel_lib.Person.schools,
+   datamodel_lib.Person.updated),
+  (datamodel_lib.Tombstone, datamodel_lib.Tombstone.school,
+   datamodel_lib.Tombstone.deleted),
+)
+
+
+def EncodeToken(when, until=None, cursors=None):
+  """The sync token of a UTC datetime.
+
+  Args:
+    when: (datetime) What the client has synced up to.
+    until: (datetime) Mid-sync, the token to hand out once it is done.
+    cursors: (list) Mid-sync, the page token of each of KINDS, '' for a
+      kind read to the end.
+  Returns:
+    str: The token.
+  """
+  token = '%s:%d' % (TOKEN_VERSION, _Micros(when))
+  if until is None:
+    return token
+  return ':'.join([token, str(_Micros(until))] + list(cursors))
+
+
+def DecodeToken(token):
+  """Reverses EncodeToken.
+
+  Args:
+    token: (str) A sync token, may be empty for the first sync.
+  Returns:
+    (datetime, datetime, list): when, until and cursors as passed to
+      EncodeToken. The epoch, None and None for an empty token.
+  Raises:
+    endpoints.BadRequestException: When token is not a sync token.
+  """
+  if not token:
+    return _EPOCH, None, None
+  parts = token.split(':')
+  if (parts[0] != TOKEN_VERSION or len(parts) not in (2, 3 + len(KINDS)) or
+      not all(p.isdigit() for p in parts[1:3])):
+    raise endpoints.BadRequestException('Invalid sync_token.')
+  when = _EPOCH + datetime.timedelta(microseconds=int(parts[1]))
+  if len(parts) == 2:
+    return when, None, None
+  until = _EPOCH + datetime.timedelta(microseconds=int(parts[2]))
+  return when, until, parts[3:]
+
+
+def _Micros(when):
+  return calendar.timegm(when.timetuple()) * 1000000 + when.microsecond
+
+
+def _Since(kind, school, since, limit, page_token):
+  model, school_prop, time_prop = kind
+  query = model.query(school_prop == school, time_prop >= since)
+  return paging.FetchPage(query.order(time_prop, model.key), limit,
+                          page_token)
+
+
+def Changes(school, sync_token=None, page_size=None, now=None):
+  """What changed in school since sync_token.
+
+  Each kind returns at most page_size entities, oldest first. While one
+  of them has more, the token returned resumes each kind where its page
+  ended, and more is set.
+
+  Args:
+    school: (ndb.Key) The School.
+    sync_token: (str) From the previous sync, empty for the first one.
+    page_size: (int) Entities per kind, capped at paging.MAX_PAGE_SIZE.
+    now: (datetime) The current UTC time, for tests.
+  Returns:
+    RecordChangesMessage: The changes.
+  Raises:
+    endpoints.BadRequestException: When sync_token is not a sync token.
+  """
+  since, until, cursors = DecodeToken(sync_token)
+  if until is None:
+    until = (now or datetime.datetime.utcnow()) - datetime.timedelta(
+      seconds=SKEW_SECONDS)
+    until = max(until, since)
+    cursors = [None] * len(KINDS)
+  results = []
+  next_cursors = []
+  for kind, cursor in zip(KINDS, cursors):
+    if cursor == '':
+      # Read to the end on an earlier page.
+      results.append([])
+      next_cursors.append('')
+      continue
+    entities, next_cursor = _Since(kind, school, since, page_size, cursor)
+    results.append(entities)
+    next_cursors.append(next_cursor or '')
+  records, people, tombstones = results
+  more = any(next_cursors)
+  if more:
+    sync_token = EncodeToken(since, until, next_cursors)
+  else:
+    sync_token = EncodeToken(until)
+  msg = datamodel_lib.RecordCollectionMessageFromSnapshots(records)
+  return datamodel_lib.RecordChangesMessage(
+    records=msg.items,
+    people=[datamodel_lib.Person.ToMessage(p) for p in people],
+    deleted_records=[t.key.parent().urlsafe() for t in tombstones],
+    sync_token=sync_token,
+    more=more)
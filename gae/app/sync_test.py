@@ -0,0 +1,120 @@
+# Description:
+#   unittests for sync.py
+
+import datetime
+import endpoints
+import unittest
+
+from google.appengine.ext import ndb
+
+import datamodel_lib
+import sync
+import test_lib
+
+
+class SyncTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = test_lib.Activate()
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.AddSuperUser()
+    self.school = ndb.Key(datamodel_lib.District, 'test.org',
+                          datamodel_lib.School, 'test')
+    datamodel_lib.District(id='test.org').put()
+    datamodel_lib.School(key=self.school).put()
+    # Tokens are the current time, so the writes of a test are ordered.
+    sync.SKEW_SECONDS, self.skew = 0, sync.SKEW_SECONDS
+
+  def tearDown(self):
+    sync.SKEW_SECONDS = self.skew
+    self.testbed.deactivate()
+
+  def _Family(self, name):
+    return datamodel_lib.Record.FromMessage(datamodel_lib.RecordMessage(
+      school=datamodel_lib.SchoolMessage(district='test.org', name='test'),
+      parents=[datamodel_lib.PersonMessage(
+        first_name='parent', last_name=name)],
+      children=[datamodel_lib.PersonMessage(
+        first_name='child', last_name=name)]))
+
+  def testToken(self):
+    when = datetime.datetime(2014, 3, 1, 12, 30, 15, 123456)
+    self.assertEquals((when, None, None),
+                      sync.DecodeToken(sync.EncodeToken(when)))
+    self.assertEquals((datetime.datetime(1970, 1, 1), None, None),
+                      sync.DecodeToken(None))
+    until = when + datetime.timedelta(seconds=1)
+    cursors = ['abc', '', 'def']
+    self.assertEquals((when, until, cursors), sync.DecodeToken(
+      sync.EncodeToken(when, until, cursors)))
+    for token in ('v1:abc', 'v2:123', 'garbage', 'v1:1:2:abc'):
+      self.assertRaises(endpoints.BadRequestException,
+                        sync.DecodeToken, token)
+
+  def testChanges(self):
+    smith = self._Family('smith')
+    jones = self._Family('jones')
+    changes = sync.Changes(self.school)
+    self.assertEquals(2, len(changes.records))
+    self.assertEquals(4, len(changes.people))
+    self.assertFalse(changes.more)
+    token = changes.sync_token
+    # Nothing since.
+    changes = sync.Changes(self.school, token)
+    self.assertEquals([], changes.records + changes.people)
+    # Only what was written since the token.
+    child = smith.children[0].get()
+    child.first_name = 'kid'
+    child.put()
+    datamodel_lib.Record.Delete(jones.key)
+    changes = sync.Changes(self.school, token)
+    self.assertEquals([], changes.records)
+    self.assertEquals(['kid'], [p.first_name for p in changes.people])
+    self.assertEquals([jones.key.urlsafe()], changes.deleted_records)
+
+  def testChangesInPages(self):
+    keys = set(self._Family('family-%d' % (i)).key.urlsafe()
+               for i in xrange(5))
+    seen = set()
+    token = None
+    for _ in xrange(10):
+      changes = sync.Changes(self.school, token, page_size=2)
+      seen.update(r.id for r in changes.records)
+      token = changes.sync_token
+      if not changes.more:
+        break
+    self.assertEquals(keys, seen)
+
+  def testPageOfOneTimestamp(self):
+    # More deletions at one instant than fit in a page.
+    when = datetime.datetime(2014, 3, 1, 12, 30, 15, 123456)
+    keys = set()
+    for i in xrange(5):
+      record = ndb.Key(datamodel_lib.Record, i + 1)
+      datamodel_lib.Tombstone(parent=record, id=datamodel_lib.Tombstone.ID,
+                              school=self.school, deleted=when).put()
+      keys.add(record.urlsafe())
+    seen = []
+    token = sync.EncodeToken(when)
+    for _ in xrange(10):
+      changes = sync.Changes(self.school, token, page_size=2)
+      seen.extend(changes.deleted_records)
+      token = changes.sync_token
+      if not changes.more:
+        break
+    self.assertEquals(keys, set(seen))
+    self.assertEquals(5, len(seen))
+
+  def testOtherSchool(self):
+    self._Family('smith')
+    other = ndb.Key(datamodel_lib.District, 'test.org',
+                    datamodel_lib.School, 'other')
+    self.assertEquals([], sync.Changes(other).records)
+
+  def testDeleteMissing(self):
+    self.assertRaises(ValueError, datamodel_lib.Record.Delete,
+                      ndb.Key(datamodel_lib.Record, 123))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,91 @@
+# Description:
+#   Setup shared by the unittests and benchmarks.
+
+import os
+
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+
+import datamodel_lib
+import oauth
+
+
+# The directory of app.yaml and queue.yaml.
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ADMIN_EMAIL = 'admin@parentd.com'
+
+# What Endpoints reads to authenticate a request of its own.
+_ENDPOINTS_ENV = ('ENDPOINTS_USE_OAUTH_SCOPE', 'ENDPOINTS_AUTH_EMAIL',
+                  'ENDPOINTS_AUTH_DOMAIN')
+
+
+def Activate(taskqueue=False):
+  """Activates a Testbed with the datastore, memcache and user stubs.
+
+  The datastore is High Replication, with every write applied at once.
+
+  Args:
+    taskqueue: (bool) Also init the task queue stub, with the queues of
+      queue.yaml.
+  Returns:
+    testbed.Testbed: The active testbed, to deactivate in tearDown.
+  """
+  # First, create an instance of the Testbed class.
+  bed = testbed.Testbed()
+  # Then activate the testbed, which prepares the service stubs for use.
+  bed.activate()
+  # Create a consistency policy that will simulate the High
+  # Replication consistency model.
+  policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+  # Initialize the datastore stub with this policy.
+  bed.init_datastore_v3_stub(consistency_policy=policy)
+  bed.init_memcache_stub()
+  bed.init_user_stub()
+  if taskqueue:
+    bed.init_taskqueue_stub(root_path=APP_DIR)
+  return bed
+
+
+def SetUser(bed, email, user_id, endpoints=True):
+  """Signs in email to the users API, OAuth and Endpoints.
+
+  Args:
+    bed: (testbed.Testbed) The active testbed.
+    email: (str) The user's email.
+    user_id: (str) The user's id.
+    endpoints: (bool) False signs in as a request to a webapp2 route sees
+      it: a bearer token of the web client, no Endpoints user.
+  """
+  domain = email.split('@')[-1]
+  bed.setup_env(
+    USER_EMAIL=email, USER_ID=user_id, USER_IS_ADMIN='0',
+    OAUTH_ERROR_CODE='', OAUTH_LAST_SCOPE='0',
+    AUTH_DOMAIN=domain,
+    OAUTH_EMAIL=email, OAUTH_AUTH_DOMAIN=domain,
+    OAUTH_USER_ID=user_id, overwrite=True)
+  if endpoints:
+    bed.setup_env(ENDPOINTS_USE_OAUTH_SCOPE='0', ENDPOINTS_AUTH_EMAIL=email,
+                  ENDPOINTS_AUTH_DOMAIN=domain, overwrite=True)
+    return
+  # The OAuth API answers from these when asked for the same scope.
+  bed.setup_env(OAUTH_LAST_SCOPE=oauth.EMAIL_SCOPE,
+                OAUTH_CLIENT_ID=oauth.WEB_CLIENT_ID, overwrite=True)
+  # Testbed.deactivate restores the environment.
+  for name in _ENDPOINTS_ENV:
+    os.environ.pop(name, None)
+
+
+def SetAnonymous(bed):
+  """Signs out of the users API, OAuth and Endpoints."""
+  bed.setup_env(USER_EMAIL='', USER_ID='', OAUTH_EMAIL='', OAUTH_USER_ID='',
+                OAUTH_CLIENT_ID='', OAUTH_LAST_SCOPE=oauth.EMAIL_SCOPE,
+                # An invalid token.
+                OAUTH_ERROR_CODE='3', overwrite=True)
+  for name in _ENDPOINTS_ENV:
+    os.environ.pop(name, None)
+
+
+def AddSuperUser(email=ADMIN_EMAIL):
+  """Stores a super User for email. Returns its key."""
+  return datamodel_lib.User(email_addresses=[email], is_super_user=True).put()
@@ -0,0 +1,74 @@
+# Description:
+#   Runs datastore transactions in the narrowest scope they allow.
+#
+#   Run is cross-group only when the caller says the work spans more than
+#   one entity group, since an xg transaction costs more and caps out at
+#   MAX_GROUPS. When the commit loses to a concurrent one, it retries with
+#   jittered exponential backoff, so writers that collided don't collide
+#   again in lockstep. Each conflict and each retry is counted with
+#   rpc_stats, so metrics reports them per endpoint.
+#
+#   Work that doesn't have to be atomic with the write (cache
+#   invalidation, task enqueues) goes to AfterCommit, which runs it once
+#   the transaction has committed, and never for a failed attempt.
+
+import logging
+import random
+import time
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+import rpc_stats
+
+
+MAX_GROUPS = 25  # Entity groups per cross-group transaction.
+ATTEMPTS = 4
+BACKOFF_SECONDS = 0.05
+MAX_BACKOFF_SECONDS = 1.0
+
+
+def Backoff(attempt):
+  """Seconds to wait before retry attempt, drawn from [0, cap) ("full
+  jitter"), where cap doubles with each attempt.
+  """
+  cap = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** attempt)
+  return random.uniform(0, cap)
+
+
+def Run(fn, groups=None, attempts=ATTEMPTS):
+  """Runs fn in a transaction, retrying when it loses to contention.
+
+  fn may be called once per attempt, so it must not keep state from an
+  earlier one.
+
+  Args:
+    fn: (callable) The transaction body.
+    groups: (int) The number of entity groups fn touches; None when unknown.
+    attempts: (int) Attempts before the conflict is raised.
+  Returns:
+    What fn returned.
+  Raises:
+    datastore_errors.TransactionFailedError: When every attempt conflicted.
+  """
+  xg = groups is None or groups > 1
+  for attempt in xrange(attempts):
+    try:
+      # ndb's own retries would skip the backoff and the counts.
+      return ndb.transaction(fn, xg=xg, retries=0)
+    except datastore_errors.TransactionFailedError:
+      rpc_stats.Increment(rpc_stats.TXN_CONFLICTS)
+      if attempt + 1 >= attempts:
+        raise
+      rpc_stats.Increment(rpc_stats.TXN_RETRIES)
+      wait = Backoff(attempt)
+      logging.info('Transaction conflict, retry %d in %.3fs',
+                   attempt + 1, wait)
+      time.sleep(wait)
+
+
+def AfterCommit(callback):
+  """Calls callback once the current transaction commits, or now outside
+  of one. An attempt that fails or is retried drops its callbacks.
+  """
+  ndb.get_context().call_on_commit(callback)
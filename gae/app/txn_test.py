@@ -0,0 +1,84 @@
+# Description:
+#   unittests for txn.py
+
+import unittest
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+import rpc_stats
+import test_lib
+import txn
+
+
+class _Thing(ndb.Model):
+  n = ndb.IntegerProperty(default=0)
+
+
+class TxnTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = test_lib.Activate()
+    txn.BACKOFF_SECONDS, self.backoff = 0, txn.BACKOFF_SECONDS
+
+  def tearDown(self):
+    txn.BACKOFF_SECONDS = self.backoff
+    self.testbed.deactivate()
+
+  def _Conflicting(self, conflicts, committed):
+    """A transaction body that loses its first conflicts attempts."""
+    attempts = []
+    def _Txn():
+      attempts.append(1)
+      txn.AfterCommit(lambda: committed.append(len(attempts)))
+      _Thing(id='a', n=len(attempts)).put()
+      if len(attempts) <= conflicts:
+        raise datastore_errors.TransactionFailedError('Conflict.')
+      return len(attempts)
+    return _Txn
+
+  def testOneGroupIsNotCrossGroup(self):
+    def _TwoGroups():
+      _Thing(id='a').put()
+      _Thing(id='b').put()
+    self.assertRaises(datastore_errors.BadRequestError,
+                      txn.Run, _TwoGroups, groups=1)
+    txn.Run(_TwoGroups, groups=2)
+    self.assertEquals(2, _Thing.query().count())
+
+  def testRetriesConflicts(self):
+    committed = []
+    with rpc_stats.RpcCounter() as counter:
+      self.assertEquals(3, txn.Run(self._Conflicting(2, committed), groups=1))
+    self.assertEquals(2, counter.counts[rpc_stats.TXN_CONFLICTS])
+    self.assertEquals(2, counter.counts[rpc_stats.TXN_RETRIES])
+    # Only the attempt that committed ran its callback.
+    self.assertEquals([3], committed)
+    self.assertEquals(3, _Thing.get_by_id('a').n)
+
+  def testGivesUp(self):
+    committed = []
+    with rpc_stats.RpcCounter() as counter:
+      self.assertRaises(datastore_errors.TransactionFailedError, txn.Run,
+                        self._Conflicting(txn.ATTEMPTS, committed), groups=1)
+    self.assertEquals(txn.ATTEMPTS, counter.counts[rpc_stats.TXN_CONFLICTS])
+    self.assertEquals(txn.ATTEMPTS - 1,
+                      counter.counts[rpc_stats.TXN_RETRIES])
+    self.assertEquals([], committed)
+    self.assertEquals(None, _Thing.get_by_id('a'))
+
+  def testAfterCommitOutsideTransaction(self):
+    called = []
+    txn.AfterCommit(lambda: called.append(1))
+    self.assertEquals([1], called)
+
+  def testBackoff(self):
+    txn.BACKOFF_SECONDS = 0.1
+    for attempt in xrange(10):
+      wait = txn.Backoff(attempt)
+      self.assertTrue(0 <= wait <= min(txn.MAX_BACKOFF_SECONDS,
+                                       0.1 * 2 ** attempt))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,178 @@
+# Description:
+#   The collection endpoints in the compact protobuf encoding.
+#
+#   GET /wire/<method path>, e.g. /wire/record/list/<district>/<school>,
+#   serves the same method as /_ah/api/parentd/v1.0/<method path>, with
+#   the same query parameters, but encodes the response as the binary
+#   protocol buffer of its protorpc message when the client asks for it,
+#   with Accept: application/x-protobuf or alt=proto. Otherwise the
+#   response is the message's JSON. Endpoints only speaks JSON, hence a
+#   route of our own.
+#
+#   Callers authenticate with an OAuth 2.0 bearer token for the email
+#   scope, or a users API sign-in, see oauth.GetRouteUser; anyone else
+#   gets a 401.
+#
+#   Item messages keep their field numbers forever: the binary encoding
+#   only carries the numbers, so renumbering a field breaks every client.
+
+import endpoints
+import urllib
+import webapp2
+
+from protorpc import messages
+from protorpc import protobuf
+from protorpc import protojson
+from protorpc import remote
+
+import datamodel_lib
+import oauth
+import paging
+import services
+
+
+PROTOBUF = 'application/x-protobuf'
+JSON = 'application/json'
+
+# Content type -> the protorpc module encoding it.
+ENCODINGS = {
+  PROTOBUF: protobuf,
+  JSON: protojson,
+}
+
+# alt= value -> content type.
+ALTS = {
+  'proto': PROTOBUF,
+  'json': JSON,
+}
+
+# Method path -> (service class, method name, ResourceContainer, names of
+# the path parameters, in order).
+METHODS = {
+  'district/list': (services.DistrictService, 'DistrictList',
+                    paging.PageResource, ()),
+  'school/list': (services.SchoolService, 'SchoolList',
+                  paging.PageResource, ()),
+  'record/list': (services.RecordService, 'RecordList',
+                  services.RecordService.RecordListResource,
+                  ('district', 'school')),
+  'record/changes': (services.RecordService, 'RecordChanges',
+                     services.RecordService.RecordChangesResource,
+                     ('district', 'school')),
+  'person/search': (services.PersonService, 'PersonSearch',
+                    services.PersonService.PersonSearchResource,
+                    ('district', 'school')),
+}
+
+
+def ContentType(accept, alt=None):
+  """The content type to answer with.
+
+  Args:
+    accept: (str) The Accept header, may be None.
+    alt: (str) The alt= parameter, may be None; it wins over accept.
+  Returns:
+    str: PROTOBUF or JSON.
+  Raises:
+    ValueError: When alt is not one of ALTS.
+  """
+  if alt:
+    if alt not in ALTS:
+      raise ValueError('Unknown alt: %s' % (alt))
+    return ALTS[alt]
+  # Types in the order of the client's preference; no q= ranking needed
+  # for two types.
+  for media_range in (accept or '').split(','):
+    content_type = media_range.split(';')[0].strip().lower()
+    if content_type in ENCODINGS:
+      return content_type
+  return JSON
+
+
+def Encode(msg, content_type):
+  """Encodes msg, a protorpc Message, as content_type. Returns a str."""
+  return ENCODINGS[content_type].encode_message(msg)
+
+
+def Decode(message_type, data, content_type):
+  """Decodes data, as encoded by Encode, into a message_type."""
+  return ENCODINGS[content_type].decode_message(message_type, data)
+
+
+def _Request(resource, names, values, params):
+  """Builds resource's request message.
+
+  Args:
+    resource: (endpoints.ResourceContainer) The method's request.
+    names: (tuple) Names of the path parameters.
+    values: (list) Their values, from the URL.
+    params: (webob.MultiDict) The query parameters.
+  Returns:
+    Message: The combined_message_class of resource.
+  Raises:
+    ValueError: On an unknown or malformed parameter.
+    messages.ValidationError: On a missing one.
+  """
+  message_type = resource.combined_message_class
+  request = message_type(**dict(zip(names, values)))
+  for name, value in params.iteritems():
+    if name in names or name == 'alt':
+      continue
+    try:
+      field = message_type.field_by_name(name)
+    except KeyError:
+      raise ValueError('Unknown parameter: %s' % (name))
+    if isinstance(field, messages.IntegerField):
+      value = int(value)
+    elif isinstance(field, messages.BooleanField):
+      value = value.lower() in ('1', 'true')
+    setattr(request, name, value)
+  request.check_initialized()
+  return request
+
+
+class CollectionHandler(webapp2.RequestHandler):
+  """GET /wire/<method path>[?alt=proto|json]: see the module description."""
+
+  def get(self, path):
+    parts = [urllib.unquote(p) for p in path.split('/')]
+    method_path = '/'.join(parts[:2])
+    if method_path not in METHODS:
+      self.abort(404)
+    service_cls, method_name, resource, names = METHODS[method_path]
+    values = parts[2:]
+    if len(values) != len(names):
+      self.abort(404)
+    try:
+      content_type = ContentType(self.request.headers.get('Accept'),
+                                 self.request.get('alt'))
+      request = _Request(resource, names, values, self.request.GET)
+    except (ValueError, messages.ValidationError) as e:
+      self.abort(400, detail=str(e))
+    service = service_cls()
+    # For services._NotModified.
+    headers = {}
+    if 'If-None-Match' in self.request.headers:
+      headers['If-None-Match'] = self.request.headers['If-None-Match']
+    service.initialize_request_state(remote.HttpRequestState(
+      remote_address=self.request.remote_addr, http_method='GET',
+      service_path=self.request.path, headers=headers.items()))
+    try:
+      with oauth.RequestPrincipal(datamodel_lib.User,
+                                  oauth.GetRouteUser) as principal:
+        if not principal.user:
+          self.abort(401, headers={'WWW-Authenticate': 'Bearer'})
+        response = getattr(service, method_name)(request)
+    except endpoints.ServiceException as e:
+      self.abort(e.http_status, detail=str(e))
+    except (ValueError, messages.ValidationError) as e:
+      self.abort(400, detail=str(e))
+    etag = getattr(response, 'etag', None)
+    if etag:
+      self.response.headers['ETag'] = str(etag)
+    if getattr(response, 'not_modified', None):
+      self.response.set_status(304)
+      return
+    self.response.headers['Vary'] = 'Accept'
+    self.response.content_type = content_type
+    self.response.write(Encode(response, content_type))
@@ -0,0 +1,101 @@
+# Description:
+#   Benchmarks the protobuf encoding of wire.py against JSON.
+#
+#   Builds the RecordCollectionMessage of a whole school, as a full sync
+#   downloads it, and times encoding and decoding it both ways, and
+#   compares the sizes, raw and gzipped, as the frontends serve them. No
+#   datastore involved. Run with:
+#     pytester.py --TEST_DIR=. --PATTERN='*_bench.py'
+#   PARENTD_WIRE_BENCH_SCALES picks the school sizes, in families.
+
+import base64
+import logging
+import os
+import random
+import time
+import unittest
+import zlib
+
+import datamodel_lib
+import wire
+
+
+SCALES = [int(s) for s in os.environ.get(
+  'PARENTD_WIRE_BENCH_SCALES', '250,1000,2500').split(',')]
+REPEATS = 5  # The best of REPEATS runs is kept.
+STREETS = ('Main St', 'Oak Ave', 'Elm St', 'Park Rd', 'Hill Dr')
+
+
+def _Id(rng):
+  # About the length of a urlsafe ndb key.
+  return base64.urlsafe_b64encode(
+    ''.join(chr(rng.randint(0, 255)) for _ in xrange(36)))
+
+
+def SchoolMessage(families, seed=0):
+  """A RecordCollectionMessage of families families, in full view: two
+  parents with contact details, and one to three children each.
+  """
+  rng = random.Random(seed)
+  school = datamodel_lib.SchoolMessage(district='district.org',
+                                       name='lincoln-elementary')
+  items = []
+  for i in xrange(families):
+    last_name = 'family%d' % (i)
+    address = '%d %s' % (rng.randint(1, 9999), rng.choice(STREETS))
+    parents = [datamodel_lib.PersonMessage(
+                 id=_Id(rng), first_name=first, last_name=last_name,
+                 phone_numbers=['555-%07d' % (rng.randint(0, 9999999))],
+                 email_addresses=['%s.%s@example.com' % (first, last_name)],
+                 addresses=[address])
+               for first in ('mom', 'dad')]
+    children = [datamodel_lib.PersonMessage(
+                  id=_Id(rng), first_name='kid%d' % (j), last_name=last_name)
+                for j in xrange(rng.randint(1, 3))]
+    items.append(datamodel_lib.RecordMessage(
+      id=_Id(rng), school=school, parents=parents, children=children,
+      num_parents=len(parents), num_children=len(children)))
+  return datamodel_lib.RecordCollectionMessage(items=items, etag=_Id(rng))
+
+
+def _Best(fn, *args):
+  best = None
+  for _ in xrange(REPEATS):
+    start = time.time()
+    result = fn(*args)
+    seconds = time.time() - start
+    best = seconds if best is None else min(best, seconds)
+  return result, best
+
+
+class WireBenchmark(unittest.TestCase):
+  """Encodes and decodes a school at each of SCALES."""
+
+  def setUp(self):
+    self.results = []
+
+  def tearDown(self):
+    for name, families, encode, decode, size, gzipped in self.results:
+      logging.info('%-24s %5d families encode %8.2fms decode %8.2fms '
+                   '%9d bytes %8d gzipped', name, families, encode * 1000,
+                   decode * 1000, size, gzipped)
+
+  def testScales(self):
+    for families in SCALES:
+      msg = SchoolMessage(families)
+      sizes = {}
+      for content_type in (wire.JSON, wire.PROTOBUF):
+        data, encode = _Best(wire.Encode, msg, content_type)
+        decoded, decode = _Best(wire.Decode,
+                                datamodel_lib.RecordCollectionMessage, data,
+                                content_type)
+        self.assertEquals(msg, decoded)
+        sizes[content_type] = len(data)
+        self.results.append((content_type, families, encode, decode,
+                             len(data), len(zlib.compress(data, 6))))
+      self.assertTrue(sizes[wire.PROTOBUF] < sizes[wire.JSON])
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
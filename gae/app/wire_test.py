@@ -0,0 +1,109 @@
+# Description:
+#   unittests for wire.py
+
+import unittest
+
+import webapp2
+
+import datamodel_lib
+import main
+import test_lib
+import wire
+
+
+def _Get(url, **headers):
+  return webapp2.Request.blank(url, headers=headers).get_response(main.app)
+
+
+class ContentTypeTest(unittest.TestCase):
+
+  def testNegotiates(self):
+    self.assertEquals(wire.JSON, wire.ContentType(None))
+    self.assertEquals(wire.JSON, wire.ContentType('text/html, */*'))
+    self.assertEquals(wire.PROTOBUF, wire.ContentType(
+      'application/x-protobuf;q=1.0, application/json;q=0.5'))
+    self.assertEquals(wire.JSON, wire.ContentType(
+      'application/json, application/x-protobuf'))
+    self.assertEquals(wire.PROTOBUF, wire.ContentType(None, 'proto'))
+    self.assertEquals(wire.JSON,
+                      wire.ContentType('application/x-protobuf', 'json'))
+    self.assertRaises(ValueError, wire.ContentType, None, 'xml')
+
+
+class CollectionHandlerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = test_lib.Activate()
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888')
+    test_lib.AddSuperUser()
+    datamodel_lib.District.FromMessage(
+      datamodel_lib.DistrictMessage(domain='test.org'))
+    school = datamodel_lib.SchoolMessage(district='test.org', name='test')
+    datamodel_lib.School.FromMessage(school)
+    for i in xrange(3):
+      datamodel_lib.Record.FromMessage(datamodel_lib.RecordMessage(
+        school=school,
+        parents=[datamodel_lib.PersonMessage(
+          first_name='mom', last_name='family%d' % (i),
+          email_addresses=['mom%d@example.com' % (i)])],
+        children=[datamodel_lib.PersonMessage(
+          first_name='kid', last_name='family%d' % (i))]))
+    # As a client of the route sends it: a bearer token, no Endpoints.
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888',
+                     endpoints=False)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testProtobufMatchesJson(self):
+    url = '/wire/record/list/test.org/test?page_size=10'
+    proto = _Get(url, Accept=wire.PROTOBUF)
+    self.assertEquals(200, proto.status_int)
+    self.assertEquals(wire.PROTOBUF, proto.content_type)
+    json = _Get(url)
+    self.assertEquals(wire.JSON, json.content_type)
+    proto_msg = wire.Decode(datamodel_lib.RecordCollectionMessage,
+                            proto.body, wire.PROTOBUF)
+    json_msg = wire.Decode(datamodel_lib.RecordCollectionMessage,
+                           json.body, wire.JSON)
+    self.assertEquals(3, len(proto_msg.items))
+    self.assertEquals(json_msg, proto_msg)
+    self.assertTrue(len(proto.body) < len(json.body))
+    self.assertEquals(proto_msg.etag, proto.headers['ETag'])
+
+  def testNotModified(self):
+    url = '/wire/school/list?alt=proto'
+    etag = _Get(url).headers['ETag']
+    self.assertEquals(304, _Get(url, **{'If-None-Match': etag}).status_int)
+
+  def testUnauthenticated(self):
+    url = '/wire/record/list/test.org/test'
+    test_lib.SetAnonymous(self.testbed)
+    response = _Get(url)
+    self.assertEquals(401, response.status_int)
+    self.assertEquals('Bearer', response.headers['WWW-Authenticate'])
+    # A token another client was issued is no better.
+    test_lib.SetUser(self.testbed, 'admin@parentd.com', '8888',
+                     endpoints=False)
+    self.testbed.setup_env(OAUTH_CLIENT_ID='someone-else', USER_EMAIL='',
+                           USER_ID='', overwrite=True)
+    self.assertEquals(401, _Get(url).status_int)
+
+  def testNoAccess(self):
+    test_lib.SetUser(self.testbed, 'joe@parentd.com', '1234',
+                     endpoints=False)
+    self.assertEquals(403, _Get('/wire/record/list/test.org/test').status_int)
+
+  def testBadRequests(self):
+    self.assertEquals(404, _Get('/wire/record/nope/test.org/test').status_int)
+    self.assertEquals(404, _Get('/wire/record/list/test.org').status_int)
+    for query in ('page_size=ten', 'page_size=-1', 'nope=1', 'alt=xml',
+                  'view=nope'):
+      self.assertEquals(
+        400, _Get('/wire/record/list/test.org/test?' + query).status_int)
+    # No q.
+    self.assertEquals(400, _Get('/wire/person/search/test.org/test').status_int)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,334 @@
+#!/usr/bin/python
+#
+# Description:
+#   Load generator for the parentd Endpoints API (services.api).
+#
+#   USERS threads each run a weighted MIX of district/school/record list
+#   and add calls for DURATION seconds, against a dev server (--MODE=http)
+#   or in-process against the testbed stubs (--MODE=testbed). Per endpoint
+#   it reports throughput, error rate and p50/p95/p99 latency, and writes
+#   them to OUTPUT as JSON with sorted keys, so two runs diff cleanly.
+#
+#   Against a dev server, started with dev_appserver.py gae/app:
+#     loadgen.py --MODE=http --URL=http://localhost:8080 --USERS=50 \
+#       --TOKEN="$(gcloud auth print-access-token)"
+#   In process, with the SDK on PYTHONPATH as for make test, or with make
+#   load in gae/app:
+#     loadgen.py --MODE=testbed --APP_DIR=gae/app --USERS=200
+
+import argparse
+import collections
+import datetime
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+import urllib
+import urllib2
+
+
+OPERATIONS = ('district.list', 'district.add', 'school.list', 'school.add',
+              'record.list', 'record.add')
+DEFAULT_MIX = ('district.list=2,school.list=2,record.list=10,record.add=4,'
+               'district.add=1,school.add=1')
+PERCENTILES = (50, 95, 99)
+PAGE_SIZE = 50
+ERROR_SAMPLES = 5  # Distinct error messages kept per endpoint.
+API_PATH = '/_ah/api/parentd/v1.0/'
+
+
+def ParseMix(mix):
+  """Parses 'op=weight,...' into [(op, weight)], for the ops with weight."""
+  weights = []
+  for item in mix.split(','):
+    op, _, weight = item.strip().partition('=')
+    if op not in OPERATIONS:
+      raise ValueError('Unknown operation %r, expected one of %s' % (
+        op, ', '.join(OPERATIONS)))
+    if int(weight or 1) > 0:
+      weights.append((op, int(weight or 1)))
+  if not weights:
+    raise ValueError('The mix has no operation with a weight.')
+  return weights
+
+
+def Percentile(values, pct):
+  """The nearest-rank pct percentile of values, which are sorted."""
+  if not values:
+    return None
+  rank = int(math.ceil(pct / 100.0 * len(values)))
+  return values[max(0, rank - 1)]
+
+
+class _Family(object):
+  """The fields of a generated family; targets turn them into requests."""
+  _ids = itertools.count()
+
+  def __init__(self):
+    n = next(self._ids)
+    self.last_name = 'family-%d' % (n)
+    self.parents = [('parent-%d' % (i), 'parent%d.%d@loadgen.test' % (i, n))
+                    for i in xrange(2)]
+    self.children = ['child-%d' % (i) for i in xrange(random.randint(1, 3))]
+
+
+class HttpTarget(object):
+  """Calls a running server over HTTP, as a client would."""
+
+  def __init__(self, flags):
+    self.base = flags.URL.rstrip('/') + API_PATH
+    self.token = flags.TOKEN
+    self.district = flags.DISTRICT
+    self.school = flags.SCHOOL
+    self.names = itertools.count()
+
+  def _Call(self, method, path, body=None, params=None):
+    url = self.base + path
+    if params:
+      url += '?' + urllib.urlencode(params)
+    request = urllib2.Request(url, data=body and json.dumps(body))
+    request.get_method = lambda: method
+    request.add_header('Content-Type', 'application/json')
+    if self.token:
+      request.add_header('Authorization', 'Bearer ' + self.token)
+    try:
+      return json.loads(urllib2.urlopen(request).read() or '{}')
+    except urllib2.HTTPError as e:
+      raise RuntimeError('HTTP %d on %s' % (e.code, path))
+
+  def _Record(self, family):
+    return {
+      'school': {'district': self.district, 'name': self.school},
+      'parents': [{'first_name': name, 'last_name': family.last_name,
+                   'email_addresses': [email]}
+                  for name, email in family.parents],
+      'children': [{'first_name': name, 'last_name': family.last_name}
+                   for name in family.children]}
+
+  def Seed(self, families):
+    self._Call('POST', 'district/add', {'domain': self.district})
+    self._Call('POST', 'school/add',
+               {'district': self.district, 'name': self.school})
+    for _ in xrange(families):
+      self._Call('POST', 'record/add', self._Record(_Family()))
+
+  def Call(self, op):
+    if op == 'district.list':
+      self._Call('GET', 'district/list', params={'page_size': PAGE_SIZE})
+    elif op == 'district.add':
+      self._Call('POST', 'district/add',
+                 {'domain': 'loadgen-%d.test' % (next(self.names))})
+    elif op == 'school.list':
+      self._Call('GET', 'school/list', params={'page_size': PAGE_SIZE})
+    elif op == 'school.add':
+      self._Call('POST', 'school/add',
+                 {'district': self.district,
+                  'name': 'loadgen-%d' % (next(self.names))})
+    elif op == 'record.list':
+      self._Call('GET', 'record/list/%s/%s' % (self.district, self.school),
+                 params={'page_size': PAGE_SIZE})
+    elif op == 'record.add':
+      self._Call('POST', 'record/add', self._Record(_Family()))
+
+  def Close(self):
+    pass
+
+
+class TestbedTarget(object):
+  """Calls the service methods in this process, on the testbed stubs.
+
+  The stubs keep everything in memory behind locks, so the numbers show
+  contention in the app code rather than datastore latency.
+  """
+
+  def __init__(self, flags):
+    sys.path.insert(0, os.path.abspath(flags.APP_DIR))
+    import test_lib
+    self.testbed = test_lib.Activate(taskqueue=True)
+    email = 'loadgen@parentd.com'
+    test_lib.SetUser(self.testbed, email, '1')
+    test_lib.AddSuperUser(email)
+    import datamodel_lib
+    import paging
+    import services
+    self.datamodel_lib = datamodel_lib
+    self.services = services
+    self.page = paging.PageResource.combined_message_class
+    self.record_list = (
+      services.RecordService.RecordListResource.combined_message_class)
+    self.district = flags.DISTRICT
+    self.school = flags.SCHOOL
+    self.names = itertools.count()
+
+  def _Record(self, family):
+    lib = self.datamodel_lib
+    return lib.RecordMessage(
+      school=lib.SchoolMessage(district=self.district, name=self.school),
+      parents=[lib.PersonMessage(first_name=name, last_name=family.last_name,
+                                 email_addresses=[email])
+               for name, email in family.parents],
+      children=[lib.PersonMessage(first_name=name, last_name=family.last_name)
+                for name in family.children])
+
+  def Seed(self, families):
+    lib = self.datamodel_lib
+    self.services.DistrictService().DistrictAdd(
+      lib.DistrictMessage(domain=self.district))
+    self.services.SchoolService().SchoolAdd(
+      lib.SchoolMessage(district=self.district, name=self.school))
+    for _ in xrange(families):
+      self.services.RecordService().RecordAdd(self._Record(_Family()))
+
+  def Call(self, op):
+    lib = self.datamodel_lib
+    if op == 'district.list':
+      self.services.DistrictService().DistrictList(
+        self.page(page_size=PAGE_SIZE))
+    elif op == 'district.add':
+      self.services.DistrictService().DistrictAdd(
+        lib.DistrictMessage(domain='loadgen-%d.test' % (next(self.names))))
+    elif op == 'school.list':
+      self.services.SchoolService().SchoolList(self.page(page_size=PAGE_SIZE))
+    elif op == 'school.add':
+      self.services.SchoolService().SchoolAdd(
+        lib.SchoolMessage(district=self.district,
+                          name='loadgen-%d' % (next(self.names))))
+    elif op == 'record.list':
+      self.services.RecordService().RecordList(self.record_list(
+        district=self.district, school=self.school, page_size=PAGE_SIZE))
+    elif op == 'record.add':
+      self.services.RecordService().RecordAdd(self._Record(_Family()))
+
+  def Close(self):
+    self.testbed.deactivate()
+
+
+TARGETS = {'http': HttpTarget, 'testbed': TestbedTarget}
+
+
+def _Worker(target, mix, deadline, seed, samples):
+  """Calls target until deadline, appending (op, seconds, error) to samples."""
+  rand = random.Random(seed)
+  ops = [op for op, weight in mix for _ in xrange(weight)]
+  while time.time() < deadline:
+    op = rand.choice(ops)
+    error = None
+    start = time.time()
+    try:
+      target.Call(op)
+    except Exception as e:  # Every failure counts against the endpoint.
+      error = '%s: %s' % (type(e).__name__, e)
+    samples.append((op, time.time() - start, error))
+
+
+def Summarize(samples, wall_seconds):
+  """Throughput, error rate and latency percentiles of samples.
+
+  Returns:
+    dict: Stats per endpoint, and for all of them under 'total'.
+  """
+  by_op = collections.defaultdict(list)
+  for sample in samples:
+    by_op[sample[0]].append(sample)
+    by_op['total'].append(sample)
+  summary = {}
+  for op, op_samples in by_op.iteritems():
+    latencies = sorted(seconds * 1000 for _, seconds, _ in op_samples)
+    errors = [e for _, _, e in op_samples if e]
+    latency_ms = dict(('p%d' % (p), round(Percentile(latencies, p), 2))
+                      for p in PERCENTILES)
+    latency_ms['mean'] = round(sum(latencies) / len(latencies), 2)
+    latency_ms['max'] = round(latencies[-1], 2)
+    summary[op] = {
+      'requests': len(op_samples),
+      'errors': len(errors),
+      'error_rate': round(float(len(errors)) / len(op_samples), 4),
+      'throughput_rps': round(len(op_samples) / wall_seconds, 2),
+      'latency_ms': latency_ms,
+      'error_samples': sorted(set(errors))[:ERROR_SAMPLES],
+    }
+  return summary
+
+
+def main(flags):
+  mix = ParseMix(flags.MIX)
+  target = TARGETS[flags.MODE](flags)
+  try:
+    logging.info('Seeding %s/%s with %d families', flags.DISTRICT,
+                 flags.SCHOOL, flags.FAMILIES)
+    target.Seed(flags.FAMILIES)
+    samples = [[] for _ in xrange(flags.USERS)]
+    started = datetime.datetime.utcnow()
+    start = time.time()
+    deadline = start + flags.DURATION
+    threads = [threading.Thread(target=_Worker, args=(
+                 target, mix, deadline, flags.SEED + i, samples[i]))
+               for i in xrange(flags.USERS)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    wall_seconds = time.time() - start
+  finally:
+    target.Close()
+  endpoints = Summarize([s for ss in samples for s in ss], wall_seconds)
+  results = {
+    'config': {'mode': flags.MODE, 'users': flags.USERS,
+               'duration_seconds': flags.DURATION, 'mix': dict(mix),
+               'families': flags.FAMILIES, 'seed': flags.SEED},
+    'started': started.isoformat() + 'Z',
+    'wall_seconds': round(wall_seconds, 2),
+    'endpoints': endpoints,
+  }
+  with open(flags.OUTPUT, 'w') as output:
+    json.dump(results, output, indent=2, sort_keys=True)
+  for op in sorted(endpoints):
+    stats = endpoints[op]
+    logging.info('%-14s %6d req %8.2f/s %6.2f%% errors  p50 %8.2fms  '
+                 'p95 %8.2fms  p99 %8.2fms', op, stats['requests'],
+                 stats['throughput_rps'], stats['error_rate'] * 100,
+                 stats['latency_ms']['p50'], stats['latency_ms']['p95'],
+                 stats['latency_ms']['p99'])
+  logging.info('Results written to %s', flags.OUTPUT)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Load test the parentd API')
+  parser.add_argument('--MODE', choices=sorted(TARGETS), default='testbed',
+                      help='Call a server over HTTP, or the testbed stubs.')
+  parser.add_argument('--URL', default='http://localhost:8080',
+                      help='The server, for --MODE=http.')
+  parser.add_argument('--TOKEN', help=(
+      'An OAuth access token of a super user, for --MODE=http.'))
+  parser.add_argument('--APP_DIR', default=os.path.join(
+      os.path.dirname(os.path.abspath(__file__)), '..', 'gae', 'app'),
+                      help='The app, for --MODE=testbed.')
+  parser.add_argument('--USERS', type=int, default=50,
+                      help='Concurrent users, one thread each.')
+  parser.add_argument('--DURATION', type=float, default=30,
+                      help='Seconds to run for.')
+  parser.add_argument('--MIX', default=DEFAULT_MIX, help=(
+      'Weighted operations, e.g. record.list=3,record.add=1. One of: %s'
+      % (', '.join(OPERATIONS))))
+  parser.add_argument('--FAMILIES', type=int, default=100,
+                      help='Families written to the school before the run.')
+  parser.add_argument('--DISTRICT', default='loadgen.test',
+                      help='The district the run lists and writes.')
+  parser.add_argument('--SCHOOL', default='loadgen',
+                      help='The school the run lists and writes.')
+  parser.add_argument('--SEED', type=int, default=0,
+                      help='Seeds the operation choices, user i gets SEED+i.')
+  parser.add_argument('--OUTPUT', default='loadgen_results.json',
+                      help='The JSON results file.')
+  parser.add_argument('--logtostderr', action='store_true',
+                      help='Print logging to stderr')
+  args = parser.parse_args()
+  if args.logtostderr:
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(levelname)-1s %(asctime)-15s] %(message)s')
+  main(args)
@@ -15,11 +15,11 @@ def main(flags):
     tests = loader.loadTestsFromNames(flags.TESTS)
   else:
     logging.info('Searching %s for tests.', flags.TEST_DIR)
-    tests = loader.discover(os.getcwd(), '*_test.py')
+    tests = loader.discover(os.getcwd(), flags.PATTERN)
   runner = unittest.TextTestRunner(verbosity=2)
   result = runner.run(tests)
   logging.info('Test result: %s', result)
-  if result.errors:
+  if not result.wasSuccessful():
     sys.exit(1)
 
 
@@ -29,6 +29,8 @@ if __name__ == '__main__':
                       help='The fully qualified names of the tests to run.')
   parser.add_argument('--TEST_DIR', nargs=1, help=(
       'The directory to search for test files matching *_test.py pattern.'))
+  parser.add_argument('--PATTERN', default='*_test.py', help=(
+      'The file pattern to discover, e.g. *_bench.py for the benchmarks.'))
   parser.add_argument('--logtostderr', action='store_true',
                       help='Print logging to stderr')
   args = parser.parse_args()